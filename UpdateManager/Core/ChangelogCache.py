@@ -0,0 +1,174 @@
+# ChangelogCache.py
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+#
+#  Copyright (c) 2013 Canonical
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+from __future__ import absolute_import, print_function
+
+import apt_pkg
+import json
+import logging
+import os
+import threading
+import time
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+from .utils import get_cache_dir, write_file_atomic
+
+
+class ChangelogCacheEntry(object):
+    """ a single cached changelog (or NEWS.Debian) file, if complete
+        is False only the start of the file is in data
+    """
+
+    def __init__(self, data, etag=None, last_modified=None, validated=0,
+                 complete=True):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.validated = validated
+        self.complete = complete
+
+
+class ChangelogCache(object):
+    """
+    Persistent on-disk cache for the changelog and NEWS.Debian files
+    that are downloaded from the changelogs server. Entries are keyed
+    by (srcpkg, srcver, fname), the cache is size bounded with least
+    recently used eviction and entries older than MAX_AGE are
+    revalidated with the server (If-None-Match/If-Modified-Since).
+    """
+
+    # the configuration keys to change the defaults below
+    MAX_SIZE_KEY = "Update-Manager::Changelog-Cache-Size"
+    MAX_AGE_KEY = "Update-Manager::Changelog-Cache-Max-Age"
+
+    # in MB
+    MAX_SIZE = 20
+    # in seconds
+    MAX_AGE = 24 * 60 * 60
+
+    def __init__(self, cache_dir=None, max_size=None, max_age=None):
+        self._cache_dir = cache_dir
+        if max_size is None:
+            max_size = apt_pkg.config.find_i(
+                self.MAX_SIZE_KEY, self.MAX_SIZE) * 1000 * 1000
+        self.max_size = max_size
+        if max_age is None:
+            max_age = apt_pkg.config.find_i(self.MAX_AGE_KEY, self.MAX_AGE)
+        self.max_age = max_age
+        self._lock = threading.Lock()
+
+    @property
+    def cache_dir(self):
+        # resolved lazily so that nothing is created on disk unless
+        # a changelog is actually fetched
+        if self._cache_dir is None:
+            self._cache_dir = get_cache_dir("changelogs")
+        return self._cache_dir
+
+    def _path(self, srcpkg, srcver, fname):
+        name = "%s_%s_%s" % (srcpkg, srcver, fname)
+        return os.path.join(self.cache_dir, quote(name, safe="+.~-"))
+
+    def is_fresh(self, entry):
+        " return True if the entry does not need revalidation "
+        return time.time() - entry.validated < self.max_age
+
+    def lookup(self, srcpkg, srcver, fname):
+        """ return the ChangelogCacheEntry for the given key or None """
+        if self.cache_dir is None:
+            return None
+        path = self._path(srcpkg, srcver, fname)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            with open(path + ".meta") as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        # bump the mtime, it is the clock for the lru eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return ChangelogCacheEntry(data,
+                                   meta.get("etag"),
+                                   meta.get("last-modified"),
+                                   meta.get("validated", 0),
+                                   meta.get("complete", True))
+
+    def revalidated(self, srcpkg, srcver, fname, entry):
+        """ mark a entry as still valid (e.g. after a 304 reply) """
+        entry.validated = time.time()
+        self._write_meta(self._path(srcpkg, srcver, fname), entry)
+
+    def store(self, srcpkg, srcver, fname, entry):
+        """ add the ChangelogCacheEntry to the cache """
+        if self.cache_dir is None:
+            return
+        path = self._path(srcpkg, srcver, fname)
+        entry.validated = time.time()
+        try:
+            write_file_atomic(path, entry.data)
+            self._write_meta(path, entry)
+        except (IOError, OSError) as e:
+            logging.warning("failed to write changelog cache '%s': %s" % (
+                path, e))
+            return
+        self._evict()
+
+    def _write_meta(self, path, entry):
+        meta = {"etag": entry.etag,
+                "last-modified": entry.last_modified,
+                "validated": entry.validated,
+                "complete": entry.complete}
+        try:
+            write_file_atomic(path + ".meta",
+                              json.dumps(meta).encode("UTF-8"))
+        except (IOError, OSError) as e:
+            logging.warning("failed to write changelog cache '%s': %s" % (
+                path, e))
+
+    def _evict(self):
+        " remove the least recently used entries until we fit max_size "
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.cache_dir):
+                if name.startswith(".") or name.endswith(".meta"):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+            entries.sort()
+            while total > self.max_size and entries:
+                (mtime, size, path) = entries.pop(0)
+                for p in [path, path + ".meta"]:
+                    try:
+                        os.unlink(p)
+                    except OSError:
+                        pass
+                total -= size
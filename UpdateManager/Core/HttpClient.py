@@ -0,0 +1,250 @@
+# HttpClient.py
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+#
+#  Copyright (c) 2013 Canonical
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+from __future__ import absolute_import, print_function
+
+import apt_pkg
+import base64
+import socket
+import threading
+from io import BytesIO
+try:
+    from http.client import HTTPConnection, HTTPException, HTTPSConnection
+except ImportError:
+    from httplib import HTTPConnection, HTTPException, HTTPSConnection
+try:
+    from urllib.error import HTTPError
+    from urllib.parse import unquote, urljoin, urlsplit
+    from urllib.request import Request, getproxies, proxy_bypass, urlopen
+except ImportError:
+    from urllib import getproxies, proxy_bypass, unquote
+    from urllib2 import HTTPError, Request, urlopen
+    from urlparse import urljoin, urlsplit
+
+
+class HttpResponse(object):
+    """ a response of HttpClient.open(), it has the parts of the
+        urlopen() response interface that update-manager uses. The
+        connection goes back to the pool when the body was read
+        completely before close()
+    """
+
+    def __init__(self, client, key, conn, response, url):
+        self._client = client
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._lock = threading.Lock()
+        self.code = response.status
+        self.msg = response.reason
+        self.url = url
+
+    def info(self):
+        return self._response.msg
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def close(self):
+        # close() may be called from another thread to abort a read,
+        # the connection is only reused when nobody reads from it
+        with self._lock:
+            conn = self._conn
+            self._conn = None
+        if conn is None:
+            return
+        if not self._response.isclosed() and self._response.length == 0:
+            # e.g. HEAD, there is nothing to wait for
+            self._response.read()
+        if self._response.isclosed() and not self._response.will_close:
+            self._client._release(self._key, conn)
+        else:
+            # closing alone does not wake up a read that is blocked
+            # in another thread
+            if conn.sock is not None:
+                try:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            self._response.close()
+            conn.close()
+
+
+class HttpClient(object):
+    """
+    Minimal HTTP client that keeps the connections to each host open
+    between the requests, so that fetching many files from the same
+    server (like the changelogs of all updates) does not connect for
+    every file. The proxy from the environment (see utils.init_proxy)
+    is used. Other schemes than http and https are passed on to
+    urlopen().
+    """
+
+    # the configuration keys to change the defaults below
+    TIMEOUT_KEY = "Update-Manager::Http-Timeout"
+    MAX_IDLE_KEY = "Update-Manager::Http-Max-Idle-Connections"
+
+    # seconds
+    TIMEOUT = 20
+    # idle connections that are kept per host
+    MAX_IDLE = 4
+    MAX_REDIRECTS = 5
+
+    def __init__(self, timeout=None, max_idle=None):
+        if timeout is None:
+            timeout = apt_pkg.config.find_i(self.TIMEOUT_KEY, self.TIMEOUT)
+        if max_idle is None:
+            max_idle = apt_pkg.config.find_i(self.MAX_IDLE_KEY,
+                                             self.MAX_IDLE)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        # (scheme, host, port, proxy) -> [idle connections]
+        self._idle = {}
+
+    def _get_proxy(self, scheme, netloc):
+        proxy = getproxies().get(scheme)
+        if not proxy or proxy_bypass(netloc.rsplit("@", 1)[-1]):
+            return None
+        if "://" not in proxy:
+            proxy = "http://" + proxy
+        return proxy
+
+    def _connect(self, key):
+        (scheme, host, port, proxy) = key
+        if proxy is None:
+            connection_class = (HTTPSConnection if scheme == "https"
+                                else HTTPConnection)
+            return connection_class(host, port, timeout=self.timeout)
+        res = urlsplit(proxy)
+        connection_class = (HTTPSConnection if res.scheme == "https"
+                            else HTTPConnection)
+        conn = connection_class(res.hostname, res.port, timeout=self.timeout)
+        if scheme == "https":
+            headers = self._get_proxy_headers(proxy)
+            conn.set_tunnel(host, port, headers=headers)
+        return conn
+
+    def _get_proxy_headers(self, proxy):
+        res = urlsplit(proxy)
+        if not res.username:
+            return {}
+        credentials = "%s:%s" % (unquote(res.username),
+                                 unquote(res.password or ""))
+        return {"Proxy-Authorization": "Basic %s" % base64.b64encode(
+            credentials.encode("UTF-8")).decode("ascii")}
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return (idle.pop(), True)
+        return (self._connect(key), False)
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        " close all idle connections "
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+    def _send(self, method, url, headers):
+        res = urlsplit(url)
+        port = res.port or (443 if res.scheme == "https" else 80)
+        proxy = self._get_proxy(res.scheme, res.netloc)
+        key = (res.scheme, res.hostname, port, proxy)
+        if proxy is not None and res.scheme == "http":
+            # plain http goes to the proxy with the full url
+            target = url
+            headers = dict(self._get_proxy_headers(proxy), **headers)
+        else:
+            target = res.path or "/"
+            if res.query:
+                target += "?" + res.query
+        while True:
+            (conn, reused) = self._acquire(key)
+            try:
+                conn.request(method, target, headers=headers)
+                response = conn.getresponse()
+            except (HTTPException, socket.error):
+                conn.close()
+                # the server may have closed an idle connection
+                # meanwhile, that is only noticed on the next request
+                if reused:
+                    continue
+                raise
+            return HttpResponse(self, key, conn, response, url)
+
+    def open(self, request):
+        """ send the urllib Request (or url) and return the response, like
+            urlopen() raises HTTPError for error codes (including 304)
+        """
+        if not isinstance(request, Request):
+            request = Request(request)
+        url = request.get_full_url()
+        if urlsplit(url).scheme not in ("http", "https"):
+            return urlopen(request, timeout=self.timeout)
+        method = request.get_method()
+        headers = dict(request.header_items())
+        for i in range(self.MAX_REDIRECTS + 1):
+            response = self._send(method, url, headers)
+            if response.code in (301, 302, 303, 307, 308):
+                location = response.info().get("Location")
+                response.read()
+                response.close()
+                if location is None:
+                    break
+                url = urljoin(url, location)
+                if response.code == 303:
+                    method = "GET"
+                continue
+            if response.code < 300:
+                return response
+            break
+        body = response.read()
+        response.close()
+        raise HTTPError(url, response.code, response.msg, response.info(),
+                        BytesIO(body))
+
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client():
+    " return the HttpClient that is shared by all downloads "
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = HttpClient()
+        return _http_client
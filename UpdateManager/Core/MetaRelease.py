@@ -28,24 +28,30 @@ try:
 except ImportError:
     import ConfigParser as configparser
 try:
-    from http.client import BadStatusLine
+    from http.client import HTTPException
 except ImportError:
-    from httplib import BadStatusLine
+    from httplib import HTTPException
+import json
 import logging
 import email.utils
+import fcntl
 import os
 import socket
 import sys
+import tempfile
 import time
 import threading
+import zlib
 try:
-    from urllib.request import Request, urlopen
+    from urllib.request import Request
     from urllib.error import HTTPError, URLError
 except ImportError:
-    from urllib2 import HTTPError, Request, URLError, urlopen
+    from urllib2 import HTTPError, Request, URLError
 
+from .HttpClient import get_http_client
 from .utils import (get_lang, get_dist, get_dist_version, get_ubuntu_flavor,
-                    get_ubuntu_flavor_name)
+                    get_ubuntu_flavor_name, get_user_cache_dir, trace_span,
+                    write_file_atomic)
 
 
 class Dist(object):
@@ -61,6 +67,28 @@ class Dist(object):
         # the server may report that the upgrade is broken currently
         self.upgrade_broken = None
 
+    def to_dict(self):
+        return {"Dist": self.name,
+                "Version": self.version,
+                "Date": self.date,
+                "Supported": self.supported,
+                "ReleaseNotes": self.releaseNotesURI,
+                "ReleaseNotesHtml": self.releaseNotesHtmlUri,
+                "UpgradeTool": self.upgradeTool,
+                "UpgradeToolSignature": self.upgradeToolSig,
+                "UpgradeBroken": self.upgrade_broken}
+
+    @classmethod
+    def from_dict(cls, data):
+        dist = cls(data["Dist"], data["Version"], data["Date"],
+                   data["Supported"])
+        dist.releaseNotesURI = data["ReleaseNotes"]
+        dist.releaseNotesHtmlUri = data["ReleaseNotesHtml"]
+        dist.upgradeTool = data["UpgradeTool"]
+        dist.upgradeToolSig = data["UpgradeToolSignature"]
+        dist.upgrade_broken = data["UpgradeBroken"]
+        return dist
+
 
 class MetaReleaseCore(object):
     """
@@ -74,6 +102,20 @@ class MetaReleaseCore(object):
     CONF = "/etc/update-manager/release-upgrades"
     CONF_METARELEASE = "/etc/update-manager/meta-release"
 
+    # the system-wide location of the meta-release file
+    METARELEASE_DIR = "/var/lib/update-manager/"
+    # the size of the blocks in which the meta-release file is written
+    CHUNK_SIZE = 16 * 1024
+    # a meta-release file that was fetched less than this many seconds
+    # ago is used without asking the server again
+    REFRESH_INTERVAL_KEY = "Update-Manager::MetaRelease-Refresh-Interval"
+    REFRESH_INTERVAL = 60 * 60
+    # the format of METARELEASE_PARSED_FILE
+    PARSED_VERSION = 1
+    # seconds after which a download is given up, see wait()
+    TIMEOUT_KEY = "Update-Manager::MetaRelease-Timeout"
+    TIMEOUT = 60
+
     def __init__(self,
                  useDevelopmentRelease=False,
                  useProposed=False,
@@ -91,6 +133,14 @@ class MetaReleaseCore(object):
         self.current_dist_name = get_dist()
         self.current_dist_version = get_dist_version()
         self.no_longer_supported = None
+        self.refresh_interval = apt_pkg.config.find_i(
+            self.REFRESH_INTERVAL_KEY, self.REFRESH_INTERVAL)
+        self.timeout = apt_pkg.config.find_i(self.TIMEOUT_KEY, self.TIMEOUT)
+        self._done = threading.Event()
+        self._cancelled = threading.Event()
+        # the response that is being read, to abort it in cancel()
+        self._response = None
+        self._response_lock = threading.Lock()
 
         # default (if the conf file is missing)
         base_uri = "http://changelogs.ubuntu.com/"
@@ -107,6 +157,7 @@ class MetaReleaseCore(object):
             except configparser.Error as e:
                 sys.stderr.write("ERROR: failed to read '%s':\n%s" % (
                                  self.CONF_METARELEASE, e))
+                self._finish()
                 return
             # make changing the metarelease file and the location
             # for the files easy
@@ -129,6 +180,7 @@ class MetaReleaseCore(object):
             except configparser.Error as e:
                 sys.stderr.write("ERROR: failed to read '%s':\n%s" % (
                                  self.CONF, e))
+                self._finish()
                 return
             # now check which specific url to use
             if parser.has_option("DEFAULT", "Prompt"):
@@ -136,7 +188,7 @@ class MetaReleaseCore(object):
                 if (type == "never" or type == "no"):
                     # nothing to do for this object
                     # FIXME: what about no longer supported?
-                    self.downloading = False
+                    self._finish()
                     return
                 elif type == "lts":
                     self.METARELEASE_URI = self.METARELEASE_URI_LTS
@@ -153,6 +205,15 @@ class MetaReleaseCore(object):
         self.metarelease_information = None
         if not self._buildMetaReleaseFile():
             self._debug("_buildMetaReleaseFile failed")
+            self._finish()
+            return
+        if self._is_fresh():
+            # somebody fetched the file recently, there is nothing to
+            # wait for
+            self._debug("using recent '%s'" % self.METARELEASE_FILE)
+            self.metarelease_information = open(self.METARELEASE_FILE, "r")
+            self._parse_metarelease_information()
+            self._finish()
             return
         # we start the download thread here and we have a timeout
         threading.Thread(target=self.download).start()
@@ -161,49 +222,150 @@ class MetaReleaseCore(object):
     def _buildMetaReleaseFile(self):
         # build the metarelease_file name
         self.METARELEASE_FILE = os.path.join(
-            "/var/lib/update-manager/",
+            self.METARELEASE_DIR,
             os.path.basename(self.METARELEASE_URI))
         # check if we can write to the global location, if not,
-        # write to homedir
+        # use it read-only while it is recent or write to homedir
         try:
-            open(self.METARELEASE_FILE, "a")
+            open(self.METARELEASE_FILE, "a").close()
         except IOError as e:
-            cache_dir = os.getenv(
-                "XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
-            # Take special care when creating this directory; ~/.cache needs
-            # to be created with mode 0700, but the other directories do
-            # not.
-            cache_parent_dir = os.path.split(cache_dir)[0]
-            if not os.path.exists(cache_parent_dir):
-                try:
-                    os.makedirs(cache_parent_dir)
-                except OSError as e:
-                    sys.stderr.write("mkdir() failed: '%s'" % e)
-                    return False
-            if not os.path.exists(cache_dir):
-                try:
-                    os.mkdir(cache_dir, 0o700)
-                except OSError as e:
-                    sys.stderr.write("mkdir() failed: '%s'" % e)
-                    return False
-            path = os.path.join(cache_dir, 'update-manager-core')
-            if not os.path.exists(path):
-                try:
-                    os.mkdir(path)
-                except OSError as e:
-                    sys.stderr.write("mkdir() failed: '%s'" % e)
-                    return False
+            if self._is_fresh():
+                self._debug("using read-only '%s'" % self.METARELEASE_FILE)
+                return True
+            path = get_user_cache_dir()
+            if path is None:
+                return False
             self.METARELEASE_FILE = os.path.join(
                 path,
                 os.path.basename(self.METARELEASE_URI))
         # if it is empty, remove it to avoid I-M-S hits on empty file
         try:
             if os.path.getsize(self.METARELEASE_FILE) == 0:
-                os.unlink(self.METARELEASE_FILE)
+                self._remove_metarelease_file()
         except Exception as e:
             pass
         return True
 
+    @property
+    def METARELEASE_HEADERS_FILE(self):
+        " the validators (ETag, Last-Modified) of the downloaded file "
+        return self.METARELEASE_FILE + ".headers"
+
+    @property
+    def METARELEASE_LOCK_FILE(self):
+        " serializes the downloads of concurrent instances "
+        return self.METARELEASE_FILE + ".lock"
+
+    @property
+    def METARELEASE_PARSED_FILE(self):
+        " the dists of the file, to skip parsing it again "
+        return self.METARELEASE_FILE + ".parsed"
+
+    def _remove_metarelease_file(self):
+        for path in [self.METARELEASE_FILE, self.METARELEASE_HEADERS_FILE,
+                     self.METARELEASE_PARSED_FILE]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                self._debug("can not remove '%s': %s" % (path, e))
+
+    def _is_fresh(self):
+        """ True if the meta-release file was fetched (or found to be
+            unchanged) less than refresh_interval seconds ago
+        """
+        if self.forceDownload:
+            return False
+        try:
+            st = os.stat(self.METARELEASE_FILE)
+        except OSError:
+            return False
+        age = time.time() - st.st_mtime
+        return (st.st_size > 0 and 0 <= age < self.refresh_interval and
+                os.access(self.METARELEASE_FILE, os.R_OK))
+
+    def _lock(self):
+        """ wait until no other process downloads the meta-release file,
+            return the lock file (to close) or None if it can not be used
+        """
+        try:
+            lock = open(self.METARELEASE_LOCK_FILE, "a")
+        except IOError as e:
+            self._debug("can not open '%s': %s" % (
+                self.METARELEASE_LOCK_FILE, e))
+            return None
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        except IOError as e:
+            self._debug("can not lock '%s': %s" % (
+                self.METARELEASE_LOCK_FILE, e))
+            lock.close()
+            return None
+        return lock
+
+    def _read_headers_file(self):
+        try:
+            with open(self.METARELEASE_HEADERS_FILE) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _add_conditional_headers(self, req):
+        """ ask the server to only send the file if it changed since
+            the download of the local copy
+        """
+        try:
+            lastmodified = os.stat(self.METARELEASE_FILE).st_mtime
+        except OSError:
+            return
+        headers = self._read_headers_file()
+        if headers.get("ETag"):
+            req.add_header("If-None-Match", headers["ETag"])
+        # the date of the server if we have it, the mtime otherwise
+        if headers.get("Last-Modified"):
+            req.add_header("If-Modified-Since", headers["Last-Modified"])
+        elif lastmodified > 0:
+            req.add_header("If-Modified-Since",
+                           email.utils.formatdate(lastmodified, usegmt=True))
+
+    def _save_response(self, response):
+        """ write the response to METARELEASE_FILE, the file is replaced
+            only once the download is complete
+        """
+        decompressor = None
+        if response.info().get("Content-Encoding") == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        (fd, tmp) = tempfile.mkstemp(
+            dir=os.path.dirname(self.METARELEASE_FILE), prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    data = response.read(self.CHUNK_SIZE)
+                    if self._cancelled.is_set():
+                        # the data read after cancel() may be cut off
+                        raise IOError("download cancelled")
+                    if not data:
+                        break
+                    if decompressor is not None:
+                        data = decompressor.decompress(data)
+                    f.write(data)
+                if decompressor is not None:
+                    f.write(decompressor.flush())
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, self.METARELEASE_FILE)
+        except BaseException:
+            # like write_file_atomic(), the error is passed on
+            os.unlink(tmp)
+            raise
+        headers = dict((key, response.info().get(key))
+                       for key in ["ETag", "Last-Modified"]
+                       if response.info().get(key))
+        try:
+            write_file_atomic(self.METARELEASE_HEADERS_FILE,
+                              json.dumps(headers).encode("UTF-8"))
+        except (IOError, OSError) as e:
+            self._debug("can not write '%s': %s" % (
+                self.METARELEASE_HEADERS_FILE, e))
+
     def dist_no_longer_supported(self, dist):
         """ virtual function that is called when the distro is no longer
             supported
@@ -216,14 +378,41 @@ class MetaReleaseCore(object):
         """
         self.new_dist = dist
 
-    def parse(self):
-        self._debug("MetaRelease.parse()")
-        current_dist_name = self.current_dist_name
-        self._debug("current dist name: '%s'" % current_dist_name)
-        current_dist = None
-        dists = []
+    def done_downloading(self):
+        """ virtual function that is called when the result is known,
+            in the download thread unless it was known right away
+        """
+        pass
 
-        # parse the metarelease_information file
+    def _finish(self):
+        self.downloading = False
+        self._done.set()
+        self.done_downloading()
+
+    def wait(self, timeout=None):
+        """ wait until the result is known, the download is cancelled
+            if that takes longer than timeout seconds
+
+            :return: False if the download was cancelled
+        """
+        if not self._done.wait(timeout):
+            self.cancel()
+            return False
+        return True
+
+    def cancel(self):
+        " abort the download, the result is then unknown "
+        self._cancelled.set()
+        with self._response_lock:
+            response = self._response
+        if response is not None:
+            response.close()
+
+    def _read_dists(self):
+        """ return the dists of the metarelease_information file, with
+            the release notes uris as they are in the file
+        """
+        dists = []
         index_tag = apt_pkg.TagFile(self.metarelease_information)
         step_result = index_tag.step()
         while step_result:
@@ -240,15 +429,9 @@ class MetaReleaseCore(object):
                 dist = Dist(name, version, date, supported)
                 if "ReleaseNotes" in index_tag.section:
                     dist.releaseNotesURI = index_tag.section["ReleaseNotes"]
-                    lang = get_lang()
-                    if lang:
-                        dist.releaseNotesURI += "?lang=%s" % lang
                 if "ReleaseNotesHtml" in index_tag.section:
                     dist.releaseNotesHtmlUri = index_tag.section[
                         "ReleaseNotesHtml"]
-                    query = self._get_release_notes_uri_query_string(dist)
-                    if query:
-                        dist.releaseNotesHtmlUri += query
                 if "UpgradeTool" in index_tag.section:
                     dist.upgradeTool = index_tag.section["UpgradeTool"]
                 if "UpgradeToolSignature" in index_tag.section:
@@ -257,9 +440,82 @@ class MetaReleaseCore(object):
                 if "UpgradeBroken" in index_tag.section:
                     dist.upgrade_broken = index_tag.section["UpgradeBroken"]
                 dists.append(dist)
-                if name == current_dist_name:
-                    current_dist = dist
             step_result = index_tag.step()
+        return dists
+
+    def _get_parsed_key(self):
+        """ return what the parsed dists depend on or None if the
+            metarelease_information is not METARELEASE_FILE
+        """
+        if (getattr(self.metarelease_information, "name", None) !=
+                self.METARELEASE_FILE):
+            return None
+        st = os.fstat(self.metarelease_information.fileno())
+        key = {"version": self.PARSED_VERSION,
+               "size": st.st_size,
+               # the dates are in local time
+               "timezone": time.timezone}
+        # the mtime changes when the file is revalidated, the ETag
+        # only when it changes
+        etag = self._read_headers_file().get("ETag")
+        if etag:
+            key["etag"] = etag
+        else:
+            key["mtime"] = st.st_mtime
+        return key
+
+    def _load_parsed_dists(self, key):
+        try:
+            with open(self.METARELEASE_PARSED_FILE) as f:
+                parsed = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if parsed.get("key") != key:
+            return None
+        return [Dist.from_dict(data) for data in parsed["dists"]]
+
+    def _save_parsed_dists(self, key, dists):
+        parsed = {"key": key, "dists": [dist.to_dict() for dist in dists]}
+        try:
+            write_file_atomic(self.METARELEASE_PARSED_FILE,
+                              json.dumps(parsed).encode("UTF-8"))
+        except (IOError, OSError) as e:
+            self._debug("can not write '%s': %s" % (
+                self.METARELEASE_PARSED_FILE, e))
+
+    def parse(self):
+        self._debug("MetaRelease.parse()")
+        current_dist_name = self.current_dist_name
+        self._debug("current dist name: '%s'" % current_dist_name)
+        current_dist = None
+
+        # parse the metarelease_information file, unless it was parsed
+        # before
+        key = self._get_parsed_key()
+        dists = None
+        if key is not None:
+            dists = self._load_parsed_dists(key)
+        if dists is None:
+            dists = self._read_dists()
+            if key is not None:
+                self._save_parsed_dists(key, dists)
+
+        # the release notes are in the language and for the flavor
+        # of the system
+        lang = get_lang()
+        flavor = None
+        for dist in dists:
+            if dist.releaseNotesURI and lang:
+                dist.releaseNotesURI += "?lang=%s" % lang
+            if dist.releaseNotesHtmlUri:
+                if flavor is None:
+                    flavor = get_ubuntu_flavor()
+                query = self._get_release_notes_uri_query_string(
+                    dist, lang=lang, flavor=flavor)
+                if query:
+                    dist.releaseNotesHtmlUri += query
+            if dist.name == current_dist_name:
+                current_dist = dist
 
         # first check if the current runing distro is in the meta-release
         # information. if not, we assume that we run on something not
@@ -291,23 +547,50 @@ class MetaReleaseCore(object):
     # the network thread that tries to fetch the meta-index file
     # can't touch the gui, runs as a thread
     def download(self):
+        self.downloading = True
+        self._done.clear()
+        try:
+            with trace_span("MetaRelease download"):
+                self._download()
+        finally:
+            self._finish()
+
+    def _download(self):
         self._debug("MetaRelease.download()")
-        lastmodified = 0
+        lock = self._lock()
+        try:
+            if self._is_fresh():
+                # fetched by another instance while we waited for the lock
+                self._debug("reading file '%s'" % self.METARELEASE_FILE)
+                self.metarelease_information = open(self.METARELEASE_FILE,
+                                                    "r")
+            elif not self._cancelled.is_set():
+                self._fetch()
+        finally:
+            if lock is not None:
+                lock.close()
+        if self._cancelled.is_set():
+            self._debug("meta-release download cancelled")
+            return
+        self._parse_metarelease_information()
+
+    def _fetch(self):
         req = Request(self.METARELEASE_URI)
         # make sure that we always get the latest file (#107716)
         req.add_header("Cache-Control", "No-Cache")
         req.add_header("Pragma", "no-cache")
-        if os.access(self.METARELEASE_FILE, os.W_OK):
-            try:
-                lastmodified = os.stat(self.METARELEASE_FILE).st_mtime
-            except OSError as e:
-                pass
-        if lastmodified > 0 and not self.forceDownload:
-            req.add_header("If-Modified-Since",
-                           time.asctime(time.gmtime(lastmodified)))
+        req.add_header("Accept-Encoding", "gzip")
+        if (os.access(self.METARELEASE_FILE, os.W_OK) and
+                not self.forceDownload):
+            self._add_conditional_headers(req)
         try:
             # open
-            uri = urlopen(req, timeout=20)
+            uri = get_http_client().open(req)
+            with self._response_lock:
+                self._response = uri
+            if self._cancelled.is_set():
+                uri.close()
+                return
             # sometime there is a root owned meta-relase file
             # there, try to remove it so that we get it
             # with proper permissions
@@ -320,14 +603,14 @@ class MetaReleaseCore(object):
                                                       e))
             # we may get exception here on e.g. disk full
             try:
-                f = open(self.METARELEASE_FILE, "w+")
-                for line in uri.readlines():
-                    f.write(line.decode("UTF-8"))
-                f.flush()
-                f.seek(0, 0)
-                self.metarelease_information = f
-            except IOError as e:
-                pass
+                self._save_response(uri)
+                self.metarelease_information = open(self.METARELEASE_FILE,
+                                                    "r")
+            except (IOError, OSError, zlib.error) as e:
+                self._debug("can not write '%s': %s" % (
+                    self.METARELEASE_FILE, e))
+            with self._response_lock:
+                self._response = None
             uri.close()
         # http error
         except HTTPError as e:
@@ -335,11 +618,23 @@ class MetaReleaseCore(object):
             if e.code == 304 and os.path.exists(self.METARELEASE_FILE):
                 self._debug("reading file '%s'" % self.METARELEASE_FILE)
                 self.metarelease_information = open(self.METARELEASE_FILE, "r")
+                # the file is up to date as of now
+                try:
+                    os.utime(self.METARELEASE_FILE, None)
+                except OSError as e:
+                    pass
             else:
                 self._debug("result of meta-release download: '%s'" % e)
         # generic network error
-        except (URLError, BadStatusLine, socket.timeout) as e:
+        except (URLError, HTTPException, socket.error) as e:
             self._debug("result of meta-release download: '%s'" % e)
+        # reading a response that cancel() closed can fail in many ways
+        except Exception as e:
+            if not self._cancelled.is_set():
+                raise
+            self._debug("result of meta-release download: '%s'" % e)
+
+    def _parse_metarelease_information(self):
         # now check the information we have
         if self.metarelease_information is not None:
             self._debug("have self.metarelease_information")
@@ -349,25 +644,27 @@ class MetaReleaseCore(object):
                 logging.exception("parse failed for '%s'" %
                                   self.METARELEASE_FILE)
                 # no use keeping a broken file around
-                os.remove(self.METARELEASE_FILE)
+                self._remove_metarelease_file()
             # we don't want to keep a meta-release file around when it
             # has a "Broken" flag, this ensures we are not bitten by
             # I-M-S/cache issues
             if self.new_dist and self.new_dist.upgrade_broken:
-                os.remove(self.METARELEASE_FILE)
+                self._remove_metarelease_file()
         else:
             self._debug("NO self.metarelease_information")
-        self.downloading = False
 
-    def _get_release_notes_uri_query_string(self, dist):
+    def _get_release_notes_uri_query_string(self, dist, lang=None,
+                                            flavor=None):
         q = "?"
         # get the lang
-        lang = get_lang()
+        if lang is None:
+            lang = get_lang()
         if lang:
             q += "lang=%s&" % lang
         # get the os
-        os = get_ubuntu_flavor()
-        q += "os=%s&" % os
+        if flavor is None:
+            flavor = get_ubuntu_flavor()
+        q += "os=%s&" % flavor
         # get the version to upgrade to
         q += "ver=%s" % dist.version
         return q
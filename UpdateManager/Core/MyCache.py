@@ -26,29 +26,104 @@ import warnings
 warnings.filterwarnings("ignore", "apt API not stable yet", FutureWarning)
 import apt
 import apt_pkg
+import functools
+import itertools
 import logging
 import os
+import threading
+import zlib
+from io import BytesIO
+try:
+    from queue import PriorityQueue, Empty
+except ImportError:
+    from Queue import PriorityQueue, Empty
 try:
     from urllib.error import HTTPError
-    from urllib.request import urlopen
+    from urllib.request import Request
     from urllib.parse import urlsplit
 except ImportError:
-    from urllib2 import HTTPError, urlopen
+    from urllib2 import HTTPError, Request
     from urlparse import urlsplit
 try:
-    from http.client import BadStatusLine
+    from http.client import HTTPException
 except ImportError:
-    from httplib import BadStatusLine
+    from httplib import HTTPException
 import socket
 import re
 import DistUpgrade.DistUpgradeCache
 from gettext import gettext as _
 
+from .ChangelogCache import ChangelogCache, ChangelogCacheEntry
+from .HttpClient import get_http_client
+from .utils import trace_span
+
 SYNAPTIC_PINFILE = "/var/lib/synaptic/preferences"
 CHANGELOGS_POOL = "http://changelogs.ubuntu.com/changelogs/pool/"
 CHANGELOGS_URI = CHANGELOGS_POOL + "%s/%s/%s/%s_%s/%s"
 
 
+# the header of a changelog entry, e.g. "apt (0.8.16) oneiric; urgency=low"
+CHANGELOG_HEADER = re.compile(r"^\S+ \((.*)\)(.*)$")
+
+
+class ChangelogReader(object):
+    """
+    Line reader for a (maybe gzip encoded) changelog download that
+    keeps a copy of the decoded data that was read so far. The
+    data of a previous partial download can be passed as prefix.
+    """
+
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, fileobj, gzipped=False, prefix=b"", cancelled=None):
+        self._fileobj = fileobj
+        # a threading.Event that stops the reading when set
+        self._cancelled = cancelled
+        self._decompressor = None
+        if gzipped:
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._chunks = [prefix]
+        self._buf = prefix
+        self._pos = 0
+        self.eof = False
+
+    def _fill(self):
+        while True:
+            if self._cancelled is not None and self._cancelled.is_set():
+                raise ChangelogCancelledError()
+            raw = self._fileobj.read(self.CHUNK_SIZE)
+            if self._decompressor is None:
+                data = raw
+            elif raw:
+                data = self._decompressor.decompress(raw)
+            else:
+                data = self._decompressor.flush()
+            if not raw:
+                self.eof = True
+            # the gzip header alone does not give any data
+            if data or self.eof:
+                break
+        if data:
+            self._chunks.append(data)
+            self._buf = self._buf[self._pos:] + data
+            self._pos = 0
+
+    def readline(self):
+        while True:
+            end = self._buf.find(b"\n", self._pos)
+            if end >= 0 or self.eof:
+                break
+            self._fill()
+        if end < 0:
+            end = len(self._buf) - 1
+        line = self._buf[self._pos:end + 1]
+        self._pos = end + 1
+        return line
+
+    def get_data(self):
+        return b"".join(self._chunks)
+
+
 class HttpsChangelogsUnsupportedError(Exception):
     """ https changelogs with credentials are unsupported because of the
         lack of certitifcation validation in urllib2 which allows MITM
@@ -57,10 +132,214 @@ class HttpsChangelogsUnsupportedError(Exception):
     pass
 
 
+class ChangelogCancelledError(Exception):
+    """ the changelog download was cancelled with ChangelogRequest.cancel()
+    """
+    pass
+
+
+class ChangelogRequest(object):
+    """
+    A running MyCache.fetch_news_and_changelog() call. The callback is
+    called with the request (in the thread that did the download) once
+    the NEWS.Debian and changelog are in MyCache.all_news/all_changes,
+    unless the request was cancelled before.
+    """
+
+    def __init__(self, name, callback):
+        self.name = name
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._response = None
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+
+    def cancel(self):
+        """ drop the result and stop the download, a running read stops
+            at the next chunk
+        """
+        self.cancelled.set()
+        with self._lock:
+            response = self._response
+        if response is not None:
+            try:
+                response.close()
+            except Exception:
+                pass
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise ChangelogCancelledError()
+
+    def set_response(self, response):
+        " register the open http response of the download "
+        with self._lock:
+            self._response = response
+        if self.cancelled.is_set():
+            response.close()
+            raise ChangelogCancelledError()
+
+    def finish(self):
+        with self._lock:
+            self._response = None
+        self.done.set()
+        if not self.cancelled.is_set() and self._callback is not None:
+            self._callback(self)
+
+
+class ChangelogSource(object):
+    """
+    The fields of a package that the changelog downloads need. They are
+    read by the thread that owns the cache, the download threads only
+    get these plain values: the package records are shared state of the
+    cache, reading them from several threads mixes up the packages.
+    """
+
+    def __init__(self, name, srcpkg, srcver, section, installed, version,
+                 origins, deb_uri, source_field):
+        self.name = name
+        self.srcpkg = srcpkg
+        self.srcver = srcver
+        self.section = section
+        self.installed = installed
+        self.version = version
+        self.origins = origins
+        self.deb_uri = deb_uri
+        # the raw "Source" field, e.g. "gcc-defaults (1.93)", or None
+        self.source_field = source_field
+
+    @classmethod
+    def from_package(cls, pkg):
+        candidate = pkg.candidate
+        section = pkg._pcache._depcache.get_candidate_ver(pkg._pkg).section
+        source_field = candidate.record.get("Source")
+        # the source version differs from the binary one e.g. for binNMUs
+        # or gcc-defaults, it is only in the record then
+        srcver = candidate.version
+        if source_field and "(" in source_field:
+            srcver = source_field.split("(")[1].rstrip(")").strip()
+        return cls(pkg.name, candidate.source_name, srcver,
+                   section, getattr(pkg.installed, "version", None),
+                   candidate.version, [o.origin for o in candidate.origins],
+                   candidate.uri, source_field)
+
+
+class ChangelogPrefetcher(object):
+    """
+    Bounded pool of worker threads that fetch the NEWS.Debian and
+    changelog files for the given package names in the background.
+    Names can be moved to the front of the queue with boost() (e.g.
+    for the row under the cursor) and the whole prefetch can be
+    stopped with cancel().
+    """
+
+    (PRIORITY_HIGH, PRIORITY_NORMAL) = range(2)
+
+    def __init__(self, cache, names, workers):
+        self._cache = cache
+        self._queue = PriorityQueue()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        # names that are queued or currently downloading
+        self._pending = set()
+        self._done = set()
+        # callbacks of callers waiting for a specific name
+        self._waiters = {}
+        for name in names:
+            self._pending.add(name)
+            self._queue.put((self.PRIORITY_NORMAL, next(self._counter),
+                             name))
+        self._threads = []
+        for i in range(min(workers, len(names))):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def boost(self, name, lock=None, callback=None):
+        """ move the given name to the front of the queue, if a lock is
+            given it is released (and the callback is called) once the
+            name is fetched. Returns False if the name is not handled by
+            the prefetcher
+        """
+        if lock is not None:
+            callback = functools.partial(self._release, lock)
+        with self._lock:
+            if self._cancelled.is_set():
+                return False
+            done = name in self._done
+            if not done:
+                if name not in self._pending:
+                    return False
+                if callback is not None:
+                    self._waiters.setdefault(name, []).append(callback)
+        # the callbacks are never called with the lock held
+        if done:
+            if callback is not None:
+                callback()
+            return True
+        self._queue.put((self.PRIORITY_HIGH, next(self._counter), name))
+        return True
+
+    def is_done(self, name):
+        with self._lock:
+            return name in self._done
+
+    def cancel(self):
+        """ stop fetching, already running downloads are finished but
+            their waiters are released right away
+        """
+        self._cancelled.set()
+        with self._lock:
+            waiters = self._waiters
+            self._waiters = {}
+        for callbacks in waiters.values():
+            for callback in callbacks:
+                callback()
+
+    def _release(self, lock):
+        try:
+            lock.release()
+        except threading.ThreadError:
+            # not locked (anymore)
+            pass
+
+    def _run(self):
+        while not self._cancelled.is_set():
+            try:
+                (priority, counter, name) = self._queue.get_nowait()
+            except Empty:
+                return
+            with self._lock:
+                # boosted names are in the queue more than once
+                if name not in self._pending:
+                    continue
+                self._pending.remove(name)
+            try:
+                self._cache.get_news(name)
+                self._cache.get_changelog(name)
+            except Exception:
+                logging.exception("failed to prefetch changelog for '%s'" %
+                                  name)
+            with self._lock:
+                self._done.add(name)
+                waiters = self._waiters.pop(name, [])
+            for callback in waiters:
+                callback()
+
+
 class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
 
     CHANGELOG_ORIGIN = "Ubuntu"
 
+    # the configuration key for the number of concurrent changelog
+    # downloads when prefetching (0 disables the prefetching)
+    CHANGELOG_PREFETCH_WORKERS = "Update-Manager::Changelog-Prefetch-Workers"
+
+    # the HTTP codes of the files that a source version does not have
+    MISSING_CODES = (404, 410)
+
     def __init__(self, progress, rootdir=None):
         apt.Cache.__init__(self, progress, rootdir)
         # raise if we have packages in reqreinst state
@@ -74,6 +353,26 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
         self._initDepCache()
         self.all_changes = {}
         self.all_news = {}
+        # the NEWS.Debian and changelog texts by (srcpkg, version,
+        # installed version, fname), shared by the binaries of a source
+        self._source_files = {}
+        # the keys of _source_files that are not on the server (like
+        # most NEWS.Debian files) with the HTTPError of the download
+        self._source_files_missing = {}
+        # the running downloads of _source_files, key -> [event, error]
+        self._source_files_pending = {}
+        self._source_files_lock = threading.Lock()
+        # name -> ChangelogSource, read before the downloads start
+        self._changelog_sources_lock = threading.Lock()
+        # persistent cache for the downloaded changelogs
+        self.changelog_cache = ChangelogCache()
+        self.changelog_prefetcher = None
+        # the ChangelogRequest of the download in the current thread
+        self._changelog_local = threading.local()
+        # incremented on every change of the marks, so that views of
+        # the selection know when they need to look at them again
+        self.marks_serial = 0
+        self.connect("cache_post_change", self._on_marks_changed)
         # on broken packages, try to fix via saveDistUpgrade()
         if self._depcache.broken_count > 0:
             self.saveDistUpgrade()
@@ -96,21 +395,89 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
         #apt_pkg.config.set("Debug::pkgPolicy","1")
         #self.depcache = apt_pkg.GetDepCache(self.cache)
         #self._depcache = apt_pkg.GetDepCache(self._cache)
-        self._depcache.read_pinfile()
-        if os.path.exists(SYNAPTIC_PINFILE):
-            self._depcache.read_pinfile(SYNAPTIC_PINFILE)
-        self._depcache.init()
+        with trace_span("read pinfile"):
+            self._depcache.read_pinfile()
+            if os.path.exists(SYNAPTIC_PINFILE):
+                self._depcache.read_pinfile(SYNAPTIC_PINFILE)
+        with trace_span("depcache init"):
+            self._depcache.init()
+
+    def open(self, progress=None):
+        # the archives are checked again for the new cache
+        self._downloaded_archives = None
+        self._changelog_sources = {}
+        with trace_span("cache open"):
+            super(MyCache, self).open(progress)
+
+    def _on_marks_changed(self):
+        self.marks_serial += 1
 
     def clear(self):
+        self.cache_pre_change()
         self._initDepCache()
+        self.cache_post_change()
 
     @property
     def required_download(self):
         """ get the size of the packages that are required to download """
-        pm = apt_pkg.PackageManager(self._depcache)
-        fetcher = apt_pkg.Acquire()
-        pm.get_archives(fetcher, self._list, self._records)
-        return fetcher.fetch_needed
+        with trace_span("required_download"):
+            pm = apt_pkg.PackageManager(self._depcache)
+            fetcher = apt_pkg.Acquire()
+            pm.get_archives(fetcher, self._list, self._records)
+            return fetcher.fetch_needed
+
+    def _get_downloaded_archives(self):
+        """ return a list of (name, version, arch, size) of the .deb files
+            in the archives dir, the dir is only read once per cache open
+        """
+        if self._downloaded_archives is not None:
+            return self._downloaded_archives
+        archives = []
+        archives_dir = apt_pkg.config.find_dir("Dir::Cache::archives")
+        try:
+            names = os.listdir(archives_dir)
+        except OSError:
+            names = []
+        for name in names:
+            if not name.endswith(".deb") or name.count("_") != 2:
+                continue
+            (pkgname, version, arch) = name[:-len(".deb")].split("_")
+            try:
+                size = os.path.getsize(os.path.join(archives_dir, name))
+            except OSError:
+                continue
+            # the ":" of the epoch is quoted in the file name
+            archives.append((pkgname, version.replace("%3a", ":"), arch,
+                             size))
+        self._downloaded_archives = archives
+        return archives
+
+    def get_download_size(self):
+        """ get the size of the packages that are required to download,
+            this is a fast estimate of required_download: the size of
+            all packages to install (which the depcache keeps up to date
+            on every change) minus the size of those already in the
+            archives dir
+        """
+        depcache = self._depcache
+        size = depcache.deb_size
+        for (name, version, arch, file_size) in (
+                self._get_downloaded_archives()):
+            try:
+                if arch == "all":
+                    rawpkg = self._cache[name]
+                else:
+                    rawpkg = self._cache[name, arch]
+            except KeyError:
+                continue
+            if not (depcache.marked_install(rawpkg) or
+                    depcache.marked_upgrade(rawpkg)):
+                continue
+            candidate = depcache.get_candidate_ver(rawpkg)
+            if (candidate is not None and candidate.ver_str == version and
+                    candidate.size == file_size):
+                size -= file_size
+        return size
 
     @property
     def install_count(self):
@@ -121,16 +488,49 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
 
     def saveDistUpgrade(self):
         """ this functions mimics a upgrade but will never remove anything """
-        #self._apply_dselect_upgrade()
-        self._depcache.upgrade(True)
-        wouldDelete = self._depcache.del_count
-        if self._depcache.del_count > 0:
-            self.clear()
-        assert (self._depcache.broken_count == 0 and
-                self._depcache.del_count == 0)
-        #self._apply_dselect_upgrade()
-        self._depcache.upgrade()
-        return wouldDelete
+        with trace_span("saveDistUpgrade"):
+            self.cache_pre_change()
+            #self._apply_dselect_upgrade()
+            self._depcache.upgrade(True)
+            wouldDelete = self._depcache.del_count
+            if self._depcache.del_count > 0:
+                self._initDepCache()
+            assert (self._depcache.broken_count == 0 and
+                    self._depcache.del_count == 0)
+            #self._apply_dselect_upgrade()
+            self._depcache.upgrade()
+            self.cache_post_change()
+            return wouldDelete
+
+    def get_upgradable_packages(self):
+        """ return a tuple (pkgs, held_back), pkgs are the packages that
+            are upgradable or marked for install (sorted by name) and
+            held_back are the names of the upgradable packages that are
+            not marked for install/upgrade
+
+            This works on the low level apt_pkg objects so that the
+            apt.Package wrappers are only created for the interesting
+            packages instead of for the whole cache.
+        """
+        depcache = self._depcache
+        pkgs = []
+        held_back = []
+        for rawpkg in self._cache.packages:
+            marked_install = depcache.marked_install(rawpkg)
+            # not installed and not going to be, the common case
+            if rawpkg.current_ver is None and not marked_install:
+                continue
+            is_upgradable = (rawpkg.current_ver is not None and
+                             depcache.is_upgradable(rawpkg))
+            if not (is_upgradable or marked_install):
+                continue
+            pkg = self._rawpkg_to_pkg(rawpkg)
+            pkgs.append(pkg)
+            if is_upgradable and not (marked_install or
+                                      depcache.marked_upgrade(rawpkg)):
+                held_back.append(pkg.name)
+        pkgs.sort(key=lambda pkg: pkg.name)
+        return (pkgs, held_back)
 
     def _strip_epoch(self, verstr):
         " strip of the epoch "
@@ -139,22 +539,139 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
             verstr = "".join(l[1:])
         return verstr
 
+    def _parse_changelog(self, changelog, srcpkg, installed,
+                         strict_versioning=False):
+        """ read the new entries from the given changelog file object
+
+            Returns a (text, stopped) tuple, stopped is True if the
+            installed version was found and the rest of the file was
+            not read.
+        """
+        # strip epoch from installed version
+        if installed and ":" in installed:
+            installed = installed.split(":", 1)[1]
+        header_start = srcpkg + " ("
+        lines = []
+        while True:
+            line = changelog.readline().decode("UTF-8", "replace")
+            if line == "":
+                return ("".join(lines), False)
+            # cheap test first, only the headers start with the srcpkg
+            match = None
+            if installed and line.startswith(header_start):
+                match = CHANGELOG_HEADER.match(line)
+            if match:
+                # strip epoch from changelog too
+                changelogver = match.group(1)
+                if changelogver and ":" in changelogver:
+                    changelogver = changelogver.split(":", 1)[1]
+                # we test for "==" here for changelogs
+                # to ensure that the version
+                # is actually really in the changelog - if not
+                # just display it all, this catches cases like:
+                # gcc-defaults with "binver=4.3.1" and srcver=1.76
+                #
+                # for NEWS.Debian we do require the changelogver > installed
+                if strict_versioning:
+                    if apt_pkg.version_compare(changelogver, installed) < 0:
+                        return ("".join(lines), True)
+                else:
+                    if apt_pkg.version_compare(changelogver, installed) == 0:
+                        return ("".join(lines), True)
+            lines.append(line)
+
+    def _read_changelog(self, uri, parse, cache_key=None):
+        """ fetch the changelog uri and return the result of
+            parse(fileobj), the persistent changelog cache is used
+            if a cache_key (srcpkg, srcver, fname) is given
+
+            The download stops as soon as parse() has all it needs,
+            only the part of the file that was read is cached.
+        """
+        cache = self.changelog_cache if cache_key else None
+        entry = None
+        prefix = b""
+        if cache is not None:
+            entry = cache.lookup(*cache_key)
+        if entry is not None:
+            (text, stopped) = parse(BytesIO(entry.data))
+            if stopped or entry.complete:
+                if cache.is_fresh(entry):
+                    return text
+            else:
+                # we need more than the part that we have, continue
+                # the download where it stopped last time
+                prefix = entry.data
+        req = Request(uri)
+        if prefix:
+            req.add_header("Range", "bytes=%s-" % len(prefix))
+            req.add_header("Accept-Encoding", "identity")
+            if entry.etag:
+                req.add_header("If-Range", entry.etag)
+            elif entry.last_modified:
+                req.add_header("If-Range", entry.last_modified)
+        else:
+            req.add_header("Accept-Encoding", "gzip")
+            if entry is not None:
+                # conditional request, the server will reply with 304
+                # if the cached copy is still valid
+                if entry.etag:
+                    req.add_header("If-None-Match", entry.etag)
+                if entry.last_modified:
+                    req.add_header("If-Modified-Since", entry.last_modified)
+        request = getattr(self._changelog_local, "request", None)
+        cancelled = None
+        if request is not None:
+            request.check()
+            cancelled = request.cancelled
+        try:
+            changelog = get_http_client().open(req)
+        except HTTPError as e:
+            if e.code == 304 and entry is not None and not prefix:
+                cache.revalidated(*(cache_key + (entry,)))
+                return text
+            raise
+        try:
+            if request is not None:
+                request.set_response(changelog)
+            headers = changelog.info()
+            if getattr(changelog, "code", None) != 206:
+                prefix = b""
+            reader = ChangelogReader(
+                changelog, headers.get("Content-Encoding") == "gzip", prefix,
+                cancelled)
+            (text, stopped) = parse(reader)
+        except Exception:
+            # reading from a response closed by cancel() fails in
+            # different ways
+            if cancelled is not None and cancelled.is_set():
+                raise ChangelogCancelledError()
+            raise
+        finally:
+            # close the connection instead of reading the rest
+            changelog.close()
+        if cache is not None:
+            cache.store(*(cache_key + (ChangelogCacheEntry(
+                reader.get_data(), headers.get("ETag"),
+                headers.get("Last-Modified"), complete=reader.eof),)))
+        return text
+
     def _get_changelog_or_news(self, name, fname, strict_versioning=False,
                                changelogs_uri=None):
         " helper that fetches the file in question "
         # don't touch the gui in this function, it needs to be thread-safe
-        pkg = self[name]
+        source = self._get_changelog_source(name)
 
         # get the src package name
-        srcpkg = pkg.candidate.source_name
+        srcpkg = source.srcpkg
 
         # assume "main" section
         src_section = "main"
         # use the section of the candidate as a starting point
-        section = pkg._pcache._depcache.get_candidate_ver(pkg._pkg).section
+        section = source.section
 
-        # get the source version, start with the binaries version
-        srcver_epoch = pkg.candidate.version
+        # get the source version
+        srcver_epoch = source.srcver
         srcver = self._strip_epoch(srcver_epoch)
         #print("bin: %s" % binver)
 
@@ -172,9 +689,11 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
         # path differently
         if changelogs_uri:
             uri = changelogs_uri
+            cache_key = None
         else:
             uri = CHANGELOGS_URI % (src_section, prefix, srcpkg, srcpkg,
                                     srcver, fname)
+            cache_key = (srcpkg, srcver, fname)
 
         # https uris are not supported when they contain a username/password
         # because the urllib2 https implementation will not check certificates
@@ -186,63 +705,27 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
                 "https locations with username/password are not"
                 "supported to fetch changelogs")
 
-        # print("Trying: %s " % uri)
-        changelog = urlopen(uri)
-        #print(changelog.read())
         # do only get the lines that are new
-        alllines = ""
-        regexp = "^%s \((.*)\)(.*)$" % (re.escape(srcpkg))
+        installed = source.installed
 
-        while True:
-            line = changelog.readline().decode("UTF-8", "replace")
-            if line == "":
-                break
-            match = re.match(regexp, line)
-            if match:
-                # strip epoch from installed version
-                # and from changelog too
-                installed = getattr(pkg.installed, "version", None)
-                if installed and ":" in installed:
-                    installed = installed.split(":", 1)[1]
-                changelogver = match.group(1)
-                if changelogver and ":" in changelogver:
-                    changelogver = changelogver.split(":", 1)[1]
-                # we test for "==" here for changelogs
-                # to ensure that the version
-                # is actually really in the changelog - if not
-                # just display it all, this catches cases like:
-                # gcc-defaults with "binver=4.3.1" and srcver=1.76
-                #
-                # for NEWS.Debian we do require the changelogver > installed
-                if strict_versioning:
-                    if (installed and
-                            apt_pkg.version_compare(changelogver,
-                                                    installed) < 0):
-                        break
-                else:
-                    if (installed and
-                            apt_pkg.version_compare(changelogver,
-                                                    installed) == 0):
-                        break
-            alllines = alllines + line
-        return alllines
+        def parse(changelog):
+            return self._parse_changelog(changelog, srcpkg, installed,
+                                         strict_versioning)
+        with trace_span("fetch %s %s" % (fname, name)):
+            return self._read_changelog(uri, parse, cache_key)
 
     def _guess_third_party_changelogs_uri_by_source(self, name):
-        pkg = self[name]
-        deb_uri = pkg.candidate.uri
+        source = self._get_changelog_source(name)
+        deb_uri = source.deb_uri
         if deb_uri is None:
             return None
-        srcrec = pkg.candidate.record.get("Source")
+        srcrec = source.source_field
         if not srcrec:
             return None
         # srcpkg can be "apt" or "gcc-default (1.0)"
         srcpkg = srcrec.split("(")[0].strip()
-        if "(" in srcrec:
-            srcver = srcrec.split("(")[1].rstrip(")")
-        else:
-            srcver = pkg.candidate.version
         base_uri = deb_uri.rpartition("/")[0]
-        return base_uri + "/%s_%s.changelog" % (srcpkg, srcver)
+        return base_uri + "/%s_%s.changelog" % (srcpkg, source.srcver)
 
     def _guess_third_party_changelogs_uri_by_binary(self, name):
         """ guess changelogs uri based on ArchiveURI by replacing .deb
@@ -250,73 +733,209 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
         """
         # there is always a pkg and a pkg.candidate, no need to add
         # check here
-        pkg = self[name]
-        deb_uri = pkg.candidate.uri
+        deb_uri = self._get_changelog_source(name).deb_uri
         if deb_uri:
             return "%s.changelog" % deb_uri.rsplit(".", 1)[0]
         return None
 
+    def _get_changelog_source(self, name):
+        """ return the ChangelogSource of name, the first call for a
+            name has to be made by the thread that owns the cache
+        """
+        with self._changelog_sources_lock:
+            source = self._changelog_sources.get(name)
+        if source is None:
+            source = ChangelogSource.from_package(self[name])
+            with self._changelog_sources_lock:
+                self._changelog_sources[name] = source
+        return source
+
+    def _get_source_key(self, name):
+        """ the key of the changes of name, they are the same for all
+            binaries of a source version
+        """
+        source = self._get_changelog_source(name)
+        return (source.srcpkg, source.srcver, source.installed)
+
+    def _get_source_file(self, name, fname, strict_versioning=False):
+        """ like _get_changelog_or_news(), but the text is downloaded
+            only once for all binaries of a source version, also when
+            they are asked for at the same time
+        """
+        key = self._get_source_key(name) + (fname,)
+        while True:
+            with self._source_files_lock:
+                if key in self._source_files:
+                    return self._source_files[key]
+                if key in self._source_files_missing:
+                    raise self._source_files_missing[key]
+                pending = self._source_files_pending.get(key)
+                if pending is None:
+                    pending = [threading.Event(), None]
+                    self._source_files_pending[key] = pending
+                    break
+            # wait for the download of another binary of the source
+            pending[0].wait()
+            error = pending[1]
+            # a cancelled download was only cancelled for its caller
+            if error is not None and not isinstance(
+                    error, ChangelogCancelledError):
+                raise error
+        try:
+            text = self._get_changelog_or_news(name, fname,
+                                               strict_versioning)
+        except Exception as e:
+            pending[1] = e
+            if isinstance(e, HTTPError) and e.code in self.MISSING_CODES:
+                # asking again for the other binaries does not help
+                with self._source_files_lock:
+                    self._source_files_missing[key] = e
+            raise
+        else:
+            with self._source_files_lock:
+                self._source_files[key] = text
+        finally:
+            with self._source_files_lock:
+                del self._source_files_pending[key]
+            pending[0].set()
+        return text
+
+    def prefetch_changelogs(self, names, workers=None):
+        """ start fetching the changelogs of the given package names
+            in the background (replacing any running prefetch), only
+            one binary of each source version is fetched
+
+            The packages are looked up here, the worker threads only
+            download.
+        """
+        self.cancel_prefetch()
+        if workers is None:
+            workers = apt_pkg.config.find_i(self.CHANGELOG_PREFETCH_WORKERS,
+                                            4)
+        sources = set()
+        unique_names = []
+        for name in names:
+            if name in self.all_changes:
+                continue
+            key = self._get_source_key(name)
+            if key not in sources:
+                sources.add(key)
+                unique_names.append(name)
+        names = unique_names
+        if workers <= 0 or not names:
+            return
+        self.changelog_prefetcher = ChangelogPrefetcher(self, names, workers)
+
+    def cancel_prefetch(self):
+        if self.changelog_prefetcher is not None:
+            self.changelog_prefetcher.cancel()
+            self.changelog_prefetcher = None
+
     def get_news_and_changelog(self, name, lock):
+        # if the changelog is prefetched already (or being prefetched)
+        # just wait for that instead of downloading it a second time
+        if (self.changelog_prefetcher is not None and
+                self.changelog_prefetcher.boost(name, lock)):
+            return
         self.get_news(name)
         self.get_changelog(name)
         try:
             lock.release()
-        except:
+        except threading.ThreadError:
+            pass
+
+    def fetch_news_and_changelog(self, name, callback):
+        """ fetch the NEWS.Debian and changelog of name in the background
+            and call callback(request) when they are available, returns
+            the ChangelogRequest that can be used to cancel the fetch
+
+            The callback is called from the download thread, a GUI needs
+            to pass the result on to its main loop.
+        """
+        request = ChangelogRequest(name, callback)
+        # look the package up here, not in the download thread
+        self._get_changelog_source(name)
+        # if the changelog is prefetched already (or being prefetched)
+        # just wait for that instead of downloading it a second time
+        if (self.changelog_prefetcher is not None and
+                self.changelog_prefetcher.boost(
+                    name, callback=request.finish)):
+            return request
+        thread = threading.Thread(target=self._fetch_news_and_changelog,
+                                  args=(request,))
+        thread.daemon = True
+        thread.start()
+        return request
+
+    def _fetch_news_and_changelog(self, request):
+        self._changelog_local.request = request
+        try:
+            self.get_news(request.name)
+            self.get_changelog(request.name)
+        except ChangelogCancelledError:
             pass
+        except Exception:
+            logging.exception("error on changelog fetching")
+        finally:
+            self._changelog_local.request = None
+            # the waiters must not hang whatever happened
+            request.finish()
 
     def get_news(self, name):
         " get the NEWS.Debian file from the changelogs location "
         try:
-            news = self._get_changelog_or_news(name, "NEWS.Debian", True)
+            news = self._get_source_file(name, "NEWS.Debian", True)
         except Exception:
             return
         if news:
             self.all_news[name] = news
 
     def _fetch_changelog_for_third_party_package(self, name):
-        # Try non official changelog location
+        """ return the changes of name from the non official changelog
+            locations (or the error message)
+        """
         changelogs_uri_binary = \
             self._guess_third_party_changelogs_uri_by_binary(name)
         changelogs_uri_source = \
             self._guess_third_party_changelogs_uri_by_source(name)
+        changes = ""
         error_message = ""
         for changelogs_uri in [changelogs_uri_binary, changelogs_uri_source]:
             if changelogs_uri:
                 try:
-                    changelog = self._get_changelog_or_news(
+                    changes += self._get_changelog_or_news(
                         name, "changelog", False, changelogs_uri)
-                    self.all_changes[name] += changelog
-                except (HTTPError, HttpsChangelogsUnsupportedError):
-                    # no changelogs_uri or 404
+                except (HTTPError, HttpsChangelogsUnsupportedError,
+                        zlib.error):
+                    # no changelogs_uri, 404 or a broken file
                     error_message = _(
                         "This update does not come from a "
                         "source that supports changelogs.")
-                except (IOError, BadStatusLine, socket.error):
+                except (IOError, HTTPException, socket.error):
                     # network errors and others
                     logging.exception("error on changelog fetching")
                     error_message = _(
                         "Failed to download the list of changes. \n"
                         "Please check your Internet connection.")
-        self.all_changes[name] += error_message
+        return changes + error_message
 
     def get_changelog(self, name):
         " get the changelog file from the changelog location "
-        origins = self[name].candidate.origins
-        self.all_changes[name] = _("Changes for %s versions:\n"
-                                   "Installed version: %s\n"
-                                   "Available version: %s\n\n") % (
-                                       name,
-                                       getattr(self[name].installed, "version",
-                                               None),
-                                       self[name].candidate.version)
-        if not self.CHANGELOG_ORIGIN in [o.origin for o in origins]:
-            self._fetch_changelog_for_third_party_package(name)
+        source = self._get_changelog_source(name)
+        header = _("Changes for %s versions:\n"
+                   "Installed version: %s\n"
+                   "Available version: %s\n\n") % (
+                       name, source.installed, source.version)
+        if not self.CHANGELOG_ORIGIN in source.origins:
+            changelog = self._fetch_changelog_for_third_party_package(name)
+            # only set it once it is complete, see below
+            self.all_changes[name] = header + changelog
             return
         # fixup epoch handling version
-        srcpkg = self[name].candidate.source_name
-        srcver_epoch = self[name].candidate.version.replace(':', '%3A')
+        srcpkg = source.srcpkg
+        srcver_epoch = source.version.replace(':', '%3A')
         try:
-            changelog = self._get_changelog_or_news(name, "changelog")
+            changelog = self._get_source_file(name, "changelog")
             if len(changelog) == 0:
                 changelog = _("The changelog does not contain any relevant "
                               "changes.\n\n"
@@ -324,16 +943,19 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
                               "%s/%s/+changelog\n"
                               "until the changes become available or try "
                               "again later.") % (srcpkg, srcver_epoch)
-        except HTTPError as e:
+        except (HTTPError, zlib.error) as e:
+            # missing or broken on the server
             changelog = _("The list of changes is not available yet.\n\n"
                           "Please use http://launchpad.net/ubuntu/+source/"
                           "%s/%s/+changelog\n"
                           "until the changes become available or try again "
                           "later.") % (srcpkg, srcver_epoch)
-        except (IOError, BadStatusLine, socket.error) as e:
+        except (IOError, HTTPException, socket.error) as e:
             print("caught exception: ", e)
             changelog = _("Failed to download the list "
                           "of changes. \nPlease "
                           "check your Internet "
                           "connection.")
-        self.all_changes[name] += changelog
+        # only set it once it is complete, the changelogs may get
+        # fetched in a different thread than the one displaying them
+        self.all_changes[name] = header + changelog
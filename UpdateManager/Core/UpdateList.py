@@ -37,24 +37,253 @@ import platform
 import subprocess
 import os
 import random
-import glob
-
-from gi.repository import Gio
+import json
+import hashlib
 
 from UpdateManager.Core import utils
 
 
+def _get_gio():
+    # imported on first use, so that the headless users of this module
+    # (see UpdateManager.Core.report) do not need to load Gio
+    from gi.repository import Gio
+    return Gio
+
+
+class DesktopEntry(object):
+    """
+    Minimal .desktop file reader with the parts of the Gio.DesktopAppInfo
+    API that are needed for grouping the updates, used by headless
+    update lists that do not load Gio.
+    """
+
+    GROUP = "Desktop Entry"
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.desktop_env = ""
+        self._entries = {}
+        group = None
+        with open(filename, "rb") as f:
+            for line in f:
+                line = line.decode("UTF-8", "replace").strip()
+                if not line or line.startswith("#"):
+                    continue
+                if line.startswith("["):
+                    group = line.strip("[]")
+                elif group == self.GROUP and "=" in line:
+                    (key, value) = line.split("=", 1)
+                    self._entries.setdefault(key.strip(), value.strip())
+        # like Gio.DesktopAppInfo, refuse to load hidden entries
+        if self._entries.get("Hidden") == "true":
+            raise ValueError("'%s' is hidden" % filename)
+
+    def _get_list(self, key):
+        return [v for v in self._entries.get(key, "").split(";") if v]
+
+    def set_desktop_env(self, desktop_env):
+        self.desktop_env = desktop_env
+
+    def get_filename(self):
+        return self.filename
+
+    def get_display_name(self):
+        return self._entries.get("Name", "")
+
+    def get_icon(self):
+        # a themed icon name (or a path), resolved by UpdateItem.icon
+        return self._entries.get("Icon") or None
+
+    def should_show(self):
+        if self._entries.get("NoDisplay") == "true":
+            return False
+        desktops = [d for d in self.desktop_env.split(":") if d]
+        only_show_in = self._get_list("OnlyShowIn")
+        if only_show_in:
+            return any(d in only_show_in for d in desktops)
+        not_show_in = self._get_list("NotShowIn")
+        return not any(d in not_show_in for d in desktops)
+
+
+class DesktopFileIndex(object):
+    """
+    Index of the .desktop files that may belong to a package, built
+    in bulk from the dpkg file lists (for the files in the application
+    dirs) and the app-install data. The index is persisted and only
+    rebuilt when the mtime of one of the scanned directories changes.
+    """
+
+    VERSION = 1
+
+    def __init__(self, application_dirs, app_install_path,
+                 dpkg_info_dir=None, index_file=None):
+        self.application_dirs = application_dirs
+        self.app_install_path = app_install_path
+        if dpkg_info_dir is None:
+            dpkg_info_dir = os.path.join(os.path.dirname(
+                apt.apt_pkg.config.find_file("Dir::State::status")), "info")
+        self.dpkg_info_dir = dpkg_info_dir
+        # index_file=False disables persisting the index
+        if index_file is None:
+            cache_dir = utils.get_cache_dir()
+            if cache_dir is not None:
+                index_file = os.path.join(cache_dir, "desktop-file-index")
+        self.index_file = index_file
+        self._index = None
+
+    def _get_key(self):
+        mtimes = []
+        for path in [self.dpkg_info_dir, self.app_install_path]:
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return {"version": self.VERSION,
+                "dpkg-info-dir": self.dpkg_info_dir,
+                "app-install-path": self.app_install_path,
+                "application-dirs": self.application_dirs,
+                "mtimes": mtimes}
+
+    def _file_is_application(self, file_path):
+        if not file_path.endswith(".desktop"):
+            return False
+        file_path = os.path.abspath(file_path)
+        for app_dir in self.application_dirs:
+            if file_path.startswith(app_dir):
+                return True
+        return False
+
+    def _build(self):
+        index = {}
+        try:
+            list_files = os.listdir(self.dpkg_info_dir)
+        except OSError:
+            list_files = []
+        for list_file in list_files:
+            if not list_file.endswith(".list"):
+                continue
+            try:
+                with open(os.path.join(self.dpkg_info_dir, list_file),
+                          "rb") as f:
+                    content = f.read()
+            except IOError:
+                continue
+            # most packages do not ship any
+            if b".desktop" not in content:
+                continue
+            # multiarch packages use "name:arch.list"
+            name = list_file[:-len(".list")].split(":")[0]
+            for line in content.decode("UTF-8", "replace").splitlines():
+                if self._file_is_application(line):
+                    index.setdefault(name, []).append(line)
+        try:
+            app_install_files = os.listdir(self.app_install_path)
+        except OSError:
+            app_install_files = []
+        for desktop_file in app_install_files:
+            if ":" not in desktop_file:
+                continue
+            name = desktop_file.split(":", 1)[0]
+            index.setdefault(name, []).append(
+                os.path.join(self.app_install_path, desktop_file))
+        return index
+
+    def _load(self, key):
+        if not self.index_file:
+            return None
+        try:
+            with open(self.index_file) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if data.get("key") != key:
+            return None
+        return data.get("index")
+
+    def _save(self, key, index):
+        if not self.index_file:
+            return
+        data = json.dumps({"key": key, "index": index})
+        try:
+            utils.write_file_atomic(self.index_file, data.encode("UTF-8"))
+        except (IOError, OSError) as e:
+            logging.warning("failed to write '%s': %s" % (
+                self.index_file, e))
+
+    def get(self, name):
+        """ return the candidate .desktop files for the package name """
+        if self._index is None:
+            key = self._get_key()
+            self._index = self._load(key)
+            if self._index is None:
+                self._index = self._build()
+                self._save(key, self._index)
+        return self._index.get(name.split(":")[0], [])
+
+
+class PackageAttributes(object):
+    """
+    The attributes of the candidate of an update that the views show,
+    read once per update list so that drawing the rows does not parse
+    the package records again.
+    """
+
+    def __init__(self, requires_restart, source_name, size):
+        self.requires_restart = requires_restart
+        self.source_name = source_name
+        self.size = size
+
+    @classmethod
+    def from_package(cls, pkg):
+        candidate = pkg.candidate
+        restart = candidate.record.get("XB-Restart-Required") == "system"
+        return cls(restart, candidate.source_name, candidate.size)
+
+    def to_dict(self):
+        return {"requires-restart": self.requires_restart,
+                "source-name": self.source_name,
+                "size": self.size}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["requires-restart"], data["source-name"],
+                   data["size"])
+
+
 class UpdateItem():
     def __init__(self, pkg, name, icon):
-        self.icon = icon
+        # either a Gio.Icon or the name of a themed icon, the Gio.Icon
+        # for the latter is only created when it is needed
+        self._icon = icon
         self.name = name
         self.pkg = pkg
+        self._attributes = None
+
+    @property
+    def attributes(self):
+        " the PackageAttributes of the candidate of pkg "
+        if self._attributes is None:
+            self._attributes = PackageAttributes.from_package(self.pkg)
+        return self._attributes
+
+    @property
+    def icon(self):
+        if self._icon is None or isinstance(self._icon, str):
+            Gio = _get_gio()
+            if self._icon and os.path.isabs(self._icon):
+                self._icon = Gio.FileIcon.new(
+                    Gio.File.new_for_path(self._icon))
+            else:
+                self._icon = Gio.ThemedIcon.new(self._icon or "package")
+        return self._icon
 
 
 class UpdateGroup(UpdateItem):
     def __init__(self, pkg, name, icon):
         UpdateItem.__init__(self, pkg, name, icon)
         self._items = set()
+        self._sorted_items = None
+        self._total_size = None
         self.core_item = None
         if pkg is not None:
             self.core_item = UpdateItem(pkg, name, icon)
@@ -62,83 +291,178 @@ class UpdateGroup(UpdateItem):
 
     @property
     def items(self):
-        all_items = []
-        all_items.extend(self._items)
-        return sorted(all_items, key=lambda a: a.name.lower())
+        # sorted once and reused until the next add(), the list is
+        # shared so callers must not modify it
+        if self._sorted_items is None:
+            self._sorted_items = sorted(self._items,
+                                        key=lambda a: a.name.lower())
+        return self._sorted_items
 
     def add(self, pkg):
         name = utils.get_package_label(pkg)
-        icon = Gio.ThemedIcon.new("package")
-        self._items.add(UpdateItem(pkg, name, icon))
+        self._items.add(UpdateItem(pkg, name, "package"))
+        self._sorted_items = None
+        self._total_size = None
 
     def contains(self, item):
         return item in self._items
 
-    def _is_dependency_helper(self, cache, pkg, dep, seen=set()):
-        if pkg is None or pkg.candidate is None or pkg in seen:
-            return False
-        elif pkg.name == dep.name:
-            return True
-        seen.add(pkg)
-        candidate = pkg.candidate
-        dependencies = candidate.get_dependencies('Depends', 'Recommends')
-        for dependency_pkg in itertools.chain.from_iterable(dependencies):
-            if dependency_pkg.name in cache and \
-               self._is_dependency_helper(cache, cache[dependency_pkg.name],
-                                          dep, seen):
-                return True
-        return False
-
     def is_dependency(self, cache, maybe_dep):
-        # This is a recursive dependency check.  TODO: We do this many times
-        # when grouping packages, and it could be made more efficient.
-        seen = set()
-        for item in self._items:
-            if self._is_dependency_helper(cache, item.pkg, maybe_dep,
-                                          seen=seen):
-                return True
-        return False
+        " test if maybe_dep is (recursively) a dependency of the group "
+        index = DependencyIndex(cache, [maybe_dep.name])
+        return bool(index.get_group_reach(self) & index.bits[maybe_dep.name])
+
+    def count_selected(self):
+        " return the number of packages of the group marked for install "
+        return sum(1 for item in self._items
+                   if item.pkg.marked_install or item.pkg.marked_upgrade)
 
     def packages_are_selected(self):
-        for item in self.items:
+        for item in self._items:
             if item.pkg.marked_install or item.pkg.marked_upgrade:
                 return True
         return False
 
     def selection_is_inconsistent(self):
-        pkgs_installing = [item for item in self.items
-            if item.pkg.marked_install or item.pkg.marked_upgrade]
-        return (len(pkgs_installing) > 0 and
-                len(pkgs_installing) < len(self.items))
+        selected = self.count_selected()
+        return selected > 0 and selected < len(self._items)
 
     def get_total_size(self):
-        size = 0
-        for item in self.items:
-            size += getattr(item.pkg.candidate, "size", 0)
-        return size
+        if self._total_size is None:
+            self._total_size = sum(item.attributes.size
+                                   for item in self._items)
+        return self._total_size
+
+    def requires_restart(self):
+        return any(item.attributes.requires_restart for item in self._items)
+
+
+class DependencyIndex(object):
+    """
+    Reachability index for the Depends/Recommends of the candidate
+    versions in the cache. Every target package gets a bit, get_reach()
+    returns the bitset of the targets that can be reached from a
+    package (including itself). The transitive closure is calculated
+    once for each strongly connected component of the dependency graph,
+    so asking for many packages costs about as much as one walk of the
+    graph.
+    """
+
+    def __init__(self, cache, targets):
+        self._cache = cache
+        self.bits = {}
+        for name in targets:
+            self.bits.setdefault(name, 1 << len(self.bits))
+        self._successors = {}
+        self._closure = {}
+
+    def _get_successors(self, name):
+        if name in self._successors:
+            return self._successors[name]
+        successors = []
+        pkg = self._cache[name] if name in self._cache else None
+        if pkg is not None and pkg.candidate is not None:
+            dependencies = pkg.candidate.get_dependencies('Depends',
+                                                          'Recommends')
+            for dependency_pkg in itertools.chain.from_iterable(dependencies):
+                if dependency_pkg.name in self._cache:
+                    successors.append(dependency_pkg.name)
+        self._successors[name] = successors
+        return successors
+
+    def _has_candidate(self, name):
+        return (name in self._cache and
+                self._cache[name].candidate is not None)
+
+    def _calculate(self, root):
+        # iterative version of Tarjan's strongly connected components
+        # algorithm, components are finished in reverse topological
+        # order so the closure of all successors is known when a
+        # component is finished
+        index = {root: 0}
+        low = {root: 0}
+        stack = [root]
+        on_stack = set([root])
+        work = [(root, iter(self._get_successors(root)))]
+        while work:
+            (name, successors) = work[-1]
+            for succ in successors:
+                if succ in self._closure:
+                    continue
+                if succ not in index:
+                    index[succ] = low[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(self._get_successors(succ))))
+                    break
+                elif succ in on_stack:
+                    low[name] = min(low[name], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[name])
+                if low[name] != index[name]:
+                    continue
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.remove(member)
+                    component.append(member)
+                    if member == name:
+                        break
+                reach = 0
+                for member in component:
+                    if member in self.bits and self._has_candidate(member):
+                        reach |= self.bits[member]
+                    for succ in self._get_successors(member):
+                        reach |= self._closure.get(succ, 0)
+                for member in component:
+                    self._closure[member] = reach
+
+    def get_reach(self, name):
+        " return the bitset of targets that name depends on "
+        if name not in self._closure:
+            if not self._has_candidate(name):
+                return 0
+            self._calculate(name)
+        return self._closure[name]
+
+    def get_group_reach(self, group):
+        reach = 0
+        for item in group._items:
+            if item.pkg is not None:
+                reach |= self.get_reach(item.pkg.name)
+        return reach
 
 
 class UpdateApplicationGroup(UpdateGroup):
+    TYPE = "application"
+
     def __init__(self, pkg, application):
         name = application.get_display_name()
         icon = application.get_icon()
         super(UpdateApplicationGroup, self).__init__(pkg, name, icon)
+        self.application = application
 
 
 class UpdatePackageGroup(UpdateGroup):
+    TYPE = "package"
+
     def __init__(self, pkg):
         name = utils.get_package_label(pkg)
-        icon = Gio.ThemedIcon.new("package")
-        super(UpdatePackageGroup, self).__init__(pkg, name, icon)
+        super(UpdatePackageGroup, self).__init__(pkg, name, "package")
 
 
 class UpdateSystemGroup(UpdateGroup):
+    TYPE = "system"
+
     def __init__(self, cache):
         # Translators: the %s is a distro name, like 'Ubuntu' and 'base' as in
         # the core components and packages.
         name = _("%s base") % utils.get_ubuntu_flavor_name(cache=cache)
-        icon = Gio.ThemedIcon.new("distributor-logo")
-        super(UpdateSystemGroup, self).__init__(None, name, icon)
+        super(UpdateSystemGroup, self).__init__(None, name,
+                                                "distributor-logo")
 
 
 class UpdateOrigin():
@@ -169,14 +493,25 @@ class UpdateList():
     # ... or always off
     NEVER_INCLUDE_PHASED_UPDATES = (
         "Update-Manager::Never-Include-Phased-Updates")
+    # use the (slower) Random() based phasing values of older versions,
+    # so that a machine keeps the decisions it made before
+    LEGACY_PHASED_UPDATES = "Update-Manager::Phased-Updates-Legacy-Random"
+
+    # the file (in the cache dir) with the result of the last update()
+    SNAPSHOT_FILE = "update-list-snapshot"
+    SNAPSHOT_VERSION = 2
 
-    def __init__(self, parent, dist=None):
+    def __init__(self, parent, dist=None, use_snapshot=False,
+                 headless=False):
         self.dist = dist if dist else platform.dist()[2]
         self.distUpgradeWouldDelete = 0
         self.update_groups = []
         self.security_groups = []
         self.num_updates = 0
         self.random = random.Random()
+        self.legacy_phasing = apt.apt_pkg.config.find_b(
+            self.LEGACY_PHASED_UPDATES, False)
+        self.phasing_report = {}
         # a stable machine uniq id
         with open(self.UNIQ_MACHINE_ID_FILE) as f:
             self.machine_uniq_id = f.read()
@@ -193,14 +528,27 @@ class UpdateList():
         else:
             self.current_desktop = ''
 
-    def _file_is_application(self, file_path):
-        file_path = os.path.abspath(file_path)
-        is_application = False
-        for app_dir in self.application_dirs:
-            is_application = is_application or file_path.startswith(app_dir)
-        extension = os.path.splitext(file_path)[1]
-        is_application = is_application and (extension == '.desktop')
-        return is_application
+        # built on first use, after the cache set up the apt config
+        self.desktop_file_index = None
+        # (apt_pkg.Cache, ids of the package files of the security pocket)
+        self._security_files = None
+
+        # the result of update() is persisted and reused for the
+        # packages that did not change since the last run
+        self.use_snapshot = use_snapshot
+        self.snapshot_file = None
+
+        # do not use Gio for the .desktop files
+        self.headless = headless
+
+    def _load_application(self, desktop_file):
+        if self.headless:
+            application = DesktopEntry(desktop_file)
+        else:
+            Gio = _get_gio()
+            application = Gio.DesktopAppInfo.new_from_filename(desktop_file)
+        application.set_desktop_env(self.current_desktop)
+        return application
 
     def _rate_application_for_package(self, application, pkg):
         score = 0
@@ -216,26 +564,17 @@ class UpdateList():
         return score
 
     def _get_application_for_package(self, pkg):
-        desktop_files = []
         rated_applications = []
 
-        for installed_file in pkg.installed_files:
-            if self._file_is_application(installed_file):
-                desktop_files.append(installed_file)
-
-        app_install_pattern = os.path.join(self.APP_INSTALL_PATH,
-                                           '%s:*' % pkg.name)
-        for desktop_file in glob.glob(app_install_pattern):
-            desktop_files.append(desktop_file)
-
-        for desktop_file in desktop_files:
+        if self.desktop_file_index is None:
+            self.desktop_file_index = DesktopFileIndex(
+                self.application_dirs, self.APP_INSTALL_PATH)
+        for desktop_file in self.desktop_file_index.get(pkg.name):
             try:
-                application = Gio.DesktopAppInfo.new_from_filename(
-                    desktop_file)
-                application.set_desktop_env(self.current_desktop)
+                application = self._load_application(desktop_file)
             except Exception as e:
                 print("Error loading .desktop file %s: %s" %
-                      (installed_file, e))
+                      (desktop_file, e))
                 continue
             score = self._rate_application_for_package(application, pkg)
             if score > 0:
@@ -247,63 +586,158 @@ class UpdateList():
         else:
             return None
 
-    def _is_security_update(self, pkg):
-        """ This will test if the pkg is a security update.
+    def _get_security_files(self, cache):
+        """ return the ids of the package files of the security pocket,
+            this is calculated once for every opened cache
+        """
+        if (self._security_files is not None and
+                self._security_files[0] is cache._cache):
+            return self._security_files[1]
+        archive = "%s-security" % self.dist
+        security_files = set()
+        for pkgfile in cache._cache.file_list:
+            if pkgfile.archive == archive and pkgfile.origin == "Ubuntu":
+                indexfile = cache._list.find_index(pkgfile)
+                if indexfile:  # and indexfile.IsTrusted:
+                    security_files.add(pkgfile.id)
+        self._security_files = (cache._cache, security_files)
+        return security_files
+
+    def _get_security_flags(self, cache, pkgs):
+        """ This will test for all given pkgs if they are security updates.
             This includes if there is a newer version in -updates, but also
             an older update available in -security.  For example, if
             installed pkg A v1.0 is available in both -updates (as v1.2) and
             -security (v1.1). we want to display it as a security update.
 
-            :return: True if the update comes from the security pocket
+            :return: a list with True for every pkg that has an update
+                     from the security pocket
         """
         if not self.dist:
-            return False
-        inst_ver = pkg._pkg.current_ver
-        for ver in pkg._pkg.version_list:
-            # discard is < than installed ver
-            if (inst_ver and
-                    apt.apt_pkg.version_compare(ver.ver_str,
-                                                inst_ver.ver_str) <= 0):
-                continue
-            # check if we have a match
-            for (verFileIter, index) in ver.file_list:
-                if verFileIter.archive == "%s-security" % self.dist and \
-                        verFileIter.origin == "Ubuntu":
-                    indexfile = pkg._pcache._list.find_index(verFileIter)
-                    if indexfile:  # and indexfile.IsTrusted:
-                        return True
-        return False
+            return [False] * len(pkgs)
+        security_files = self._get_security_files(cache)
+        if not security_files:
+            return [False] * len(pkgs)
+        version_compare = apt.apt_pkg.version_compare
+        flags = []
+        for pkg in pkgs:
+            inst_ver = pkg._pkg.current_ver
+            is_security_update = False
+            for ver in pkg._pkg.version_list:
+                # only versions from the security pocket are interesting
+                for (pkgfile, index) in ver.file_list:
+                    if pkgfile.id in security_files:
+                        break
+                else:
+                    continue
+                # discard is < than installed ver
+                if (inst_ver and
+                        version_compare(ver.ver_str, inst_ver.ver_str) <= 0):
+                    continue
+                is_security_update = True
+                break
+            flags.append(is_security_update)
+        return flags
 
-    def _is_ignored_phased_update(self, pkg):
-        """ This will test if the pkg is a phased update and if
-            it needs to get installed or ignored.
+    def _is_security_update(self, pkg):
+        """ This will test if the pkg is a security update.
 
-            :return: True if the updates should be ignored
+            :return: True if the update comes from the security pocket
+        """
+        return self._get_security_flags(pkg._pcache, [pkg])[0]
+
+    def _get_phasing_value(self, pkg_name, version):
+        """ return the (stable) value between 0 and 100 of this machine
+            for the given package version, the update is installed if
+            it is not above the phased update percentage
+        """
+        # its important that we always get the same result on
+        # multiple runs of the update-manager, so we need to
+        # feed a seed that is a combination of the pkg/ver/machine
+        seed = "%s-%s-%s" % (pkg_name, version, self.machine_uniq_id)
+        if self.legacy_phasing:
+            # the decisions of the old Random() based implementation
+            self.random.seed(seed)
+            return self.random.randint(0, 100)
+        digest = hashlib.sha256(seed.encode("UTF-8")).hexdigest()
+        return int(digest[:16], 16) % 101
+
+    def _get_phased_update_percentage(self, pkg):
+        """ return the phased update percentage of the candidate of pkg
+            or None if it is not a phased update
+        """
+        # only the raw record is looked up, parsing the whole record
+        # (pkg.candidate.record) is needlessly expensive as the field
+        # is only set for very few packages
+        records = pkg._pcache._records
+        if not records.lookup(pkg.candidate._cand.file_list[0]):
+            return None
+        raw = records.record
+        if "\n%s:" % self.PHASED_UPDATES_KEY not in raw:
+            return None
+        value = apt.apt_pkg.TagSection(raw).get(self.PHASED_UPDATES_KEY)
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            logging.warning("invalid %s '%s' for '%s'" % (
+                self.PHASED_UPDATES_KEY, value, pkg.name))
+            return None
+
+    def _get_phased_flags(self, pkgs):
+        """ This will test for all given pkgs if they are phased updates
+            and if they need to get installed or ignored. The decisions
+            are recorded in self.phasing_report.
+
+            :return: a list with True for every update that should be
+                     ignored
         """
         # allow the admin to override this
         if apt.apt_pkg.config.find_b(
                 self.ALWAYS_INCLUDE_PHASED_UPDATES, False):
-            return False
+            return [False] * len(pkgs)
+        never_include = apt.apt_pkg.config.find_b(
+            self.NEVER_INCLUDE_PHASED_UPDATES, False)
 
-        if self.PHASED_UPDATES_KEY in pkg.candidate.record:
-            if apt.apt_pkg.config.find_b(
-                    self.NEVER_INCLUDE_PHASED_UPDATES, False):
+        flags = []
+        for pkg in pkgs:
+            percentage = self._get_phased_update_percentage(pkg)
+            if percentage is None:
+                flags.append(False)
+                continue
+            version = pkg.candidate.version
+            if never_include:
                 logging.info("holding back phased update per configuration")
-                return True
+                value = None
+                ignored = True
+            else:
+                value = self._get_phasing_value(pkg.name, version)
+                ignored = value > percentage
+                if ignored:
+                    logging.info("holding back phased update (%s < %s)" % (
+                        percentage, value))
+            self.phasing_report[pkg.name] = {"version": version,
+                                             "percentage": percentage,
+                                             "value": value,
+                                             "included": not ignored}
+            flags.append(ignored)
+        return flags
 
-            # its important that we always get the same result on
-            # multiple runs of the update-manager, so we need to
-            # feed a seed that is a combination of the pkg/ver/machine
-            self.random.seed("%s-%s-%s" % (
-                pkg.name, pkg.candidate.version,
-                self.machine_uniq_id))
-            threshold = pkg.candidate.record[self.PHASED_UPDATES_KEY]
-            percentage = self.random.randint(0, 100)
-            if percentage > int(threshold):
-                logging.info("holding back phased update (%s < %s)" % (
-                    threshold, percentage))
-                return True
-        return False
+    def _is_ignored_phased_update(self, pkg):
+        """ This will test if the pkg is a phased update and if
+            it needs to get installed or ignored.
+
+            :return: True if the updates should be ignored
+        """
+        return self._get_phased_flags([pkg])[0]
+
+    def get_phasing_report(self):
+        """ return the phasing decisions of the last update() as a dict
+            of package name to a dict with the candidate "version", the
+            phased update "percentage", the "value" of this machine (or
+            None if phased updates are never included) and if the
+            update is "included"
+        """
+        return dict(self.phasing_report)
 
     def _get_linux_packages(self):
         "Return all binary packages made by the linux-meta source package"
@@ -341,16 +775,24 @@ class UpdateList():
                 else:
                     ungrouped_pkgs.append(pkg)
 
+        # Index the dependencies of everything once, the bitsets in
+        # group_reach tell which ungrouped packages a group depends on
+        index = DependencyIndex(cache, [pkg.name for pkg in ungrouped_pkgs])
+        group_reach = [index.get_group_reach(group) for group in app_groups]
+
         # Stick together applications and their immediate dependencies
         for pkg in list(ungrouped_pkgs):
+            bit = index.bits[pkg.name]
             dep_groups = []
-            for group in app_groups:
-                if group.is_dependency(cache, pkg):
-                    dep_groups.append(group)
+            for (i, reach) in enumerate(group_reach):
+                if reach & bit:
+                    dep_groups.append(i)
                     if len(dep_groups) > 1:
                         break
             if len(dep_groups) == 1:
-                dep_groups[0].add(pkg)
+                i = dep_groups[0]
+                app_groups[i].add(pkg)
+                group_reach[i] |= index.get_reach(pkg.name)
                 ungrouped_pkgs.remove(pkg)
 
         # Separate out system base packages
@@ -362,8 +804,9 @@ class UpdateList():
         for pkg in meta_pkgs:
             if pkg in cache:
                 meta_group.add(cache[pkg])
+        meta_reach = index.get_group_reach(meta_group)
         for pkg in ungrouped_pkgs:
-            if meta_group.contains(pkg) or meta_group.is_dependency(cache, pkg):
+            if meta_reach & index.bits[pkg.name]:
                 if system_group is None:
                     system_group = UpdateSystemGroup(cache)
                 system_group.add(pkg)
@@ -377,40 +820,227 @@ class UpdateList():
 
         return app_groups + pkg_groups
 
-    def update(self, cache):
-        self.held_back = []
+    def get_packages(self):
+        """ return the packages of all security and other update groups """
+        pkgs = []
+        for group in self.security_groups + self.update_groups:
+            pkgs.extend([item.pkg for item in group.items])
+        return pkgs
+
+    def _get_snapshot_key(self):
+        """ return what the result of update() depends on, besides the
+            installed and candidate versions of the packages
+        """
+        lists_dir = apt.apt_pkg.config.find_dir("Dir::State::lists")
+        lists = []
+        try:
+            for name in sorted(os.listdir(lists_dir)):
+                if name in ("lock", "partial"):
+                    continue
+                st = os.stat(os.path.join(lists_dir, name))
+                lists.append([name, st.st_mtime, st.st_size])
+        except OSError:
+            pass
+        try:
+            st = os.stat(apt.apt_pkg.config.find_file("Dir::State::status"))
+            status = [st.st_mtime, st.st_size]
+        except OSError:
+            status = None
+        config = [
+            apt.apt_pkg.config.find_b(self.ALWAYS_INCLUDE_PHASED_UPDATES),
+            apt.apt_pkg.config.find_b(self.NEVER_INCLUDE_PHASED_UPDATES),
+            self.legacy_phasing]
+        lists_hash = hashlib.sha1(json.dumps(lists).encode("UTF-8"))
+        return {"version": self.SNAPSHOT_VERSION,
+                "dist": self.dist,
+                "config": config,
+                "lists": lists_hash.hexdigest(),
+                "status": status}
+
+    def _load_snapshot(self, key):
+        """ return the snapshot of the last update() or None if it
+            was made with different package lists or settings
+        """
+        if self.snapshot_file is None:
+            cache_dir = utils.get_cache_dir()
+            if cache_dir is None:
+                return None
+            self.snapshot_file = os.path.join(cache_dir, self.SNAPSHOT_FILE)
+        try:
+            with open(self.snapshot_file) as f:
+                snapshot = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        old_key = snapshot.get("key", {})
+        for k in key:
+            if k != "status" and old_key.get(k) != key[k]:
+                return None
+        return snapshot
+
+    def _save_snapshot(self, snapshot):
+        if self.snapshot_file is None:
+            return
+        try:
+            utils.write_file_atomic(self.snapshot_file,
+                                    json.dumps(snapshot).encode("UTF-8"))
+        except (IOError, OSError) as e:
+            logging.warning("failed to write '%s': %s" % (
+                self.snapshot_file, e))
+
+    def _dump_groups(self, groups):
+        " return the layout of the groups as json serializable list "
+        layout = []
+        for group in groups:
+            desktop_file = None
+            if isinstance(group, UpdateApplicationGroup):
+                desktop_file = group.application.get_filename()
+            core = group.core_item.pkg.name if group.core_item else None
+            layout.append({"type": group.TYPE,
+                           "desktop-file": desktop_file,
+                           "core": core,
+                           "items": sorted(item.pkg.name
+                                           for item in group._items)})
+        return layout
+
+    def _restore_groups(self, cache, layout):
+        """ recreate the groups from the layout of _dump_groups(),
+            return None if this is not possible (anymore)
+        """
+        groups = []
+        try:
+            for entry in layout:
+                core = entry["core"]
+                if entry["type"] == "application":
+                    application = self._load_application(
+                        entry["desktop-file"])
+                    group = UpdateApplicationGroup(cache[core], application)
+                elif entry["type"] == "system":
+                    group = UpdateSystemGroup(cache)
+                else:
+                    group = UpdatePackageGroup(cache[core])
+                for name in entry["items"]:
+                    if name != core:
+                        group.add(cache[name])
+                groups.append(group)
+        except Exception as e:
+            logging.debug("can not restore update groups: %s" % e)
+            return None
+        return groups
+
+    def _set_attributes(self, records):
+        """ read the PackageAttributes of all items, they are kept in the
+            records of the packages (and so in the snapshot) as well
+        """
+        for group in self.update_groups + self.security_groups:
+            for item in group._items:
+                record = records.get(item.pkg.name, {})
+                if "attributes" in record:
+                    item._attributes = PackageAttributes.from_dict(
+                        record["attributes"])
+                else:
+                    record["attributes"] = item.attributes.to_dict()
 
+    def _classify(self, cache, pkgs):
+        """ return a (is_security_update, is_ignored_phased_update) tuple
+            for every pkg
+        """
+        with utils.trace_span("security classification"):
+            security_flags = self._get_security_flags(cache, pkgs)
+        # see if its a phased update and *not* a security update
+        with utils.trace_span("phasing"):
+            phased_flags = self._get_phased_flags(
+                [pkg for (pkg, is_security_update)
+                 in zip(pkgs, security_flags) if not is_security_update])
+        phased_flags.reverse()
+        return [(is_security_update,
+                 not is_security_update and phased_flags.pop())
+                for is_security_update in security_flags]
+
+    def update(self, cache):
         # do the upgrade
         self.distUpgradeWouldDelete = cache.saveDistUpgrade()
+        self.phasing_report = {}
+
+        snapshot = None
+        if self.use_snapshot:
+            key = self._get_snapshot_key()
+            snapshot = self._load_snapshot(key)
+        old_records = snapshot["packages"] if snapshot else {}
+        records = {}
 
         security_pkgs = []
         upgrade_pkgs = []
+        upgradable_pkgs = []
+        unknown_pkgs = []
 
         # Find all upgradable packages
-        for pkg in cache:
-            if pkg.is_upgradable or pkg.marked_install:
-                if getattr(pkg.candidate, "origins", None) is None:
-                    # can happen for e.g. locked packages
-                    # FIXME: do something more sensible here (but what?)
-                    print("WARNING: upgradable but no candidate.origins?!?: ",
-                          pkg.name)
-                    continue
-
-                # see if its a phased update and *not* a security update
-                is_security_update = self._is_security_update(pkg)
-                if (not is_security_update and
-                        self._is_ignored_phased_update(pkg)):
-                    continue
-
-                if is_security_update:
-                    security_pkgs.append(pkg)
-                else:
-                    upgrade_pkgs.append(pkg)
-                self.num_updates = self.num_updates + 1
-
-            if pkg.is_upgradable and not (pkg.marked_upgrade or
-                                          pkg.marked_install):
-                self.held_back.append(pkg.name)
+        (pkgs, self.held_back) = cache.get_upgradable_packages()
+        for pkg in pkgs:
+            if getattr(pkg.candidate, "origins", None) is None:
+                # can happen for e.g. locked packages
+                # FIXME: do something more sensible here (but what?)
+                print("WARNING: upgradable but no candidate.origins?!?: ",
+                      pkg.name)
+                continue
 
-        self.update_groups = self._make_groups(cache, upgrade_pkgs)
-        self.security_groups = self._make_groups(cache, security_pkgs)
+            # the classification only depends on the package lists
+            # (checked by _load_snapshot) and on the versions
+            installed = pkg.installed.version if pkg.installed else None
+            candidate = pkg.candidate.version
+            record = old_records.get(pkg.name)
+            if (record is None or
+                    record["installed"] != installed or
+                    record["candidate"] != candidate):
+                record = {"installed": installed,
+                          "candidate": candidate}
+                unknown_pkgs.append(pkg)
+            elif record.get("phasing"):
+                self.phasing_report[pkg.name] = record["phasing"]
+            records[pkg.name] = record
+            upgradable_pkgs.append(pkg)
+
+        # classify the new packages in one go
+        if unknown_pkgs:
+            for (pkg, (is_security, is_ignored)) in zip(
+                    unknown_pkgs, self._classify(cache, unknown_pkgs)):
+                records[pkg.name]["security"] = is_security
+                records[pkg.name]["phased"] = is_ignored
+                records[pkg.name]["phasing"] = self.phasing_report.get(
+                    pkg.name)
+
+        for pkg in upgradable_pkgs:
+            record = records[pkg.name]
+            if record["phased"]:
+                continue
+            if record["security"]:
+                security_pkgs.append(pkg)
+            else:
+                upgrade_pkgs.append(pkg)
+            self.num_updates = self.num_updates + 1
+
+        update_groups = security_groups = None
+        # the grouping also depends on the installed packages (via the
+        # dependencies and .desktop files), so the groups are only reused
+        # if the dpkg status is unchanged too and no update was added or
+        # removed
+        with utils.trace_span("grouping"):
+            if (snapshot and snapshot["key"] == key and
+                    snapshot["packages"] == records):
+                update_groups = self._restore_groups(
+                    cache, snapshot["update-groups"])
+                security_groups = self._restore_groups(
+                    cache, snapshot["security-groups"])
+            if update_groups is None or security_groups is None:
+                update_groups = self._make_groups(cache, upgrade_pkgs)
+                security_groups = self._make_groups(cache, security_pkgs)
+        self.update_groups = update_groups
+        self.security_groups = security_groups
+        with utils.trace_span("attributes"):
+            self._set_attributes(records)
+
+        if self.use_snapshot:
+            self._save_snapshot({
+                "key": key,
+                "packages": records,
+                "update-groups": self._dump_groups(self.update_groups),
+                "security-groups": self._dump_groups(self.security_groups)})
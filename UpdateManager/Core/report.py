@@ -0,0 +1,132 @@
+# report.py
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+#
+#  Copyright (c) 2013 Canonical
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+"""
+Headless, machine readable report of the available updates. This
+builds the same update list as the update-manager UI, but without
+loading Gtk or Gio, and prints it as JSON (or NDJSON: one line per
+update followed by a summary line):
+
+  python3 -m UpdateManager.Core.report [--ndjson] [--rootdir DIR]
+"""
+
+from __future__ import absolute_import, print_function
+
+import json
+import sys
+from optparse import OptionParser
+
+from .MyCache import MyCache
+from .UpdateList import UpdateList
+from .utils import enable_trace
+
+
+def get_report(cache, update_list):
+    """ return the result of update_list.update(cache) as a json
+        serializable dict
+    """
+    updates = []
+    groups = []
+    for (security, group_list) in [(True, update_list.security_groups),
+                                   (False, update_list.update_groups)]:
+        for group in group_list:
+            names = []
+            for item in group.items:
+                pkg = item.pkg
+                attributes = item.attributes
+                names.append(pkg.name)
+                updates.append({
+                    "name": pkg.name,
+                    "source": attributes.source_name,
+                    "installed": (pkg.installed.version
+                                  if pkg.installed else None),
+                    "candidate": pkg.candidate.version,
+                    "security": security,
+                    "group": group.name,
+                    "size": attributes.size,
+                    "restart-required": attributes.requires_restart,
+                })
+            groups.append({"name": group.name,
+                           "type": group.TYPE,
+                           "security": security,
+                           "packages": names})
+    return {
+        "dist": update_list.dist,
+        "num-updates": update_list.num_updates,
+        "dist-upgrade-would-delete": update_list.distUpgradeWouldDelete,
+        "download-size": cache.required_download,
+        "restart-required": any(u["restart-required"] for u in updates),
+        "held-back": sorted(update_list.held_back),
+        "phasing": update_list.get_phasing_report(),
+        "groups": groups,
+        "updates": updates,
+    }
+
+
+def write_report(report, out, ndjson=False):
+    if not ndjson:
+        json.dump(report, out, indent=2, sort_keys=True)
+        out.write("\n")
+        return
+    summary = dict(report)
+    for update in summary.pop("updates"):
+        out.write(json.dumps(dict(update, type="update"), sort_keys=True))
+        out.write("\n")
+    summary["type"] = "summary"
+    out.write(json.dumps(summary, sort_keys=True))
+    out.write("\n")
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--ndjson", action="store_true", default=False,
+                      help="print one JSON object per line")
+    parser.add_option("--rootdir", default=None,
+                      help="use the apt configuration and state of DIR")
+    parser.add_option("--dist", default=None,
+                      help="the distribution codename (default: running)")
+    parser.add_option("--snapshot", action="store_true", default=False,
+                      help="reuse the result of the previous run if "
+                           "nothing changed")
+    parser.add_option("--profile", default=None, metavar="FILE",
+                      help="write the timing of the stages to FILE")
+    (options, args) = parser.parse_args(argv)
+    if options.profile:
+        enable_trace(options.profile)
+
+    try:
+        cache = MyCache(None, rootdir=options.rootdir)
+    except (AssertionError, SystemError) as e:
+        sys.stderr.write("can not open the package cache: %s\n" % e)
+        return 1
+    update_list = UpdateList(None, dist=options.dist,
+                             use_snapshot=options.snapshot, headless=True)
+    try:
+        update_list.update(cache)
+    except SystemError as e:
+        sys.stderr.write("can not calculate the upgrade: %s\n" % e)
+        return 1
+    write_report(get_report(cache, update_list), sys.stdout,
+                 ndjson=options.ndjson)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
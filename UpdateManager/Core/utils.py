@@ -28,17 +28,20 @@ from gettext import ngettext
 from stat import (S_IMODE, ST_MODE, S_IXUSR)
 from math import ceil
 
-import apt
 import apt_pkg
 apt_pkg.init_config()
 
+import atexit
 import locale
 import logging
 import re
 import os
 import glob
+import json
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 try:
     from urllib.request import (
@@ -46,7 +49,6 @@ try:
         Request,
         build_opener,
         install_opener,
-        urlopen,
     )
     from urllib.parse import urlsplit
 except ImportError:
@@ -55,12 +57,13 @@ except ImportError:
         Request,
         build_opener,
         install_opener,
-        urlopen,
     )
     from urlparse import urlsplit
 
 from copy import copy
 
+from .HttpClient import get_http_client
+
 
 class ExecutionTime(object):
     """
@@ -68,15 +71,211 @@ class ExecutionTime(object):
     measure of the timing of a particular block of code, e.g.
     with ExecutionTime("db flush"):
         db.flush()
+
+    If a Trace is given the time is added to it as a span instead of
+    being printed.
     """
-    def __init__(self, info=""):
+    def __init__(self, info="", trace=None):
         self.info = info
+        self.trace = trace
 
     def __enter__(self):
         self.now = time.time()
 
     def __exit__(self, type, value, stack):
-        print("%s: %s" % (self.info, time.time() - self.now))
+        duration = time.time() - self.now
+        if self.trace is not None:
+            self.trace.add(self.info, self.now, duration)
+        else:
+            print("%s: %s" % (self.info, duration))
+
+
+class Trace(object):
+    """
+    Collects the named spans of a run (see trace_span()) and writes
+    them as plain JSON or in the Chrome trace format (that can be
+    loaded in chrome://tracing)
+    """
+
+    FORMATS = ("chrome", "json")
+
+    def __init__(self, path=None, format="chrome"):
+        if format not in self.FORMATS:
+            raise ValueError("unknown trace format '%s'" % format)
+        self.path = path
+        self.format = format
+        self.start = time.time()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, start, duration):
+        thread = threading.current_thread()
+        with self._lock:
+            self.spans.append((name, start, duration, thread.name))
+
+    def to_json(self):
+        return {"start": self.start,
+                "spans": [{"name": name,
+                           "start": start - self.start,
+                           "duration": duration,
+                           "thread": thread}
+                          for (name, start, duration, thread) in self.spans]}
+
+    def to_chrome_trace(self):
+        threads = {}
+        events = []
+        for (name, start, duration, thread) in self.spans:
+            tid = threads.setdefault(thread, len(threads) + 1)
+            events.append({"name": name,
+                           "cat": "update-manager",
+                           "ph": "X",
+                           "ts": int((start - self.start) * 1000000),
+                           "dur": int(duration * 1000000),
+                           "pid": os.getpid(),
+                           "tid": tid})
+        for (thread, tid) in threads.items():
+            events.append({"name": "thread_name", "ph": "M",
+                           "pid": os.getpid(), "tid": tid,
+                           "args": {"name": thread}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path=None):
+        path = path or self.path
+        if self.format == "chrome":
+            data = self.to_chrome_trace()
+        else:
+            data = self.to_json()
+        try:
+            with open(path, "w") as f:
+                json.dump(data, f, indent=1)
+        except (IOError, OSError) as e:
+            logging.warning("failed to write trace to '%s': %s" % (path, e))
+
+
+# the environment variables to enable the trace (PROFILE is the path)
+TRACE_ENV = "UPDATE_MANAGER_PROFILE"
+TRACE_FORMAT_ENV = "UPDATE_MANAGER_PROFILE_FORMAT"
+
+_trace = None
+_trace_checked_env = False
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type, value, stack):
+        pass
+
+
+_no_span = _NoSpan()
+
+
+def enable_trace(path, format=None):
+    """ collect the spans of trace_span() and write them to path at
+        exit, return the Trace
+    """
+    global _trace
+    if format is None:
+        format = os.environ.get(TRACE_FORMAT_ENV, "chrome")
+    if format not in Trace.FORMATS:
+        # a typo in the environment must not stop the application
+        logging.warning("unknown trace format '%s', using 'chrome'" % format)
+        format = "chrome"
+    _trace = Trace(path, format)
+    atexit.register(_trace.write)
+    return _trace
+
+
+def get_trace():
+    " return the active Trace or None if tracing is not enabled "
+    global _trace_checked_env
+    if _trace is None and not _trace_checked_env:
+        _trace_checked_env = True
+        if os.environ.get(TRACE_ENV):
+            enable_trace(os.environ[TRACE_ENV])
+    return _trace
+
+
+def trace_span(name):
+    """ return a context manager that records the time of the block as
+        span name if tracing is enabled (and does nothing otherwise), e.g.
+    with trace_span("saveDistUpgrade"):
+        cache.saveDistUpgrade()
+    """
+    trace = get_trace()
+    if trace is None:
+        return _no_span
+    return ExecutionTime(name, trace)
+
+
+def get_user_cache_dir():
+    """ return the per-user update-manager-core cache directory
+        (creating it if needed) or None if it can not be created
+    """
+    cache_dir = os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    # Take special care when creating this directory; ~/.cache needs
+    # to be created with mode 0700, but the other directories do
+    # not.
+    cache_parent_dir = os.path.split(cache_dir)[0]
+    if not os.path.exists(cache_parent_dir):
+        try:
+            os.makedirs(cache_parent_dir)
+        except OSError as e:
+            sys.stderr.write("mkdir() failed: '%s'" % e)
+            return None
+    if not os.path.exists(cache_dir):
+        try:
+            os.mkdir(cache_dir, 0o700)
+        except OSError as e:
+            sys.stderr.write("mkdir() failed: '%s'" % e)
+            return None
+    path = os.path.join(cache_dir, 'update-manager-core')
+    if not os.path.exists(path):
+        try:
+            os.mkdir(path)
+        except OSError as e:
+            sys.stderr.write("mkdir() failed: '%s'" % e)
+            return None
+    return path
+
+
+def get_cache_dir(subdir=None, system_dir="/var/lib/update-manager"):
+    """ return a writable directory for cached data, this is the
+        system wide location if we can write to it and the per-user
+        cache directory otherwise (or None if neither is usable)
+    """
+    if os.access(system_dir, os.W_OK):
+        path = system_dir
+    else:
+        path = get_user_cache_dir()
+        if path is None:
+            return None
+    if subdir:
+        path = os.path.join(path, subdir)
+        if not os.path.exists(path):
+            try:
+                os.mkdir(path)
+            except OSError as e:
+                sys.stderr.write("mkdir() failed: '%s'" % e)
+                return None
+    return path
+
+
+def write_file_atomic(path, data, mode=0o644):
+    """ write the given bytes to path via a temporary file in the same
+        directory, so that readers never see a partial file
+    """
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp, mode)
+        os.rename(tmp, path)
+    except BaseException:
+        # also on KeyboardInterrupt, the error is passed on
+        os.unlink(tmp)
+        raise
 
 
 def get_string_with_no_auth_from_source_entry(entry):
@@ -270,7 +469,7 @@ def url_downloadable(uri, debug_func=None):
                                                        querry, fragment))
     if scheme == "http":
         try:
-            http_file = urlopen(HeadRequest(uri))
+            http_file = get_http_client().open(HeadRequest(uri))
             http_file.close()
             if http_file.code == 200:
                 return True
@@ -329,7 +528,8 @@ def init_proxy(gsettings=None):
         proxy_support = ProxyHandler({"http": proxy})
         opener = build_opener(proxy_support)
         install_opener(opener)
-        os.putenv("http_proxy", proxy)
+        # in os.environ too, so that HttpClient sees it
+        os.environ["http_proxy"] = proxy
     return proxy
 
 
@@ -413,16 +613,51 @@ def get_ubuntu_flavor(cache=None):
     return pkg.split('-', 1)[0]
 
 
+_meta_pkg_list = None
+
+
 def _load_meta_pkg_list():
     # This could potentially introduce a circular dependency, but the config
     # parser logic is simple, and doesn't rely on any UpdateManager code.
-    from DistUpgrade.DistUpgradeConfigParser import DistUpgradeConfig
-    parser = DistUpgradeConfig('/usr/share/ubuntu-release-upgrader')
-    return parser.getlist('Distro', 'MetaPkgs')
+    global _meta_pkg_list
+    if _meta_pkg_list is None:
+        from DistUpgrade.DistUpgradeConfigParser import DistUpgradeConfig
+        parser = DistUpgradeConfig('/usr/share/ubuntu-release-upgrader')
+        _meta_pkg_list = parser.getlist('Distro', 'MetaPkgs')
+    return _meta_pkg_list
+
+
+def _get_installed_packages(names):
+    """ return which of the given packages are installed according to
+        the dpkg status file, without opening an apt.Cache
+    """
+    installed = set()
+    names = set(names)
+    status_file = apt_pkg.config.find_file("Dir::State::status")
+    try:
+        with open(status_file) as f:
+            tagfile = apt_pkg.TagFile(f)
+            for section in tagfile:
+                if section.get("Package") not in names:
+                    continue
+                status = section.get("Status", "").split()
+                if status and status[-1] not in ("not-installed",
+                                                 "config-files"):
+                    installed.add(section["Package"])
+    except (IOError, OSError, SystemError) as e:
+        logging.warning("failed to read '%s': %s" % (status_file, e))
+    return installed
+
+
+_flavor_package = None
+_flavor_package_lock = threading.Lock()
 
 
 def get_ubuntu_flavor_package(cache=None):
-    """ try to guess the flavor metapackage based on the running desktop """
+    """ try to guess the flavor metapackage based on the running desktop,
+        without a cache the result is looked up once per process
+    """
+    global _flavor_package
     # From spec, first if ubuntu-desktop is installed, use that.
     # Second, grab first installed one from DistUpgrade.cfg.
     # Lastly, fallback to ubuntu-desktop again.
@@ -433,13 +668,22 @@ def get_ubuntu_flavor_package(cache=None):
     except Exception as e:
         print('Could not load list of meta packages:', e)
 
-    if cache is None:
-        cache = apt.Cache()
-    for meta_pkg in meta_pkgs:
-        cache_pkg = cache[meta_pkg] if meta_pkg in cache else None
-        if cache_pkg and cache_pkg.is_installed:
-            return meta_pkg
-    return 'ubuntu-desktop'
+    if cache is not None:
+        for meta_pkg in meta_pkgs:
+            cache_pkg = cache[meta_pkg] if meta_pkg in cache else None
+            if cache_pkg and cache_pkg.is_installed:
+                return meta_pkg
+        return 'ubuntu-desktop'
+
+    with _flavor_package_lock:
+        if _flavor_package is None:
+            installed = _get_installed_packages(meta_pkgs)
+            _flavor_package = 'ubuntu-desktop'
+            for meta_pkg in meta_pkgs:
+                if meta_pkg in installed:
+                    _flavor_package = meta_pkg
+                    break
+        return _flavor_package
 
 
 def get_ubuntu_flavor_name(cache=None):
@@ -41,19 +41,37 @@ class MetaRelease(MetaReleaseCore, GObject.GObject):
 
     def __init__(self, useDevelopmentRelease=False, useProposed=False):
         GObject.GObject.__init__(self)
+        self._emitted = False
+        self._timeout_id = None
         MetaReleaseCore.__init__(self, useDevelopmentRelease, useProposed)
-        # in the gtk space to test if the download already finished
-        # this is needed because gtk is not thread-safe
-        GLib.timeout_add_seconds(1, self.check)
+        # give up on a download that hangs, the timeout is removed
+        # when the result comes in before
+        if self.downloading and self.timeout > 0:
+            self._timeout_id = GLib.timeout_add_seconds(self.timeout,
+                                                        self._on_timeout)
+
+    def done_downloading(self):
+        # gtk is not thread-safe, the signals are emitted in the main loop
+        GLib.idle_add(self.check)
+
+    def _on_timeout(self):
+        self._timeout_id = None
+        self.cancel()
+        self.downloading = False
+        self.check()
+        return False
 
     def check(self):
+        if self._emitted:
+            return False
+        self._emitted = True
+        if self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
         # check if we have a metarelease_information file
         if self.no_longer_supported is not None:
             self.emit("dist_no_longer_supported")
         if self.new_dist is not None:
             self.emit("new_dist_available", self.new_dist)
-        if self.downloading:
-            return True
-        else:
-            self.emit("done_downloading")
-            return False
+        self.emit("done_downloading")
+        return False
@@ -25,7 +25,6 @@ from __future__ import absolute_import, print_function
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import Gio
-from gi.repository import GLib
 
 import warnings
 warnings.filterwarnings("ignore", "Accessed deprecated property",
@@ -237,9 +236,12 @@ class UpdateManager(Gtk.Window):
             return None
 
         if self.meta_release.downloading:
-            # Block until we get an answer
-            GLib.idle_add(self._meta_release_wait_idle)
+            # Block until we get an answer, 'done_downloading' is emitted
+            # in our thread's event loop after 'downloading' is cleared
+            handler = self.meta_release.connect("done_downloading",
+                                                Gtk.main_quit)
             Gtk.main()
+            self.meta_release.disconnect(handler)
 
         # Check if there is anything to upgrade to or a known-broken upgrade
         next = self.meta_release.upgradable_to
@@ -259,16 +261,6 @@ class UpdateManager(Gtk.Window):
 
         return None
 
-    def _meta_release_wait_idle(self):
-        # 'downloading' is changed in a thread, but the signal
-        # 'done_downloading' is done in our thread's event loop.  So we know
-        # that it won't fire while we're in this function.
-        if not self.meta_release.downloading:
-            Gtk.main_quit()
-        else:
-            self.meta_release.connect("done_downloading", Gtk.main_quit)
-        return False
-
     # fixme: we should probably abstract away all the stuff from libapt
     def refresh_cache(self):
         # get the lock
@@ -281,6 +273,9 @@ class UpdateManager(Gtk.Window):
             if self.cache is None:
                 self.cache = MyCache(None)
             else:
+                # the prefetch threads must not use the cache while
+                # it is reopened
+                self.cache.cancel_prefetch()
                 self.cache.open(None)
                 self.cache._initDepCache()
         except AssertionError:
@@ -308,7 +303,7 @@ class UpdateManager(Gtk.Window):
         while Gtk.events_pending():
             Gtk.main_iteration()
 
-        self.update_list = UpdateList(self)
+        self.update_list = UpdateList(self, use_snapshot=True)
         try:
             self.update_list.update(self.cache)
         except SystemError as e:
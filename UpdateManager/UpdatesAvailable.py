@@ -50,13 +50,12 @@ import re
 import logging
 import subprocess
 import time
-import threading
 
 from gettext import gettext as _
 from gettext import ngettext
 
 
-from .Core.utils import (get_package_label, humanize_size)
+from .Core.utils import (get_package_label, humanize_size, trace_span)
 from .Core.AlertWatcher import AlertWatcher
 from .Core.UpdateList import UpdateSystemGroup
 
@@ -88,6 +87,10 @@ class UpdateData():
         self.item = item
 
 
+# the child row of a group whose item rows are not created yet
+PLACEHOLDER_DATA = UpdateData(None, None, None)
+
+
 class CellAreaPackage(Gtk.CellAreaBox):
     """This CellArea lays our package cells side by side, without allocating
        width for a cell if it isn't present (like icons for header labels).
@@ -205,6 +208,10 @@ class CellAreaPackage(Gtk.CellAreaBox):
 
 class UpdatesAvailable(SimpleGtkbuilderApp):
 
+    # bursts of selection changes within this time (in ms) only update
+    # the download size once
+    REFRESH_COUNT_DELAY = 150
+
     def __init__(self, app, header=None, desc=None):
         self.window_main = app
         self.datadir = app.datadir
@@ -228,7 +235,12 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
 
         self.button_close.grab_focus()
         self.dl_size = 0
+        self._refresh_count_source = None
+        self.pane_updates_available.connect("destroy", self._on_pane_destroy)
+        self._changelog_request = None
+        self._changelog_button = None
         self.connected = True
+        self._reset_selection_rows()
 
         self.settings = Gio.Settings("com.ubuntu.update-manager")
 
@@ -321,8 +333,12 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
         self.treeview_update.set_fixed_height_mode(False)
         self.treeview_update.set_expander_column(pkg_column)
         self.treeview_update.set_search_column(LIST_NAME)
+        self.treeview_update.set_search_equal_func(self._search_equal_func,
+                                                   None)
         self.treeview_update.connect("button-press-event",
                                      self.on_treeview_button_press)
+        self.treeview_update.connect("test-expand-row",
+                                     self.on_treeview_update_test_expand_row)
 
         # setup the help viewer and disable the help button if there
         # is no viewer available
@@ -372,23 +388,16 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
 
     def restart_icon_renderer_data_func(self, cell_layout, renderer, model,
                                         iter, data):
-        def pkg_requires_restart(pkg):
-            restart_condition = pkg.candidate.record.get('XB-Restart-Required')
-            return restart_condition == 'system'
-
         data = model.get_value(iter, LIST_UPDATE_DATA)
         path = model.get_path(iter)
 
         requires_restart = False
         if data.item:
-            requires_restart = pkg_requires_restart(data.item.pkg)
+            requires_restart = data.item.attributes.requires_restart
         elif data.group:
             if not self.treeview_update.row_expanded(path):
                 # A package in the group requires restart
-                for group_item in data.group.items:
-                    if pkg_requires_restart(group_item.pkg):
-                        requires_restart = True
-                        break
+                requires_restart = data.group.requires_restart()
 
         # FIXME: Non-standard, incorrect icon name (from app category).
         # Theme support for what we want seems to be lacking.
@@ -412,21 +421,10 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
             inconsistent = False
         elif data.group:
             activatable = True
-            inconsistent = data.group.selection_is_inconsistent()
+            inconsistent = self._selection_is_inconsistent([data.group])
         elif data.groups:
             activatable = True
-            inconsistent = False
-            saw_install = None
-            for group in data.groups:
-                for item in group.items:
-                    pkg = item.pkg
-                    this_install = pkg.marked_install or pkg.marked_upgrade
-                    if saw_install is not None and saw_install != this_install:
-                        inconsistent = True
-                        break
-                    saw_install = this_install
-                if inconsistent:
-                    break
+            inconsistent = self._selection_is_inconsistent(data.groups)
 
         # The "active" attribute is already set via LIST_TOGGLE_ACTIVE in the
         # tree model, so we don't set it here.
@@ -450,7 +448,9 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
         data = model.get_value(iter, LIST_UPDATE_DATA)
         name = GLib.markup_escape_text(model.get_value(iter, LIST_NAME))
 
-        if data.group:
+        if data is PLACEHOLDER_DATA:
+            markup = ""
+        elif data.group:
             markup = name
         elif data.item:
             markup = name
@@ -484,6 +484,8 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
                 changes_buffer.insert(end_iter, line + "\n")
 
     def on_treeview_update_cursor_changed(self, widget):
+        # the changes of the previous row are not needed anymore
+        self._cancel_changelog_request()
         path = widget.get_cursor()[0]
         # check if we have a path at all
         if path is None:
@@ -493,6 +495,8 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
 
         # set descr
         data = model.get_value(iter, LIST_UPDATE_DATA)
+        if data is PLACEHOLDER_DATA:
+            return
         item = data.item
         if (item is None and data.group is not None and
                 data.group.core_item is not None):
@@ -533,7 +537,7 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
         # (even if currently disconnected)
         if name in self.cache.all_changes:
             changes = self.cache.all_changes[name]
-            srcpkg = self.cache[name].candidate.source_name
+            srcpkg = item.attributes.source_name
             self.set_changes_buffer(changes_buffer, changes, name, srcpkg)
         # if not connected, do not even attempt to get the changes
         elif not self.connected:
@@ -542,11 +546,8 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
                   "changelog information."))
         # else, get it from the entwork
         elif self.expander_details.get_expanded():
-            lock = threading.Lock()
-            lock.acquire()
-            changelog_thread = threading.Thread(
-                target=self.cache.get_news_and_changelog, args=(name, lock))
-            changelog_thread.start()
+            # fetch_news_and_changelog() will just wait for the prefetch
+            # (moved to the front of the queue) if it has this package
             changes_buffer.set_text("%s\n" %
                                     _("Downloading list of changes..."))
             iter = changes_buffer.get_iter_at_line(1)
@@ -554,33 +555,45 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
             button = Gtk.Button(stock="gtk-cancel")
             self.textview_changes.add_child_at_anchor(button, anchor)
             button.show()
-            id = button.connect("clicked",
-                                lambda w, lock: lock.release(), lock)
-            # wait for the dl-thread
-            while lock.locked():
-                time.sleep(0.01)
-                while Gtk.events_pending():
-                    Gtk.main_iteration()
-            # download finished (or canceld, or time-out)
-            button.hide()
-            if button.handler_is_connected(id):
-                button.disconnect(id)
-        # check if we still are in the right pkg (the download may have taken
-        # some time and the user may have clicked on a new pkg)
-        now_path = widget.get_cursor()[0]
-        if now_path is None:
-            return
-        if path != now_path:
+            self._changelog_button = button
+            button.connect("clicked",
+                           lambda w: self._cancel_changelog_request())
+            self._changelog_request = self.cache.fetch_news_and_changelog(
+                name, lambda request: GLib.idle_add(
+                    self._on_changelog_fetched, request, item))
             return
+        self._show_news_and_changelog(item)
+
+    def _cancel_changelog_request(self):
+        if self._changelog_request is not None:
+            self._changelog_request.cancel()
+            self._changelog_request = None
+        if self._changelog_button is not None:
+            self._changelog_button.hide()
+            self._changelog_button = None
+
+    def _on_changelog_fetched(self, request, item):
+        # the cursor moved on (or the download was cancelled) since
+        if request is not self._changelog_request:
+            return False
+        self._changelog_request = None
+        self._changelog_button.hide()
+        self._changelog_button = None
+        self._show_news_and_changelog(item)
+        return False
+
+    def _show_news_and_changelog(self, item):
         # display NEWS.Debian first, then the changelog
+        name = item.pkg.name
         changes = ""
-        srcpkg = self.cache[name].candidate.source_name
         if name in self.cache.all_news:
             changes += self.cache.all_news[name]
         if name in self.cache.all_changes:
             changes += self.cache.all_changes[name]
         if changes:
-            self.set_changes_buffer(changes_buffer, changes, name, srcpkg)
+            self.set_changes_buffer(self.textview_changes.get_buffer(),
+                                    changes, name,
+                                    item.attributes.source_name)
 
     def on_treeview_button_press(self, widget, event):
         """
@@ -607,24 +620,12 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
             menu.show()
             return True
 
-    # we need this for select all/unselect all
-    def _toggle_group_headers(self, new_selection_value):
-        """ small helper that will set/unset the group headers
-        """
-        model = self.treeview_update.get_model()
-        for row in model:
-            data = model.get_value(row.iter, LIST_UPDATE_DATA)
-            if data.groups is not None or data.group is not None:
-                model.set_value(row.iter, LIST_TOGGLE_ACTIVE,
-                                new_selection_value)
-
     def select_all_upgrades(self, widget):
         """
         Select all updates
         """
         self.setBusy(True)
         self.cache.saveDistUpgrade()
-        self._toggle_group_headers(True)
         self.treeview_update.queue_draw()
         self.updates_changed()
         self.setBusy(False)
@@ -635,7 +636,6 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
         """
         self.setBusy(True)
         self.cache.clear()
-        self._toggle_group_headers(False)
         self.treeview_update.queue_draw()
         self.updates_changed()
         self.setBusy(False)
@@ -653,50 +653,101 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
         while Gtk.events_pending():
             Gtk.main_iteration()
 
+    def _reset_selection_rows(self):
+        # the rows of the store and the selection state they show:
+        #  item -> [group, item row or None, selected]
+        self._item_rows = {}
+        #  group -> [group row, number of selected items]
+        self._group_rows = {}
+        #  [header row, groups, selected]
+        self._header_rows = []
+        self._marks_serial = None
+        # group -> group row, for the groups whose item rows are not
+        # created yet (they get a placeholder child until expanded)
+        self._collapsed_groups = {}
+        self._size_strings = {}
+
+    def _get_size_string(self, size):
+        if size not in self._size_strings:
+            self._size_strings[size] = humanize_size(size)
+        return self._size_strings[size]
+
+    def _selection_is_inconsistent(self, groups):
+        selected = 0
+        total = 0
+        for group in groups:
+            if group in self._group_rows:
+                selected += self._group_rows[group][1]
+                total += len(group.items)
+        return selected > 0 and selected < total
+
     def _mark_selected_updates(self):
-        def foreach_cb(model, path, iter, data):
-            data = model.get_value(iter, LIST_UPDATE_DATA)
-            active = False
-            if data.item:
-                active = data.item.pkg.marked_install or \
-                         data.item.pkg.marked_upgrade
-            elif data.group:
-                active = data.group.packages_are_selected()
-            elif data.groups:
-                active = any([g.packages_are_selected() for g in data.groups])
-            model.set_value(iter, LIST_TOGGLE_ACTIVE, active)
-        self.store.foreach(foreach_cb, None)
+        """ update the toggles of the rows whose selection changed, the
+            marks are only looked at again after the cache sent a change
+            notification and only the group and header rows of the
+            changed items are updated
+        """
+        if self._marks_serial == self.cache.marks_serial:
+            return
+        self._marks_serial = self.cache.marks_serial
+        # group -> was selected before
+        changed_groups = {}
+        for (item, row) in self._item_rows.items():
+            (group, item_iter, was_selected) = row
+            pkg = item.pkg
+            selected = bool(pkg.marked_install or pkg.marked_upgrade)
+            if selected == was_selected:
+                continue
+            row[2] = selected
+            if item_iter is not None:
+                self.store.set_value(item_iter, LIST_TOGGLE_ACTIVE, selected)
+            group_row = self._group_rows[group]
+            changed_groups.setdefault(group, group_row[1] > 0)
+            group_row[1] += 1 if selected else -1
+        for (group, was_selected) in changed_groups.items():
+            (group_iter, count) = self._group_rows[group]
+            if (count > 0) != was_selected:
+                self.store.set_value(group_iter, LIST_TOGGLE_ACTIVE,
+                                     count > 0)
+        for header_row in self._header_rows:
+            (header_iter, groups, was_selected) = header_row
+            if not any(group in changed_groups for group in groups):
+                continue
+            selected = any(self._group_rows[group][1] > 0
+                           for group in groups if group in self._group_rows)
+            if selected != was_selected:
+                header_row[2] = selected
+                self.store.set_value(header_iter, LIST_TOGGLE_ACTIVE,
+                                     selected)
+
+    def _refresh_install_button(self):
+        # do not set the buttons to sensitive/insensitive until NM
+        # can deal with dialup connections properly
+        #if self.alert_watcher.network_state != NM_STATE_CONNECTED:
+        #    self.button_install.set_sensitive(False)
+        #else:
+        #    self.button_install.set_sensitive(True)
+        has_updates = self.cache.install_count > 0
+        self.button_install.set_sensitive(has_updates)
+        self.unity.set_install_menuitem_visible(has_updates)
 
     def _refresh_updates_count(self):
-        self.button_install.set_sensitive(self.cache.install_count)
         try:
             inst_count = self.cache.install_count
-            self.dl_size = self.cache.required_download
+            self.dl_size = self.cache.get_download_size()
             download_str = ""
             if self.dl_size != 0:
                 download_str = _("%s will be downloaded.") % (
                     humanize_size(self.dl_size))
                 self.image_downsize.set_sensitive(True)
-                # do not set the buttons to sensitive/insensitive until NM
-                # can deal with dialup connections properly
-                #if self.alert_watcher.network_state != NM_STATE_CONNECTED:
-                #    self.button_install.set_sensitive(False)
-                #else:
-                #    self.button_install.set_sensitive(True)
-                self.button_install.set_sensitive(True)
-                self.unity.set_install_menuitem_visible(True)
             else:
                 if inst_count > 0:
                     download_str = ngettext(
                         "The update has already been downloaded.",
                         "The updates have already been downloaded.",
                         inst_count)
-                    self.button_install.set_sensitive(True)
-                    self.unity.set_install_menuitem_visible(True)
                 else:
                     download_str = _("There are no updates to install.")
-                    self.button_install.set_sensitive(False)
-                    self.unity.set_install_menuitem_visible(False)
                 self.image_downsize.set_sensitive(False)
             self.label_downsize.set_text(download_str)
             self.hbox_downsize.show()
@@ -708,9 +759,34 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
             self.hbox_downsize.show()
             self.vbox_alerts.show()
 
+    def _on_refresh_count_timeout(self):
+        self._refresh_count_source = None
+        self._refresh_updates_count()
+        return False
+
+    def _cancel_refresh_updates_count(self):
+        if self._refresh_count_source is not None:
+            GLib.source_remove(self._refresh_count_source)
+            self._refresh_count_source = None
+
+    def _queue_refresh_updates_count(self):
+        """ refresh the download size once the selection did not change
+            for REFRESH_COUNT_DELAY ms, this is done in the main loop and
+            not in a thread because the depcache is not thread safe
+        """
+        self._cancel_refresh_updates_count()
+        self._refresh_count_source = GLib.timeout_add(
+            self.REFRESH_COUNT_DELAY, self._on_refresh_count_timeout)
+
     def updates_changed(self):
         self._mark_selected_updates()
-        self._refresh_updates_count()
+        # the install button follows the selection right away, only the
+        # (more expensive) download size waits for the burst to end
+        self._refresh_install_button()
+        self._queue_refresh_updates_count()
+
+    def _on_pane_destroy(self, widget):
+        self._cancel_refresh_updates_count()
 
     def update_count(self):
         """activate or disable widgets and show dialog texts correspoding to
@@ -829,17 +905,22 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
             self.hbox_offline.show()
             self.vbox_alerts.show()
             self.connected = False
+            self.cache.cancel_prefetch()
         # in doubt (STATE_UNKNOWN), assume connected
         elif (state in NetworkManagerHelper.NM_STATE_CONNECTED_LIST or
               state == NetworkManagerHelper.NM_STATE_UNKNOWN):
             self.updates_changed()
             self.hbox_offline.hide()
+            if not self.connected:
+                self.cache.prefetch_changelogs(
+                    [pkg.name for pkg in self.list.get_packages()])
             self.connected = True
             # trigger re-showing the current app to get changelog info (if
             # needed)
             self.on_treeview_update_cursor_changed(self.treeview_update)
         else:
             self.connected = False
+            self.cache.cancel_prefetch()
             self.label_offline.set_text(_("You may not be able to check for "
                                           "updates or download new updates."))
             self.updates_changed()
@@ -869,6 +950,8 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
         """ a toggle button in the listview was toggled """
         iter = self.store.get_iter(path)
         data = self.store.get_value(iter, LIST_UPDATE_DATA)
+        if data is PLACEHOLDER_DATA:
+            return False
         # make sure that we don't allow to toggle deactivated updates
         # this is needed for the call by the row activation callback
         if data.groups or data.group:
@@ -954,10 +1037,12 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
         header_row = [
             name,
             UpdateData(groups, None, None),
-            humanize_size(total_size),
+            self._get_size_string(total_size),
             True
         ]
-        return self.store.append(None, header_row)
+        header_iter = self.store.append(None, header_row)
+        self._header_rows.append([header_iter, groups, True])
+        return header_iter
 
     def _add_groups(self, groups):
         # Each row contains:
@@ -977,47 +1062,90 @@ class UpdatesAvailable(SimpleGtkbuilderApp):
             group_row = [
                 group.name,
                 UpdateData(None, group, group_is_item),
-                humanize_size(group.get_total_size()),
+                self._get_size_string(group.get_total_size()),
                 True
             ]
             group_iter = self.store.append(None, group_row)
+            self._group_rows[group] = [group_iter, len(group.items)]
 
+            for item in group.items:
+                self._item_rows[item] = [group, None, True]
             if group_is_item:
                 continue
-            for item in group.items:
-                item_row = [
-                    item.name,
-                    UpdateData(None, None, item),
-                    humanize_size(getattr(item.pkg.candidate, "size", 0)),
-                    True
-                ]
-                self.store.append(group_iter, item_row)
+            # the item rows are only created when the group is expanded
+            self.store.append(group_iter, ["", PLACEHOLDER_DATA, "", False])
+            self._collapsed_groups[group] = group_iter
+
+    def _add_items(self, group):
+        group_iter = self._collapsed_groups.pop(group)
+        placeholder = self.store.iter_children(group_iter)
+        for item in group.items:
+            item_row = [
+                item.name,
+                UpdateData(None, None, item),
+                self._get_size_string(item.attributes.size),
+                self._item_rows[item][2]
+            ]
+            self._item_rows[item][1] = self.store.append(group_iter, item_row)
+        self.store.remove(placeholder)
+
+    def on_treeview_update_test_expand_row(self, treeview, iter, path):
+        data = self.store.get_value(iter, LIST_UPDATE_DATA)
+        if data.group in self._collapsed_groups:
+            self._add_items(data.group)
+        return False
+
+    def _search_equal_func(self, model, column, key, iter, data=None):
+        """ the typeahead search of the tree view, it returns False for a
+            match. Like the default one it compares the start of the
+            names, a collapsed group (whose item rows GTK does not
+            search or that are not created yet) also matches the names
+            of its items
+        """
+        key = key.lower()
+        if model.get_value(iter, column).lower().startswith(key):
+            return False
+        data = model.get_value(iter, LIST_UPDATE_DATA)
+        if data.group is None:
+            return True
+        if self.treeview_update.row_expanded(model.get_path(iter)):
+            return True
+        return not any(item.name.lower().startswith(key)
+                       for item in data.group.items)
 
     def fillstore(self):
         # use the watch cursor
         self.setBusy(True)
-        # disconnect the view first
-        self.treeview_update.set_model(None)
-        self.store.clear()
-        # clean most objects
-        self.dl_size = 0
-
-        self.scrolledwindow_update.show()
-
-        # add security and update groups to self.store
-        if self.list.security_groups:
-            self._add_header(_("Security updates"), self.list.security_groups)
-            self._add_groups(self.list.security_groups)
-        if self.list.security_groups and self.list.update_groups:
-            self._add_header(_("Other updates"), self.list.update_groups)
-        if self.list.update_groups:
-            self._add_groups(self.list.update_groups)
-
-        self.treeview_update.set_model(self.store)
-        self.update_count()
+        with trace_span("fillstore"):
+            # a pending refresh of the old list is not needed anymore
+            self._cancel_refresh_updates_count()
+            # disconnect the view first
+            self.treeview_update.set_model(None)
+            self.store.clear()
+            self._reset_selection_rows()
+            # clean most objects
+            self.dl_size = 0
+
+            self.scrolledwindow_update.show()
+
+            # add security and update groups to self.store
+            if self.list.security_groups:
+                self._add_header(_("Security updates"),
+                                 self.list.security_groups)
+                self._add_groups(self.list.security_groups)
+            if self.list.security_groups and self.list.update_groups:
+                self._add_header(_("Other updates"), self.list.update_groups)
+            if self.list.update_groups:
+                self._add_groups(self.list.update_groups)
+
+            self.treeview_update.set_model(self.store)
+            self.update_count()
+        # fetch the changelogs in the background so that browsing them
+        # does not need to wait for the network
+        if self.connected:
+            self.cache.prefetch_changelogs(
+                [pkg.name for pkg in self.list.get_packages()])
         self.setBusy(False)
-        while Gtk.events_pending():
-            Gtk.main_iteration()
         self.updates_changed()
         return False
 
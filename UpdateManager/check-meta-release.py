@@ -20,11 +20,9 @@
 from __future__ import absolute_import, print_function
 
 from .Core.MetaRelease import MetaReleaseCore
-import time
 
 metaRelease = MetaReleaseCore(False, False)
-while metaRelease.downloading:
-    time.sleep(1)
+metaRelease.wait(metaRelease.timeout or None)
 print("no_longer_supported:" + str(metaRelease.no_longer_supported))
 if metaRelease.new_dist is None:
     print("new_dist_available:None")
@@ -0,0 +1,113 @@
+# ChangelogExport.py
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+#
+#  Copyright (c) 2013 Canonical
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+#
+# Non-interactive export of the changelogs of all pending updates, for
+# reviewing them without clicking through the packages one by one.
+
+from __future__ import print_function
+
+import io
+import os
+import sys
+
+from UpdateManager.Core.MyCache import MyCache
+from UpdateManager.Core.UpdateList import UpdateList
+
+
+def get_sources(cache, update_list):
+    """ return a sorted list of (source name, source version, binary
+        names) of the updates, every source version is listed once
+        even if several of its binaries (with maybe other versions,
+        like binNMUs) are updated
+    """
+    sources = {}
+    for group in update_list.update_groups + update_list.security_groups:
+        for item in group.items:
+            source = cache._get_changelog_source(item.pkg.name)
+            key = (source.srcpkg, source.srcver)
+            sources.setdefault(key, []).append(item.pkg.name)
+    return [(source, version, sorted(names))
+            for ((source, version), names) in sorted(sources.items())]
+
+
+def format_changes(cache, source, version, names):
+    " return the NEWS.Debian and changelog text of a source package "
+    # the changes are the same for all binaries of a source
+    name = names[0]
+    text = "%s (%s): %s\n\n" % (source, version, ", ".join(names))
+    text += cache.all_news.get(name, "")
+    text += cache.all_changes.get(name, "")
+    if not text.endswith("\n"):
+        text += "\n"
+    return text
+
+
+def export_changelogs(cache, update_list, directory=None, out=None):
+    """ fetch the changelogs of all updates and write one file per
+        source package to directory (or all of them to out). The
+        downloads run in parallel (see MyCache.prefetch_changelogs),
+        the results are written in order as soon as they are there
+
+        :return: the number of source packages
+    """
+    sources = get_sources(cache, update_list)
+    cache.prefetch_changelogs([names[0] for (s, v, names) in sources])
+    try:
+        for (source, version, names) in sources:
+            request = cache.fetch_news_and_changelog(names[0], None)
+            request.done.wait()
+            text = format_changes(cache, source, version, names)
+            if directory is None:
+                out.write(text + "\n")
+                out.flush()
+                continue
+            # like the pool, without the epoch
+            path = os.path.join(directory, "%s_%s.changelog" % (
+                source, version.split(":", 1)[-1]))
+            with io.open(path, "w", encoding="UTF-8") as f:
+                f.write(text)
+    finally:
+        cache.cancel_prefetch()
+    return len(sources)
+
+
+def main(target):
+    """ export the changelogs of the pending updates to target, a
+        directory, a file or "-" for stdout
+    """
+    try:
+        cache = MyCache(None)
+    except (AssertionError, SystemError) as e:
+        sys.stderr.write("can not open the package cache: %s\n" % e)
+        return 1
+    update_list = UpdateList(None, headless=True)
+    try:
+        update_list.update(cache)
+    except SystemError as e:
+        sys.stderr.write("can not calculate the upgrade: %s\n" % e)
+        return 1
+    if target == "-":
+        export_changelogs(cache, update_list, out=sys.stdout)
+    elif os.path.isdir(target):
+        export_changelogs(cache, update_list, directory=target)
+    else:
+        with io.open(target, "w", encoding="UTF-8") as f:
+            export_changelogs(cache, update_list, out=f)
+    return 0
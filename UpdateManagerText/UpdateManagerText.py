@@ -7,10 +7,9 @@ import apt
 import apt_pkg
 import operator
 import sys
-import threading
-import time
 from gettext import gettext as _
 
+from UpdateManager.Core.HttpClient import get_http_client
 from UpdateManager.Core.UpdateList import UpdateList
 from UpdateManager.Core.MyCache import MyCache
 
@@ -26,6 +25,9 @@ from snack import (SnackScreen,
 class UpdateManagerText(object):
     DEBUG = False
 
+    # seconds to wait for a changelog on top of the network timeout
+    CHANGELOG_WAIT_MARGIN = 5
+
     def __init__(self, datadir):
         self.screen = SnackScreen()
         # FIXME: self.screen.finish() clears the screen (and all messages)
@@ -100,11 +102,12 @@ This can be caused by:
 
     def updateSelectionStates(self):
         """
-        helper that goes over the cache and updates the selection
-        states in the UI based on the cache
+        helper that goes over the packages in the tree and updates the
+        selection states in the UI based on the cache
         """
-        for pkg in self.cache:
-            if pkg not in self.checkbox_tree_updates.item2key:
+        for pkg in list(self.checkbox_tree_updates.item2key):
+            # the headers are strings
+            if not hasattr(pkg, "name"):
                 continue
             # update based on the status
             if pkg.marked_upgrade or pkg.marked_install:
@@ -125,14 +128,13 @@ This can be caused by:
         if (name not in self.cache.all_changes and
                 name not in self.cache.all_news):
             self.textview_changes.setText(_("Downloading changelog"))
-            lock = threading.Lock()
-            lock.acquire()
-            changelog_thread = threading.Thread(
-                target=self.cache.get_news_and_changelog, args=(name, lock))
-            changelog_thread.start()
-            # this lock should never take more than 2s even with network down
-            while lock.locked():
-                time.sleep(0.03)
+            request = self.cache.fetch_news_and_changelog(name, None)
+            # a stalled download must not block the UI, it goes on in
+            # the background and is shown when the package is selected
+            # again
+            timeout = get_http_client().timeout + self.CHANGELOG_WAIT_MARGIN
+            if not request.done.wait(timeout):
+                return _("Downloading changelog")
 
         # build changes from NEWS and changelog
         if name in self.cache.all_news:
@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+#
+# Benchmark of the update calculation pipeline on a synthetic aptroot.
+# Every stage (MyCache.__init__, saveDistUpgrade, UpdateList.update
+# and its sub-stages, _make_groups, required_download, checkFreeSpace)
+# is timed, the results are written as JSON and can be compared with
+# a stored baseline:
+#
+#   ./benchmark.py --installed 3000 --upgradable 500 \
+#       --output result.json --baseline baseline.json
+#
+# The exit status is 1 if a stage got slower than the baseline allows.
+
+from __future__ import print_function
+
+import apt
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from UpdateManager.Core.MyCache import MyCache
+from UpdateManager.Core.UpdateList import DesktopFileIndex, UpdateList
+
+from synthetic_aptroot import make_benchmark_aptroot
+
+# the parameters of the synthetic aptroot
+PARAMETERS = {
+    "installed": 3000,
+    "upgradable": 500,
+    "fanout": 3,
+    "security": 0.1,
+    "phased": 0.05,
+    "desktop": 0.05,
+}
+
+
+class StageTimer(object):
+    """ collects the time spent in the stages of a single run """
+
+    def __init__(self):
+        self.times = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.times[name] = (self.times.get(name, 0.0) +
+                                time.time() - start)
+
+    def wrap(self, obj, method_name, name):
+        " time all calls of obj.method_name as stage name "
+        method = getattr(obj, method_name)
+
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return method(*args, **kwargs)
+        setattr(obj, method_name, wrapper)
+
+
+def run_once(aptroot, app_dir):
+    """ calculate the updates for aptroot once, return the StageTimer """
+    timer = StageTimer()
+    with timer.stage("MyCache.__init__"):
+        cache = MyCache(None, rootdir=aptroot)
+    timer.wrap(cache, "saveDistUpgrade", "saveDistUpgrade")
+    timer.wrap(cache, "get_upgradable_packages",
+               "UpdateList.update:upgradable")
+    update_list = UpdateList(None, dist="lucid", headless=True)
+    update_list.application_dirs = [app_dir]
+    update_list.desktop_file_index = DesktopFileIndex(
+        [app_dir], "/nonexistent", index_file=False)
+    timer.wrap(update_list, "_get_security_flags",
+               "UpdateList.update:security")
+    timer.wrap(update_list, "_get_phased_flags", "UpdateList.update:phasing")
+    timer.wrap(update_list, "_make_groups", "_make_groups")
+    with timer.stage("UpdateList.update"):
+        update_list.update(cache)
+    with timer.stage("required_download"):
+        cache.required_download
+    with timer.stage("checkFreeSpace"):
+        try:
+            cache.checkFreeSpace()
+        except Exception as e:
+            # the synthetic packages may not fit, that is fine here
+            logging.debug("checkFreeSpace: %s" % e)
+    return timer
+
+
+def summarize(runs):
+    " return the min/median/max of the runs per stage "
+    stages = {}
+    for name in sorted(set(name for run in runs for name in run)):
+        values = sorted(run.get(name, 0.0) for run in runs)
+        stages[name] = {"min": values[0],
+                        "median": values[len(values) // 2],
+                        "max": values[-1]}
+    return stages
+
+
+def run_benchmark(parameters, repeat=3, keep_aptroot=False):
+    """ run the benchmark on a new synthetic aptroot and return the
+        results as a json serializable dict
+    """
+    aptroot = tempfile.mkdtemp(prefix="update-manager-benchmark-")
+    try:
+        app_dir = make_benchmark_aptroot(aptroot, **parameters)
+        real_arch = apt.apt_pkg.config.find("APT::Architecture")
+        apt.apt_pkg.config.set("APT::Architecture", "amd64")
+        try:
+            runs = [run_once(aptroot, app_dir).times for i in range(repeat)]
+        finally:
+            apt.apt_pkg.config.set("APT::Architecture", real_arch)
+    finally:
+        if keep_aptroot:
+            print("aptroot: %s" % aptroot, file=sys.stderr)
+        else:
+            shutil.rmtree(aptroot)
+    return {"parameters": parameters,
+            "repeat": repeat,
+            "python": platform.python_version(),
+            "apt": apt.apt_pkg.VERSION,
+            "stages": summarize(runs)}
+
+
+def compare_results(results, baseline, tolerance=0.25, min_delta=0.005):
+    """ return a list of (stage, baseline time, time) for the stages that
+        are more than tolerance (relative) and min_delta (in seconds)
+        slower than in the baseline, the best run of each is compared
+    """
+    regressions = []
+    for (name, stage) in sorted(results["stages"].items()):
+        if name not in baseline.get("stages", {}):
+            continue
+        before = baseline["stages"][name]["min"]
+        now = stage["min"]
+        if now > before * (1 + tolerance) and now - before > min_delta:
+            regressions.append((name, before, now))
+    return regressions
+
+
+def main(argv=None):
+    parser = OptionParser()
+    for (key, default) in sorted(PARAMETERS.items()):
+        parser.add_option("--%s" % key, default=default, type=type(default),
+                          help="default: %s" % default)
+    parser.add_option("--repeat", default=3, type=int)
+    parser.add_option("--output", default=None,
+                      help="write the results to this file")
+    parser.add_option("--baseline", default=None,
+                      help="compare the results with this file")
+    parser.add_option("--save-baseline", action="store_true", default=False,
+                      help="store the results as new baseline")
+    parser.add_option("--tolerance", default=0.25, type=float,
+                      help="allowed slowdown relative to the baseline")
+    parser.add_option("--keep-aptroot", action="store_true", default=False)
+    (options, args) = parser.parse_args(argv)
+
+    parameters = dict((key, getattr(options, key)) for key in PARAMETERS)
+    results = run_benchmark(parameters, options.repeat, options.keep_aptroot)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if not options.baseline:
+        return 0
+    if options.save_baseline:
+        with open(options.baseline, "w") as f:
+            f.write(output + "\n")
+        return 0
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("parameters") != parameters:
+        print("warning: the baseline was made with other parameters",
+              file=sys.stderr)
+    regressions = compare_results(results, baseline, options.tolerance)
+    for (name, before, now) in regressions:
+        print("REGRESSION %s: %0.3fs -> %0.3fs" % (name, before, now),
+              file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+#
+# Helper to create large synthetic aptroots for the benchmarks, the
+# aptroot-* directories in the tests dir are too small for that.
+
+import os
+import random
+
+RELEASE = """Origin: Ubuntu
+Label: Ubuntu
+Suite: %(suite)s
+Version: 10.04
+Codename: %(dist)s
+Date: Thu, 29 Apr 2010 17:24:55 UTC
+Architectures: amd64 armel i386 ia64 powerpc sparc
+Components: main restricted universe multiverse
+Description: Ubuntu Lucid 10.04
+"""
+
+STANZA = """Package: %(name)s
+Priority: optional
+Section: admin
+Installed-Size: 1
+Maintainer: Foo <foo@bar.com>
+Architecture: all
+Version: %(version)s
+Filename: pool/main/%(name)s_%(version)s_all.deb
+Size: %(size)s
+Description: synthetic package %(name)s
+Origin: Ubuntu
+
+"""
+
+STATUS = """Package: %(name)s
+Status: install ok installed
+Priority: optional
+Section: admin
+Installed-Size: 1
+Maintainer: Foo <foo@bar.com>
+Architecture: all
+Version: %(version)s
+Description: synthetic package %(name)s
+
+"""
+
+
+def package_name(i):
+    return "synthetic-pkg-%05d" % i
+
+
+def make_aptroot(rootdir, nr_pkgs, dist="lucid"):
+    """ create a aptroot with nr_pkgs installed packages in rootdir:
+         - every third package has an update (1.1) in dist-security
+         - every second package has an update (1.2) in dist-updates
+         - every fifth package has the security version installed already
+
+        :return: the set of the names of the packages that have a
+                 (not yet installed) security update
+    """
+    lists_dir = os.path.join(rootdir, "var", "lib", "apt", "lists")
+    for d in [os.path.join(rootdir, "etc", "apt"),
+              os.path.join(lists_dir, "partial"),
+              os.path.join(rootdir, "var", "cache", "apt", "archives",
+                           "partial"),
+              os.path.join(rootdir, "var", "lib", "dpkg")]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+    suites = [dist, "%s-security" % dist, "%s-updates" % dist]
+    with open(os.path.join(rootdir, "etc", "apt", "sources.list"), "w") as f:
+        for suite in suites:
+            f.write("deb http://archive.ubuntu.com/ubuntu %s main\n" % suite)
+    open(os.path.join(lists_dir, "lock"), "w").close()
+
+    packages = dict((suite, []) for suite in suites)
+    status = []
+    security_pkgs = set()
+    for i in range(nr_pkgs):
+        name = package_name(i)
+        installed = "1.1" if i % 5 == 0 else "1.0"
+        packages[dist].append((name, "1.0"))
+        if i % 3 == 0:
+            packages["%s-security" % dist].append((name, "1.1"))
+            if installed == "1.0":
+                security_pkgs.add(name)
+        if i % 2 == 0:
+            packages["%s-updates" % dist].append((name, "1.2"))
+        status.append(STATUS % {"name": name, "version": installed})
+
+    prefix = os.path.join(lists_dir, "archive.ubuntu.com_ubuntu_dists_")
+    for suite in suites:
+        with open(prefix + "%s_Release" % suite, "w") as f:
+            f.write(RELEASE % {"suite": suite, "dist": dist})
+        with open(prefix + "%s_main_binary-amd64_Packages" % suite,
+                  "w") as f:
+            for (name, version) in packages[suite]:
+                f.write(STANZA % {"name": name, "version": version,
+                                  "size": 1000})
+    with open(os.path.join(rootdir, "var", "lib", "dpkg", "status"),
+              "w") as f:
+        f.write("".join(status))
+    return security_pkgs
+
+
+def make_benchmark_aptroot(rootdir, installed, upgradable, fanout=2,
+                           security=0.1, phased=0.05, desktop=0.05,
+                           dist="lucid", seed=0):
+    """ create a aptroot in rootdir for the benchmarks:
+         - installed packages, the first upgradable of them have an
+           update in dist-updates or (for the given share of them)
+           in dist-security
+         - the given share of the updates in dist-updates is phased
+         - every package depends on up to fanout other packages
+         - the given share of the packages ships a .desktop file in
+           rootdir/usr/share/applications
+
+        :return: the application dir of the aptroot
+    """
+    rand = random.Random(seed)
+    lists_dir = os.path.join(rootdir, "var", "lib", "apt", "lists")
+    info_dir = os.path.join(rootdir, "var", "lib", "dpkg", "info")
+    app_dir = os.path.join(rootdir, "usr", "share", "applications")
+    for d in [os.path.join(rootdir, "etc", "apt"),
+              os.path.join(lists_dir, "partial"),
+              os.path.join(rootdir, "var", "cache", "apt", "archives",
+                           "partial"),
+              info_dir, app_dir]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+    suites = [dist, "%s-security" % dist, "%s-updates" % dist]
+    with open(os.path.join(rootdir, "etc", "apt", "sources.list"), "w") as f:
+        for suite in suites:
+            f.write("deb http://archive.ubuntu.com/ubuntu %s main\n" % suite)
+    open(os.path.join(lists_dir, "lock"), "w").close()
+
+    packages = dict((suite, []) for suite in suites)
+    status = []
+    for i in range(installed):
+        name = package_name(i)
+        # only depend on packages with a higher index, that gives
+        # deep dependency chains but no loops
+        deps = set()
+        if i + 1 < installed:
+            for j in range(rand.randint(0, fanout)):
+                deps.add(package_name(rand.randint(i + 1, installed - 1)))
+        extra = ""
+        if deps:
+            extra = "Depends: %s\n" % ", ".join(sorted(deps))
+        status.append((STATUS % {"name": name, "version": "1.0"}).replace(
+            "Version:", extra + "Version:"))
+        packages[dist].append((name, "1.0", extra))
+        if i < upgradable:
+            if rand.random() < security:
+                packages["%s-security" % dist].append((name, "1.1", extra))
+            else:
+                if rand.random() < phased:
+                    extra += "Phased-Update-Percentage: 50\n"
+                packages["%s-updates" % dist].append((name, "1.1", extra))
+        if rand.random() < desktop:
+            desktop_file = os.path.join(app_dir, name + ".desktop")
+            with open(desktop_file, "w") as f:
+                f.write("[Desktop Entry]\nType=Application\n"
+                        "Name=%s\nIcon=%s\nExec=%s\n" % (name, name, name))
+            with open(os.path.join(info_dir, name + ".list"), "w") as f:
+                f.write("/.\n/usr\n/usr/bin/%s\n%s\n" % (name, desktop_file))
+
+    prefix = os.path.join(lists_dir, "archive.ubuntu.com_ubuntu_dists_")
+    for suite in suites:
+        with open(prefix + "%s_Release" % suite, "w") as f:
+            f.write(RELEASE % {"suite": suite, "dist": dist})
+        with open(prefix + "%s_main_binary-amd64_Packages" % suite,
+                  "w") as f:
+            for (name, version, extra) in packages[suite]:
+                stanza = STANZA % {"name": name, "version": version,
+                                   "size": 1000}
+                f.write(stanza.replace("Version:", extra + "Version:"))
+    with open(os.path.join(rootdir, "var", "lib", "dpkg", "status"),
+              "w") as f:
+        f.write("".join(status))
+    return app_dir
@@ -0,0 +1,40 @@
+#!/usr/bin/python3
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+
+import json
+import unittest
+
+from benchmark import compare_results, run_benchmark, summarize
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_summarize(self):
+        stages = summarize([{"a": 3.0, "b": 1.0}, {"a": 1.0}, {"a": 2.0}])
+        self.assertEqual(stages["a"], {"min": 1.0, "median": 2.0, "max": 3.0})
+        # a stage that did not run counts as 0
+        self.assertEqual(stages["b"]["min"], 0.0)
+
+    def test_compare(self):
+        baseline = {"stages": {"a": {"min": 1.0}, "b": {"min": 0.001},
+                               "c": {"min": 1.0}}}
+        results = {"stages": {"a": {"min": 1.5}, "b": {"min": 0.003},
+                              "c": {"min": 1.1}, "d": {"min": 9.0}}}
+        # "b" is slower, but not by enough to be measured reliably
+        # and "d" is not in the baseline
+        self.assertEqual(compare_results(results, baseline),
+                         [("a", 1.0, 1.5)])
+
+    def test_small_run(self):
+        parameters = {"installed": 50, "upgradable": 20, "fanout": 2,
+                      "security": 0.2, "phased": 0.2, "desktop": 0.2}
+        results = run_benchmark(parameters, repeat=1)
+        for stage in ["MyCache.__init__", "saveDistUpgrade",
+                      "UpdateList.update", "UpdateList.update:security",
+                      "_make_groups", "required_download"]:
+            self.assertIn(stage, results["stages"])
+        json.dumps(results)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,12 +4,24 @@
 import apt
 import logging
 import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
-from mock import Mock
+from mock import Mock, patch
+try:
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import HTTPError
 
-from UpdateManager.Core.MyCache import MyCache
+from UpdateManager.Core.MyCache import (ChangelogPrefetcher,
+                                        ChangelogRequest, ChangelogSource,
+                                        MyCache)
+
+from synthetic_aptroot import make_aptroot, package_name
 
 CURDIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -44,14 +56,286 @@ class TestCache(unittest.TestCase):
         mock = Mock()
         mock.return_value = uri
         self.cache._guess_third_party_changelogs_uri_by_source = mock
-        self.cache.all_changes[pkgname] = "header\n"
-        self.cache._fetch_changelog_for_third_party_package(pkgname)
         self.assertEqual(
-            self.cache.all_changes[pkgname],
-            "header\n"
+            self.cache._fetch_changelog_for_third_party_package(pkgname),
             "This update does not come from a source that supports "
             "changelogs.")
 
+    def test_third_party_changes_complete(self):
+        # the changes are only visible once they are complete
+        started = threading.Event()
+        finish = threading.Event()
+
+        def download(name, fname, strict_versioning, changelogs_uri):
+            started.set()
+            finish.wait()
+            return "changes of %s\n" % changelogs_uri
+        self.cache._get_changelog_source = lambda name: ChangelogSource(
+            name, "src", "1.0", "main", "0.9", "1.0", ["Other"], None, None)
+        self.cache._guess_third_party_changelogs_uri_by_binary = \
+            lambda name: "binary-uri"
+        self.cache._guess_third_party_changelogs_uri_by_source = \
+            lambda name: None
+        self.cache._get_changelog_or_news = download
+        thread = threading.Thread(target=self.cache.get_changelog,
+                                  args=("pkg",))
+        thread.start()
+        started.wait()
+        self.assertNotIn("pkg", self.cache.all_changes)
+        finish.set()
+        thread.join()
+        self.assertTrue(self.cache.all_changes["pkg"].startswith(
+            "Changes for pkg versions:\n"))
+        self.assertTrue(self.cache.all_changes["pkg"].endswith(
+            "\n\nchanges of binary-uri\n"))
+
+    def test_source_file_coalescing(self):
+        # binaries of the same source wait for one download
+        started = threading.Event()
+        finish = threading.Event()
+        downloads = []
+
+        def download(name, fname, strict_versioning=False):
+            downloads.append(name)
+            started.set()
+            finish.wait()
+            return "changes"
+        self.cache._get_changelog_or_news = download
+        self.cache._get_source_key = lambda name: ("src", "1.0", "0.9")
+        results = []
+        threads = [threading.Thread(
+            target=lambda name: results.append(
+                self.cache._get_source_file(name, "changelog")),
+            args=(name,)) for name in ["bin1", "bin2", "bin3"]]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        finish.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(downloads, ["bin1"])
+        self.assertEqual(results, ["changes"] * 3)
+        # and later requests are answered from the store
+        self.assertEqual(self.cache._get_source_file("bin4", "changelog"),
+                         "changes")
+        self.assertEqual(len(downloads), 1)
+
+    def test_source_file_missing(self):
+        # a NEWS.Debian that is not there is asked for once per source
+        downloads = []
+
+        def download(name, fname, strict_versioning=False):
+            downloads.append(name)
+            raise HTTPError("uri", 404, "Not Found", {}, None)
+        self.cache._get_changelog_or_news = download
+        self.cache._get_source_key = lambda name: ("src", "1.0", "0.9")
+        for name in ["bin1", "bin2", "bin3"]:
+            self.cache.get_news(name)
+        self.assertEqual(downloads, ["bin1"])
+        self.assertEqual(self.cache.all_news, {})
+
+    def test_changelog_source(self):
+        # the packages are looked up when the prefetch is started, the
+        # download threads do not read the package records
+        self.cache.prefetch_changelogs(["apt"], workers=0)
+        with patch.object(ChangelogSource, "from_package",
+                          side_effect=AssertionError):
+            source = self.cache._get_changelog_source("apt")
+        candidate = self.cache["apt"].candidate
+        self.assertEqual(source.srcpkg, candidate.source_name)
+        self.assertEqual(source.version, candidate.version)
+
+    def test_request_finished_on_error(self):
+        # the waiters of a request are released whatever goes wrong
+        request = ChangelogRequest("apt", None)
+        with patch.object(self.cache, "get_news"):
+            with patch.object(self.cache, "get_changelog",
+                              side_effect=ValueError):
+                self.cache._fetch_news_and_changelog(request)
+        self.assertTrue(request.done.is_set())
+        self.assertIsNone(self.cache._changelog_local.request)
+
+
+class TestChangelogSource(unittest.TestCase):
+
+    def make_package(self, version, source_field):
+        pkg = Mock()
+        pkg.name = "bin"
+        pkg.candidate.source_name = "src"
+        pkg.candidate.version = version
+        pkg.candidate.origins = []
+        pkg.candidate.record = {"Source": source_field} if source_field else {}
+        return pkg
+
+    def test_source_version(self):
+        # a binNMU is coalesced with the other binaries of its source
+        source = ChangelogSource.from_package(
+            self.make_package("1:1.0-1build1", "src (1:1.0-1)"))
+        self.assertEqual(source.srcver, "1:1.0-1")
+        self.assertEqual(source.version, "1:1.0-1build1")
+        # without a version in the record both are the same
+        for field in ["src", None]:
+            source = ChangelogSource.from_package(
+                self.make_package("1.0-1", field))
+            self.assertEqual(source.srcver, "1.0-1")
+
+
+class FakeChangelogCache(object):
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.fetched = []
+        self.lock = threading.Lock()
+
+    def get_news(self, name):
+        pass
+
+    def get_changelog(self, name):
+        time.sleep(self.delay)
+        with self.lock:
+            self.fetched.append(name)
+
+
+class TestUpgradablePackages(unittest.TestCase):
+
+    def setUp(self):
+        real_arch = apt.apt_pkg.config.find("APT::Architecture")
+        apt.apt_pkg.config.set("APT::Architecture", "amd64")
+        self.addCleanup(
+            lambda: apt.apt_pkg.config.set("APT::Architecture", real_arch))
+        self.aptroot = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.aptroot)
+        make_aptroot(self.aptroot, 300)
+        self.cache = MyCache(None, rootdir=self.aptroot)
+        self.cache.saveDistUpgrade()
+
+    def assertSameAsFullScan(self):
+        pkgs = []
+        held_back = []
+        for pkg in self.cache:
+            if pkg.is_upgradable or pkg.marked_install:
+                pkgs.append(pkg.name)
+            if pkg.is_upgradable and not (pkg.marked_upgrade or
+                                          pkg.marked_install):
+                held_back.append(pkg.name)
+        (upgradable, held) = self.cache.get_upgradable_packages()
+        self.assertEqual([pkg.name for pkg in upgradable], pkgs)
+        self.assertEqual(sorted(held), held_back)
+
+    def test_upgradable(self):
+        self.assertSameAsFullScan()
+        self.assertEqual(self.cache.get_upgradable_packages()[1], [])
+
+    def test_held_back(self):
+        self.cache[package_name(0)].mark_keep()
+        self.cache[package_name(2)].mark_keep()
+        self.assertSameAsFullScan()
+        self.assertEqual(self.cache.get_upgradable_packages()[1],
+                         [package_name(0), package_name(2)])
+
+    def test_download_size(self):
+        size = self.cache.get_download_size()
+        self.assertGreater(size, 0)
+        self.assertEqual(size, self.cache.required_download)
+        # a downloaded candidate does not count
+        pkg = self.cache[package_name(2)]
+        archives = os.path.join(self.aptroot, "var", "cache", "apt",
+                                "archives")
+        with open(os.path.join(archives, "%s_%s_all.deb" % (
+                pkg.name, pkg.candidate.version)), "wb") as f:
+            f.write(b"x" * pkg.candidate.size)
+        self.cache.open()
+        self.cache.saveDistUpgrade()
+        self.assertEqual(self.cache.get_download_size(),
+                         size - pkg.candidate.size)
+        # and the size follows the selection
+        pkg = self.cache[package_name(4)]
+        pkg.mark_keep()
+        self.assertEqual(self.cache.get_download_size(),
+                         size - 2 * pkg.candidate.size)
+
+    def test_marks_serial(self):
+        serial = self.cache.marks_serial
+        self.cache[package_name(0)].mark_keep()
+        self.assertGreater(self.cache.marks_serial, serial)
+        serial = self.cache.marks_serial
+        self.cache.clear()
+        self.assertGreater(self.cache.marks_serial, serial)
+        serial = self.cache.marks_serial
+        self.cache.saveDistUpgrade()
+        self.assertGreater(self.cache.marks_serial, serial)
+
+
+class TestChangelogPrefetcher(unittest.TestCase):
+
+    def test_prefetch_all(self):
+        cache = FakeChangelogCache()
+        names = ["pkg%s" % i for i in range(20)]
+        prefetcher = ChangelogPrefetcher(cache, names, 4)
+        for thread in prefetcher._threads:
+            thread.join()
+        self.assertEqual(sorted(cache.fetched), sorted(names))
+        self.assertTrue(prefetcher.is_done("pkg0"))
+
+    def test_boost(self):
+        cache = FakeChangelogCache(delay=0.01)
+        names = ["pkg%s" % i for i in range(20)]
+        prefetcher = ChangelogPrefetcher(cache, names, 1)
+        lock = threading.Lock()
+        lock.acquire()
+        self.assertTrue(prefetcher.boost("pkg19", lock))
+        self.assertFalse(prefetcher.boost("not-an-update"))
+        # released as soon as pkg19 is fetched
+        lock.acquire()
+        self.assertTrue(cache.fetched.index("pkg19") < 5)
+        prefetcher.cancel()
+
+    def test_boost_done(self):
+        cache = FakeChangelogCache()
+        prefetcher = ChangelogPrefetcher(cache, ["pkg0"], 1)
+        for thread in prefetcher._threads:
+            thread.join()
+        # the callback of a fetched name is called right away, without
+        # holding the lock of the prefetcher
+        locked = []
+        self.assertTrue(prefetcher.boost(
+            "pkg0", callback=lambda: locked.append(prefetcher._lock.locked())))
+        self.assertEqual(locked, [False])
+
+    def test_cancel(self):
+        cache = FakeChangelogCache(delay=0.01)
+        names = ["pkg%s" % i for i in range(20)]
+        prefetcher = ChangelogPrefetcher(cache, names, 2)
+        lock = threading.Lock()
+        lock.acquire()
+        prefetcher.boost("pkg19", lock)
+        prefetcher.cancel()
+        # waiters are released on cancel
+        lock.acquire()
+        for thread in prefetcher._threads:
+            thread.join()
+        self.assertTrue(len(cache.fetched) < len(names))
+        self.assertFalse(prefetcher.boost("pkg18"))
+
+    def test_request(self):
+        cache = FakeChangelogCache(delay=0.01)
+        names = ["pkg%s" % i for i in range(20)]
+        prefetcher = ChangelogPrefetcher(cache, names, 1)
+        results = []
+        request = ChangelogRequest("pkg19", results.append)
+        stale_request = ChangelogRequest("pkg18", results.append)
+        self.assertTrue(prefetcher.boost("pkg19", callback=request.finish))
+        self.assertTrue(prefetcher.boost("pkg18",
+                                         callback=stale_request.finish))
+        stale_request.cancel()
+        request.done.wait()
+        stale_request.done.wait()
+        # the result of the cancelled request is dropped
+        self.assertEqual(results, [request])
+        prefetcher.cancel()
+
+
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == "-v":
         logging.basicConfig(level=logging.DEBUG)
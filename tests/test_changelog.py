@@ -2,16 +2,24 @@
 # -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
 
 import apt
+import gzip
+import io
 import logging
 import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
 import unittest
 try:
     from urllib.error import HTTPError
 except ImportError:
     from urllib2 import HTTPError
 
-from UpdateManager.Core.MyCache import MyCache
+from UpdateManager.Core.MyCache import (ChangelogCancelledError,
+                                        ChangelogReader, ChangelogRequest,
+                                        MyCache)
 
 CURDIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -75,6 +83,125 @@ class TestChangelogs(unittest.TestCase):
         self.assertEqual(self.cache.all_changes[pkgname].count(error), 1)
         self.cache.CHANGELOG_ORIGIN = real_origin
 
+
+def make_changelog(path, srcpkg, versions):
+    """ write a changelog with one entry for each of the given versions """
+    with open(path, "w") as f:
+        for ver in versions:
+            f.write("%s (%s) lucid; urgency=low\n\n" % (srcpkg, ver))
+            for i in range(5):
+                f.write("  * Fix bug number %s in this upload, with a long "
+                        "enough line to look real. (LP: #%s)\n" % (i, i))
+            f.write("\n -- Some Developer <dev@example.com>  "
+                    "Thu, 29 Apr 2010 17:24:55 +0200\n\n")
+
+
+class CountingFile(io.BytesIO):
+    """ file object that counts how many bytes got read """
+
+    def __init__(self, data):
+        io.BytesIO.__init__(self, data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = io.BytesIO.read(self, size)
+        self.bytes_read += len(data)
+        return data
+
+
+class TestChangelogParsing(unittest.TestCase):
+    """ benchmark style tests against a multi-megabyte changelog """
+
+    def setUp(self):
+        real_arch = apt.apt_pkg.config.find("APT::Architecture")
+        apt.apt_pkg.config.set("APT::Architecture", "amd64")
+        self.addCleanup(
+            lambda: apt.apt_pkg.config.set("APT::Architecture", real_arch))
+        aptroot = os.path.join(CURDIR, "aptroot-changelog")
+        self.cache = MyCache(apt.progress.base.OpProgress(), rootdir=aptroot)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        # ~5MB, the oldest entry is the installed version of "gcc"
+        self.changelog = os.path.join(self.tmpdir, "changelog")
+        versions = ["1.%s" % i for i in range(10000, 0, -1)] + ["0.1"]
+        make_changelog(self.changelog, "gcc-defaults", versions)
+        with open(self.changelog, "rb") as f:
+            self.data = f.read()
+        self.assertGreater(len(self.data), 4 * 1000 * 1000)
+
+    def test_large_changelog(self):
+        uri = "file://%s" % self.changelog
+        start = time.time()
+        changelog = self.cache._get_changelog_or_news(
+            "gcc", "changelog", changelogs_uri=uri)
+        logging.debug("parsed %s bytes in %ss" % (len(self.data),
+                                                  time.time() - start))
+        # everything but the installed version
+        self.assertTrue(changelog.startswith("gcc-defaults (1.10000)"))
+        self.assertFalse("gcc-defaults (0.1)" in changelog)
+        self.assertEqual(changelog.count("gcc-defaults ("), 10000)
+
+    def test_early_stop(self):
+        fileobj = CountingFile(self.data)
+        reader = ChangelogReader(fileobj)
+        (text, stopped) = self.cache._parse_changelog(
+            reader, "gcc-defaults", "1.9990")
+        self.assertTrue(stopped)
+        self.assertFalse(reader.eof)
+        self.assertEqual(text.count("gcc-defaults ("), 10)
+        # only the start of the file was read
+        self.assertLess(fileobj.bytes_read, len(self.data) / 100)
+        self.assertTrue(self.data.startswith(reader.get_data()))
+
+    def test_strict_versioning(self):
+        reader = ChangelogReader(io.BytesIO(self.data))
+        (text, stopped) = self.cache._parse_changelog(
+            reader, "gcc-defaults", "1:1.9990.5", strict_versioning=True)
+        self.assertTrue(stopped)
+        self.assertEqual(text.count("gcc-defaults ("), 10)
+
+    def test_gzip(self):
+        compressed = io.BytesIO()
+        with gzip.GzipFile(fileobj=compressed, mode="wb") as f:
+            f.write(self.data)
+        reader = ChangelogReader(io.BytesIO(compressed.getvalue()),
+                                 gzipped=True)
+        (text, stopped) = self.cache._parse_changelog(
+            reader, "gcc-defaults", None)
+        self.assertFalse(stopped)
+        self.assertTrue(reader.eof)
+        self.assertEqual(text.encode("UTF-8"), self.data)
+
+    def test_prefix(self):
+        # continue a partial download
+        cut = self.data.index(b"\n", len(self.data) // 2) + 1
+        reader = ChangelogReader(io.BytesIO(self.data[cut:]),
+                                 prefix=self.data[:cut])
+        (text, stopped) = self.cache._parse_changelog(
+            reader, "gcc-defaults", "0.1")
+        self.assertTrue(stopped)
+        self.assertEqual(text.count("gcc-defaults ("), 10000)
+
+    def test_cancel(self):
+        cancelled = threading.Event()
+        reader = ChangelogReader(io.BytesIO(self.data), cancelled=cancelled)
+        reader.readline()
+        cancelled.set()
+        self.assertRaises(ChangelogCancelledError,
+                          self.cache._parse_changelog, reader,
+                          "gcc-defaults", None)
+        # a cancelled request does not start the download
+        request = ChangelogRequest("gcc", None)
+        request.cancel()
+        self.cache._changelog_local.request = request
+        self.addCleanup(setattr, self.cache._changelog_local, "request",
+                        None)
+        self.assertRaises(ChangelogCancelledError,
+                          self.cache._get_changelog_or_news, "gcc",
+                          "changelog",
+                          changelogs_uri="file://%s" % self.changelog)
+
+
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == "-v":
         logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from mock import patch
+
+from UpdateManager.Core.ChangelogCache import (ChangelogCache,
+                                               ChangelogCacheEntry)
+
+
+class TestChangelogCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache = ChangelogCache(self.tmpdir, max_size=1000,
+                                    max_age=60)
+
+    def test_store_and_lookup(self):
+        self.assertEqual(self.cache.lookup("gcc", "1.0", "changelog"), None)
+        entry = ChangelogCacheEntry(b"gcc (1.0) lucid; urgency=low\n",
+                                    etag='"abc"')
+        self.cache.store("gcc", "1.0", "changelog", entry)
+        entry = self.cache.lookup("gcc", "1.0", "changelog")
+        self.assertEqual(entry.data, b"gcc (1.0) lucid; urgency=low\n")
+        self.assertEqual(entry.etag, '"abc"')
+        self.assertTrue(self.cache.is_fresh(entry))
+        # other files of the same source are separate entries
+        self.assertEqual(self.cache.lookup("gcc", "1.0", "NEWS.Debian"),
+                         None)
+
+    def test_revalidate(self):
+        entry = ChangelogCacheEntry(b"data")
+        self.cache.store("apt", "0.8", "changelog", entry)
+        entry.validated = time.time() - 120
+        self.cache.revalidated("apt", "0.8", "changelog", entry)
+        entry = self.cache.lookup("apt", "0.8", "changelog")
+        self.assertTrue(self.cache.is_fresh(entry))
+        entry.validated = time.time() - 120
+        self.assertFalse(self.cache.is_fresh(entry))
+
+    def test_lru_eviction(self):
+        for i, name in enumerate(["a", "b", "c"]):
+            entry = ChangelogCacheEntry(b"x" * 400)
+            self.cache.store(name, "1", "changelog", entry)
+            # make sure the lru order does not depend on the fs
+            # timestamp granularity
+            path = self.cache._path(name, "1", "changelog")
+            os.utime(path, (i, i))
+        # "a" was the oldest, so it got evicted when "c" was added
+        self.assertEqual(self.cache.lookup("a", "1", "changelog"), None)
+        self.assertNotEqual(self.cache.lookup("b", "1", "changelog"), None)
+        self.assertNotEqual(self.cache.lookup("c", "1", "changelog"), None)
+
+    def test_key_quoting(self):
+        entry = ChangelogCacheEntry(b"data")
+        self.cache.store("../evil", "1:2.0", "changelog", entry)
+        path = self.cache._path("../evil", "1:2.0", "changelog")
+        self.assertEqual(os.path.dirname(path), self.tmpdir)
+        self.assertTrue(os.path.exists(path))
+        self.assertNotEqual(
+            self.cache.lookup("../evil", "1:2.0", "changelog"), None)
+
+    def test_failed_write(self):
+        entry = ChangelogCacheEntry(b"old")
+        self.cache.store("gcc", "1.0", "changelog", entry)
+        # a failed write keeps the old entry and no temporary files
+        with patch("os.rename", side_effect=OSError("disk full")):
+            self.cache.store("gcc", "1.0", "changelog",
+                             ChangelogCacheEntry(b"new"))
+        self.assertEqual(self.cache.lookup("gcc", "1.0", "changelog").data,
+                         b"old")
+        self.assertEqual([name for name in os.listdir(self.tmpdir)
+                          if name.startswith(".")], [])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "-v":
+        logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
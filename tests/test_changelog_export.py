@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mock import Mock
+
+from UpdateManager.Core.MyCache import ChangelogSource
+from UpdateManagerText.ChangelogExport import export_changelogs, get_sources
+
+
+class FakeRequest(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.done.set()
+
+
+class FakeCache(object):
+
+    def __init__(self):
+        self.all_news = {"a": "news of a\n"}
+        self.all_changes = {}
+        self.prefetched = None
+        self.fetched = []
+        self.sources = {}
+
+    def prefetch_changelogs(self, names):
+        self.prefetched = names
+
+    def cancel_prefetch(self):
+        pass
+
+    def _get_changelog_source(self, name):
+        return self.sources[name]
+
+    def fetch_news_and_changelog(self, name, callback):
+        self.fetched.append(name)
+        self.all_changes[name] = "changes of %s\n" % name
+        return FakeRequest()
+
+
+def make_item(cache, name, source, version="1.0", srcver=None):
+    cache.sources[name] = ChangelogSource(
+        name, source, srcver or version, "main", None, version, [], None,
+        None)
+    item = Mock()
+    item.pkg.name = name
+    item.pkg.candidate.version = version
+    item.attributes.source_name = source
+    return item
+
+
+class TestChangelogExport(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = FakeCache()
+        group = Mock()
+        # libb is a binNMU of src-b
+        group.items = [make_item(self.cache, "a", "src-a"),
+                       make_item(self.cache, "b", "src-b"),
+                       make_item(self.cache, "libb", "src-b", "1.0+b1",
+                                 "1.0")]
+        security_group = Mock()
+        security_group.items = [make_item(self.cache, "c", "src-c", "1:2.0")]
+        self.update_list = Mock()
+        self.update_list.update_groups = [group]
+        self.update_list.security_groups = [security_group]
+
+    def test_sources(self):
+        self.assertEqual(get_sources(self.cache, self.update_list),
+                         [("src-a", "1.0", ["a"]),
+                          ("src-b", "1.0", ["b", "libb"]),
+                          ("src-c", "1:2.0", ["c"])])
+
+    def test_directory(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.assertEqual(
+            export_changelogs(self.cache, self.update_list, directory), 3)
+        # one download per source package
+        self.assertEqual(self.cache.prefetched, ["a", "b", "c"])
+        self.assertEqual(self.cache.fetched, ["a", "b", "c"])
+        self.assertEqual(sorted(os.listdir(directory)),
+                         ["src-a_1.0.changelog", "src-b_1.0.changelog",
+                          "src-c_2.0.changelog"])
+        with io.open(os.path.join(directory, "src-a_1.0.changelog")) as f:
+            self.assertEqual(f.read(), "src-a (1.0): a\n\n"
+                                       "news of a\nchanges of a\n")
+        with io.open(os.path.join(directory, "src-b_1.0.changelog")) as f:
+            self.assertTrue(f.read().startswith("src-b (1.0): b, libb\n"))
+
+    def test_stream(self):
+        out = io.StringIO()
+        export_changelogs(self.cache, self.update_list, out=out)
+        text = out.getvalue()
+        self.assertLess(text.index("changes of a"), text.index("changes of b"))
+        self.assertIn("src-c (1:2.0): c\n\nchanges of c\n", text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+
+import os
+import threading
+import unittest
+try:
+    from urllib.error import HTTPError
+    from urllib.request import Request
+except ImportError:
+    from urllib2 import HTTPError, Request
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
+
+from UpdateManager.Core.HttpClient import HttpClient
+from UpdateManager.Core.utils import HeadRequest
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        self.server.requests.append((self.command, self.path))
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/file")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path != "/file":
+            self.send_error(404)
+            return
+        if self.headers.get("If-None-Match") == "etag":
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = b"x" * 1000
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", "etag")
+        self.end_headers()
+        if self.command == "GET":
+            self.wfile.write(body)
+    do_HEAD = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class KeepAliveServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestHttpClient(unittest.TestCase):
+
+    def setUp(self):
+        # no proxy for the local server
+        for key in ["http_proxy", "HTTP_PROXY"]:
+            if key in os.environ:
+                self.addCleanup(os.environ.__setitem__, key, os.environ[key])
+                del os.environ[key]
+        self.server = KeepAliveServer(("localhost", 0), KeepAliveHandler)
+        self.server.connections = set()
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.client = HttpClient(timeout=5)
+        self.addCleanup(self.client.close)
+        self.url = "http://localhost:%s" % self.server.server_address[1]
+
+    def test_keep_alive(self):
+        for i in range(5):
+            response = self.client.open(self.url + "/file")
+            self.assertEqual(response.code, 200)
+            self.assertEqual(len(response.read()), 1000)
+            response.close()
+        response = self.client.open(HeadRequest(self.url + "/file"))
+        self.assertEqual(response.info().get("ETag"), "etag")
+        response.close()
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_partial_read(self):
+        # a connection with unread data is not reused
+        response = self.client.open(self.url + "/file")
+        response.read(10)
+        response.close()
+        response = self.client.open(self.url + "/file")
+        response.read()
+        response.close()
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_errors(self):
+        with self.assertRaises(HTTPError) as cm:
+            self.client.open(self.url + "/missing")
+        self.assertEqual(cm.exception.code, 404)
+        request = Request(self.url + "/file")
+        request.add_header("If-None-Match", "etag")
+        with self.assertRaises(HTTPError) as cm:
+            self.client.open(request)
+        self.assertEqual(cm.exception.code, 304)
+
+    def test_redirect(self):
+        response = self.client.open(self.url + "/redirect")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.geturl(), self.url + "/file")
+        response.read()
+        response.close()
+        self.assertEqual(len(self.server.connections), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from mock import patch
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
+
+from UpdateManager.Core.MetaRelease import MetaReleaseCore
+
+CURDIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class MetaReleaseHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append(self.headers)
+        if self.path == "/slow":
+            # a download that hangs in the middle
+            self.send_response(200)
+            self.send_header("Content-Length", "1000")
+            self.end_headers()
+            self.wfile.write(b"Dist: x\n")
+            self.wfile.flush()
+            self.server.release.wait(10)
+            return
+        if self.headers.get("If-None-Match") == self.server.etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = self.server.body
+        self.send_response(200)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+                f.write(body)
+            body = buf.getvalue()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", self.server.etag)
+        self.send_header("Last-Modified", "Wed, 21 Oct 2015 07:28:00 GMT")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetaReleaseServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestMetaReleaseDownload(unittest.TestCase):
+
+    def setUp(self):
+        for key in ["http_proxy", "HTTP_PROXY"]:
+            if key in os.environ:
+                self.addCleanup(os.environ.__setitem__, key, os.environ[key])
+                del os.environ[key]
+        self.server = MetaReleaseServer(("localhost", 0),
+                                        MetaReleaseHandler)
+        self.server.requests = []
+        self.server.release = threading.Event()
+        self.server.etag = '"1"'
+        self.url = "http://localhost:%s/meta-release" % (
+            self.server.server_address[1])
+        with open(os.path.join(CURDIR, "test-data", "meta-release"),
+                  "rb") as f:
+            self.server.body = f.read()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(self.server.release.set)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        # a config that does not start the download in the constructor
+        conf = os.path.join(self.tmpdir, "release-upgrades")
+        with open(conf, "w") as f:
+            f.write("[DEFAULT]\nPrompt=never\n")
+
+        class TestMetaRelease(MetaReleaseCore):
+            CONF = conf
+            CONF_METARELEASE = os.path.join(self.tmpdir, "meta-release.conf")
+            METARELEASE_DIR = self.tmpdir
+        self.meta_release_class = TestMetaRelease
+
+    def download(self, refresh_interval=0):
+        meta = self.meta_release_class()
+        meta.current_dist_name = "karmic"
+        meta.refresh_interval = refresh_interval
+        meta.METARELEASE_URI = self.url
+        meta.METARELEASE_FILE = os.path.join(self.tmpdir, "meta-release")
+        meta.metarelease_information = None
+        meta.download()
+        return meta
+
+    def test_download(self):
+        meta = self.download()
+        self.assertEqual(meta.new_dist.name, "lucid")
+        self.assertEqual(self.server.requests[0].get("Accept-Encoding"),
+                         "gzip")
+        # the file is stored uncompressed, with its validators
+        with open(meta.METARELEASE_FILE, "rb") as f:
+            self.assertEqual(f.read(), self.server.body)
+        with open(meta.METARELEASE_HEADERS_FILE) as f:
+            headers = json.load(f)
+        self.assertEqual(headers["ETag"], '"1"')
+        # no temporary files are left behind
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ["meta-release", "meta-release.headers",
+                          "meta-release.lock", "meta-release.parsed",
+                          "release-upgrades"])
+
+    def test_not_modified(self):
+        self.download()
+        meta = self.download()
+        self.assertEqual(meta.new_dist.name, "lucid")
+        headers = self.server.requests[1]
+        self.assertEqual(headers.get("If-None-Match"), '"1"')
+        self.assertEqual(headers.get("If-Modified-Since"),
+                         "Wed, 21 Oct 2015 07:28:00 GMT")
+
+    def test_force_download(self):
+        self.download()
+        os.remove(os.path.join(self.tmpdir, "meta-release.headers"))
+        meta = self.download()
+        # without the validators the file date is sent as a HTTP-date
+        self.assertTrue(
+            self.server.requests[1]["If-Modified-Since"].endswith(" GMT"))
+        meta.forceDownload = True
+        meta.download()
+        self.assertNotIn("If-Modified-Since", self.server.requests[2])
+        self.assertNotIn("If-None-Match", self.server.requests[2])
+
+    def test_refresh_interval(self):
+        self.download()
+        # a recent file is used without asking the server
+        meta = self.download(refresh_interval=60)
+        self.assertEqual(meta.new_dist.name, "lucid")
+        self.assertEqual(len(self.server.requests), 1)
+        # a 304 makes the file recent again
+        path = os.path.join(self.tmpdir, "meta-release")
+        os.utime(path, (time.time() - 120, time.time() - 120))
+        self.download(refresh_interval=60)
+        self.assertEqual(len(self.server.requests), 2)
+        self.download(refresh_interval=60)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_parsed(self):
+        with patch("UpdateManager.Core.MetaRelease.get_ubuntu_flavor",
+                   return_value="ubuntu") as mock_flavor:
+            meta = self.download()
+        # the flavor is looked up once, not for every dist
+        self.assertEqual(mock_flavor.call_count, 1)
+        uris = [meta.new_dist.releaseNotesURI,
+                meta.new_dist.releaseNotesHtmlUri]
+        # an unchanged file is not parsed again
+        with patch("apt_pkg.TagFile", side_effect=AssertionError):
+            meta = self.download(refresh_interval=60)
+        self.assertEqual(meta.new_dist.name, "lucid")
+        self.assertEqual([meta.new_dist.releaseNotesURI,
+                          meta.new_dist.releaseNotesHtmlUri], uris)
+        # but a changed one is
+        self.server.etag = '"2"'
+        self.server.body = self.server.body.replace(b"lucid", b"lynx")
+        meta = self.download()
+        self.assertEqual(meta.new_dist.name, "lynx")
+
+    def test_no_download_thread(self):
+        self.download()
+        os.environ["META_RELEASE_FAKE_CODENAME"] = "karmic"
+        self.addCleanup(os.environ.__delitem__, "META_RELEASE_FAKE_CODENAME")
+        with open(self.meta_release_class.CONF_METARELEASE, "w") as f:
+            f.write("[METARELEASE]\nURI = %s\n" % self.url)
+        self.meta_release_class.CONF = os.path.join(self.tmpdir, "missing")
+        # the recent file is parsed right away
+        meta = self.meta_release_class()
+        self.assertFalse(meta.downloading)
+        self.assertTrue(meta.wait(0))
+        self.assertEqual(meta.new_dist.name, "lucid")
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_cancel(self):
+        self.download()
+        done = []
+        meta = self.meta_release_class()
+        meta.done_downloading = lambda: done.append(meta.downloading)
+        meta.current_dist_name = "karmic"
+        meta.refresh_interval = 0
+        meta.METARELEASE_URI = self.url.replace("meta-release", "slow")
+        meta.METARELEASE_FILE = os.path.join(self.tmpdir, "meta-release")
+        meta.metarelease_information = None
+        thread = threading.Thread(target=meta.download)
+        thread.start()
+        # the download is aborted after the timeout
+        self.assertFalse(meta.wait(0.5))
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(done, [False])
+        self.assertIsNone(meta.new_dist)
+        # the previous file is kept
+        with open(meta.METARELEASE_FILE, "rb") as f:
+            self.assertEqual(f.read(), self.server.body)
+        # and the partial download is removed
+        self.assertEqual([name for name in os.listdir(self.tmpdir)
+                          if name.startswith(".tmp")], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
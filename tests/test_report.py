@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import apt
+
+from mock import patch, MagicMock
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from UpdateManager.Core import UpdateList
+from UpdateManager.Core.MyCache import MyCache
+from UpdateManager.Core.report import get_report, write_report
+
+CURDIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class TestReport(unittest.TestCase):
+
+    def setUp(self):
+        real_arch = apt.apt_pkg.config.find("APT::Architecture")
+        apt.apt_pkg.config.set("APT::Architecture", "amd64")
+        self.addCleanup(
+            lambda: apt.apt_pkg.config.set("APT::Architecture", real_arch))
+        self.aptroot = os.path.join(CURDIR, "aptroot-grouping-test")
+        self.cache = MyCache(apt.progress.base.OpProgress(),
+                             rootdir=self.aptroot)
+        self.updates_list = UpdateList.UpdateList(parent=None, dist='lucid',
+                                                  headless=True)
+        self.updates_list.desktop_file_index = UpdateList.DesktopFileIndex(
+            ['/usr/share/applications'], '/nonexistent',
+            os.path.join(self.aptroot, "var", "lib", "dpkg", "info"),
+            index_file=False)
+        with patch.object(UpdateList, "DesktopEntry") as mock_entry:
+            mock_entry.side_effect = self.fake_desktop
+            self.updates_list.update(self.cache)
+
+    def fake_desktop(self, path):
+        app = MagicMock()
+        app.get_filename.return_value = path
+        app.get_display_name.return_value = 'App ' + os.path.basename(path)
+        app.get_icon.return_value = "package"
+        return app
+
+    def test_report(self):
+        report = get_report(self.cache, self.updates_list)
+        self.assertEqual(report["dist"], "lucid")
+        self.assertEqual(
+            [(g["type"], g["security"]) for g in report["groups"]],
+            [("system", True), ("application", False),
+             ("application", False), ("package", False),
+             ("package", False)])
+        updates = dict((u["name"], u) for u in report["updates"])
+        self.assertTrue(updates["base-pkg"]["security"])
+        self.assertFalse(updates["installed-pkg"]["security"])
+        self.assertEqual(updates["installed-pkg-single-dep"]["group"],
+                         "App installed-app-with-subitems.desktop")
+        self.assertEqual(report["held-back"], [])
+        # it is really json serializable
+        json.dumps(report)
+
+    def test_ndjson(self):
+        report = get_report(self.cache, self.updates_list)
+        out = StringIO()
+        write_report(report, out, ndjson=True)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(lines), len(report["updates"]) + 1)
+        self.assertEqual(set(line["type"] for line in lines[:-1]),
+                         set(["update"]))
+        self.assertEqual(lines[-1]["type"], "summary")
+        self.assertNotIn("updates", lines[-1])
+
+
+class TestHeadless(unittest.TestCase):
+
+    def test_no_gtk(self):
+        # the headless report must not load Gtk/Gio
+        code = ("import sys; import UpdateManager.Core.report; "
+                "print('gi.repository' in sys.modules)")
+        output = subprocess.check_output(
+            [sys.executable, "-c", code],
+            cwd=os.path.dirname(CURDIR))
+        self.assertEqual(output.strip(), b"False")
+
+
+class TestDesktopEntry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def make_entry(self, content):
+        path = os.path.join(self.tmpdir, "app.desktop")
+        with open(path, "w") as f:
+            f.write(content)
+        return UpdateList.DesktopEntry(path)
+
+    def test_entry(self):
+        entry = self.make_entry("[Desktop Entry]\n"
+                                "Name=App\n"
+                                "Name[de]=Anwendung\n"
+                                "Icon=app-icon\n"
+                                "OnlyShowIn=GNOME;Unity;\n"
+                                "[Desktop Action New]\n"
+                                "Name=New Window\n")
+        self.assertEqual(entry.get_display_name(), "App")
+        self.assertEqual(entry.get_icon(), "app-icon")
+        self.assertFalse(entry.should_show())
+        entry.set_desktop_env("Unity")
+        self.assertTrue(entry.should_show())
+
+    def test_no_display(self):
+        entry = self.make_entry("[Desktop Entry]\nName=App\nNoDisplay=true\n")
+        self.assertFalse(entry.should_show())
+        entry = self.make_entry("[Desktop Entry]\nName=App\nNotShowIn=KDE\n")
+        entry.set_desktop_env("KDE")
+        self.assertFalse(entry.should_show())
+
+    def test_hidden(self):
+        self.assertRaises(ValueError, self.make_entry,
+                          "[Desktop Entry]\nName=App\nHidden=true\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,11 @@
 #!/usr/bin/python3
 # -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
 
+import json
 import os
+import random
+import shutil
+import tempfile
 
 import apt
 import unittest
@@ -10,7 +14,9 @@ from UpdateManager.Core import UpdateList
 from UpdateManager.Core.MyCache import MyCache
 
 from gi.repository import Gio
-from mock import patch, PropertyMock, MagicMock
+from mock import patch, MagicMock
+
+from synthetic_aptroot import make_aptroot
 
 CURDIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -38,18 +44,57 @@ class PhasedTestCase(unittest.TestCase):
 
     def test_phased_percentage_not_included(self):
         """ Test that updates above the threshold are not included"""
-        with patch.object(self.updates_list.random, "randint") as mock_randint:
-            mock_randint.return_value = 100
+        with patch.object(self.updates_list,
+                          "_get_phasing_value") as mock_value:
+            mock_value.return_value = 100
             self.updates_list.update(self.cache)
             self.assertUpdatesListLen(1)
 
     def test_phased_percentage_included(self):
         """ Test that updates below the threshold are included"""
-        with patch.object(self.updates_list.random, "randint") as mock_randint:
-            mock_randint.return_value = 1
+        with patch.object(self.updates_list,
+                          "_get_phasing_value") as mock_value:
+            mock_value.return_value = 1
             self.updates_list.update(self.cache)
             self.assertUpdatesListLen(2)
 
+    def test_phasing_report(self):
+        with patch.object(self.updates_list,
+                          "_get_phasing_value") as mock_value:
+            mock_value.return_value = 11
+            self.updates_list.update(self.cache)
+        report = self.updates_list.get_phasing_report()
+        self.assertEqual(len(report), 1)
+        entry = list(report.values())[0]
+        self.assertEqual(entry["percentage"], 10)
+        self.assertEqual(entry["value"], 11)
+        self.assertFalse(entry["included"])
+
+    def test_phasing_value(self):
+        self.assertFalse(self.updates_list.legacy_phasing)
+        value = self.updates_list._get_phasing_value("pkg", "1.0")
+        self.assertTrue(0 <= value <= 100)
+        # the same on every run
+        self.assertEqual(
+            UpdateList.UpdateList(parent=None)._get_phasing_value(
+                "pkg", "1.0"), value)
+        values = set(self.updates_list._get_phasing_value("pkg", str(i))
+                     for i in range(200))
+        self.assertGreater(len(values), 50)
+
+    def test_phasing_value_legacy(self):
+        apt.apt_pkg.config.set(
+            self.updates_list.LEGACY_PHASED_UPDATES, "1")
+        self.addCleanup(apt.apt_pkg.config.clear,
+                        self.updates_list.LEGACY_PHASED_UPDATES)
+        updates_list = UpdateList.UpdateList(parent=None)
+        self.assertTrue(updates_list.legacy_phasing)
+        # the same value as the Random() based version
+        rand = random.Random()
+        rand.seed("pkg-1.0-%s" % updates_list.machine_uniq_id)
+        self.assertEqual(updates_list._get_phasing_value("pkg", "1.0"),
+                         rand.randint(0, 100))
+
     def test_phased_percentage_included_via_force(self):
         """ Test that the "always" override config works """
         # set config to force override
@@ -58,8 +103,9 @@ class PhasedTestCase(unittest.TestCase):
         self.addCleanup(lambda: apt.apt_pkg.config.set(
             self.updates_list.ALWAYS_INCLUDE_PHASED_UPDATES, "0"))
         # ensure it's included even if it's above the threshold
-        with patch.object(self.updates_list.random, "randint") as mock_randint:
-            mock_randint.return_value = 100
+        with patch.object(self.updates_list,
+                          "_get_phasing_value") as mock_value:
+            mock_value.return_value = 100
             self.updates_list.update(self.cache)
             self.assertUpdatesListLen(2)
 
@@ -71,26 +117,27 @@ class PhasedTestCase(unittest.TestCase):
         self.addCleanup(lambda: apt.apt_pkg.config.set(
             self.updates_list.NEVER_INCLUDE_PHASED_UPDATES, "0"))
         # ensure it's excluded even if it's below the threshold
-        with patch.object(self.updates_list.random, "randint") as mock_randint:
-            mock_randint.return_value = 0
+        with patch.object(self.updates_list,
+                          "_get_phasing_value") as mock_value:
+            mock_value.return_value = 0
             self.updates_list.update(self.cache)
             self.assertUpdatesListLen(1)
 
-    @patch('UpdateManager.Core.UpdateList.UpdateList._is_security_update')
+    @patch('UpdateManager.Core.UpdateList.UpdateList._get_security_flags')
     def test_phased_percentage_from_security(self, mock_security):
         """ Test that updates from the security node go in"""
         # pretend all updates come from security for the sake of this test
-        mock_security.return_value = True
-        with patch.object(self.updates_list.random, "randint") as mock_randint:
-            mock_randint.return_value = 100
+        mock_security.side_effect = lambda cache, pkgs: [True] * len(pkgs)
+        with patch.object(self.updates_list,
+                          "_get_phasing_value") as mock_value:
+            mock_value.return_value = 100
             self.updates_list.update(self.cache)
             self.assertUpdatesListLen(2)
 
 class GroupingTestCase(unittest.TestCase):
-    # installed_files does not respect aptroot, so we have to patch it
-    @patch('apt.package.Package.installed_files', new_callable=PropertyMock)
+    # the .desktop files are found via aptroot/var/lib/dpkg/info/*.list
     @patch('gi.repository.Gio.DesktopAppInfo.new_from_filename')
-    def setUp(self, mock_desktop, mock_installed):
+    def setUp(self, mock_desktop):
         # mangle the arch
         real_arch = apt.apt_pkg.config.find("APT::Architecture")
         apt.apt_pkg.config.set("APT::Architecture", "amd64")
@@ -100,19 +147,14 @@ class GroupingTestCase(unittest.TestCase):
                                     "aptroot-grouping-test")
         self.cache = MyCache(apt.progress.base.OpProgress(),
                              rootdir=self.aptroot)
-        mock_installed.__get__ = self.fake_installed_files
         mock_desktop.side_effect = self.fake_desktop
         self.updates_list = UpdateList.UpdateList(parent=None, dist='lucid')
+        self.updates_list.desktop_file_index = UpdateList.DesktopFileIndex(
+            ['/usr/share/applications'], '/nonexistent',
+            os.path.join(self.aptroot, "var", "lib", "dpkg", "info"),
+            index_file=False)
         self.updates_list.update(self.cache)
 
-    def fake_installed_files(self, mock_prop, pkg, pkg_class):
-        if pkg.name == 'installed-app':
-            return ['/usr/share/applications/installed-app.desktop']
-        elif pkg.name == 'installed-app-with-subitems':
-            return ['/usr/share/applications/installed-app2.desktop']
-        else:
-            return []
-
     def fake_desktop(self, path):
         # These can all be the same for our purposes
         app = MagicMock()
@@ -167,5 +209,246 @@ class GroupingTestCase(unittest.TestCase):
         self.assertIsNone(group.core_item)
         self.assertListEqual([x.pkg.name for x in group.items], ['base-pkg'])
 
+    def test_selection(self):
+        group = self.updates_list.update_groups[1]
+        items = group.items
+        self.assertIs(group.items, items)
+        self.assertEqual(group.count_selected(), 2)
+        self.assertFalse(group.selection_is_inconsistent())
+        items[1].pkg.mark_keep()
+        self.assertEqual(group.count_selected(), 1)
+        self.assertTrue(group.packages_are_selected())
+        self.assertTrue(group.selection_is_inconsistent())
+        # adding an item sorts the items and sums the sizes again
+        size = group.get_total_size()
+        group.add(self.cache['base-pkg'])
+        self.assertIsNot(group.items, items)
+        self.assertEqual(len(group.items), 3)
+        self.assertEqual(group.get_total_size(),
+                         size + self.cache['base-pkg'].candidate.size)
+
+    def test_attributes(self):
+        for group in (self.updates_list.update_groups +
+                      self.updates_list.security_groups):
+            for item in group.items:
+                candidate = item.pkg.candidate
+                self.assertEqual(item.attributes.size, candidate.size)
+                self.assertEqual(item.attributes.source_name,
+                                 candidate.source_name)
+                self.assertFalse(item.attributes.requires_restart)
+                self.assertFalse(group.requires_restart())
+
+
+class SnapshotTestCase(GroupingTestCase):
+    """ the grouping tests, run on the groups restored from a snapshot """
+
+    @patch('gi.repository.Gio.DesktopAppInfo.new_from_filename')
+    def setUp(self, mock_desktop):
+        real_arch = apt.apt_pkg.config.find("APT::Architecture")
+        apt.apt_pkg.config.set("APT::Architecture", "amd64")
+        self.addCleanup(
+            lambda: apt.apt_pkg.config.set("APT::Architecture", real_arch))
+        self.aptroot = os.path.join(CURDIR,
+                                    "aptroot-grouping-test")
+        self.cache = MyCache(apt.progress.base.OpProgress(),
+                             rootdir=self.aptroot)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.snapshot_file = os.path.join(self.tmpdir, "snapshot")
+        mock_desktop.side_effect = self.fake_desktop
+        self.make_list().update(self.cache)
+        self.assertTrue(os.path.exists(self.snapshot_file))
+        self.updates_list = self.make_list()
+        with patch.object(self.updates_list, "_classify") as mock_classify, \
+                patch.object(self.updates_list, "_make_groups") as mock_make, \
+                patch.object(UpdateList.PackageAttributes,
+                             "from_package") as mock_attributes:
+            self.updates_list.update(self.cache)
+        self.assertFalse(mock_classify.called)
+        self.assertFalse(mock_make.called)
+        self.assertFalse(mock_attributes.called)
+
+    def make_list(self):
+        updates_list = UpdateList.UpdateList(parent=None, dist='lucid',
+                                             use_snapshot=True)
+        updates_list.snapshot_file = self.snapshot_file
+        updates_list.desktop_file_index = UpdateList.DesktopFileIndex(
+            ['/usr/share/applications'], '/nonexistent',
+            os.path.join(self.aptroot, "var", "lib", "dpkg", "info"),
+            index_file=False)
+        return updates_list
+
+    @patch('gi.repository.Gio.DesktopAppInfo.new_from_filename')
+    def test_changed_version(self, mock_desktop):
+        mock_desktop.side_effect = self.fake_desktop
+        with open(self.snapshot_file) as f:
+            snapshot = json.load(f)
+        snapshot["packages"]["installed-pkg"]["candidate"] = "0.1"
+        with open(self.snapshot_file, "w") as f:
+            json.dump(snapshot, f)
+        updates_list = self.make_list()
+        with patch.object(updates_list, "_classify") as mock_classify:
+            mock_classify.side_effect = (
+                lambda cache, pkgs: [(False, False)] * len(pkgs))
+            updates_list.update(self.cache)
+        # only the changed package is classified again
+        self.assertEqual(mock_classify.call_count, 1)
+        self.assertEqual([pkg.name for pkg in mock_classify.call_args[0][1]],
+                         ["installed-pkg"])
+        self.assertEqual(len(updates_list.update_groups), 4)
+
+    def test_changed_lists(self):
+        with open(self.snapshot_file) as f:
+            snapshot = json.load(f)
+        snapshot["key"]["lists"] = "outdated"
+        with open(self.snapshot_file, "w") as f:
+            json.dump(snapshot, f)
+        self.assertIsNone(
+            self.make_list()._load_snapshot(
+                self.updates_list._get_snapshot_key()))
+
+
+class SecurityIndexTestCase(unittest.TestCase):
+
+    # every combination of security/updates/installed versions (see
+    # make_aptroot), the timing on a large aptroot is in benchmark.py
+    NR_PKGS = 30
+
+    def setUp(self):
+        real_arch = apt.apt_pkg.config.find("APT::Architecture")
+        apt.apt_pkg.config.set("APT::Architecture", "amd64")
+        self.addCleanup(
+            lambda: apt.apt_pkg.config.set("APT::Architecture", real_arch))
+        self.aptroot = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.aptroot)
+        self.security_pkgs = make_aptroot(self.aptroot, self.NR_PKGS)
+        self.cache = MyCache(apt.progress.base.OpProgress(),
+                             rootdir=self.aptroot)
+        self.updates_list = UpdateList.UpdateList(parent=None, dist='lucid')
+
+    def test_security_flags(self):
+        pkgs = [pkg for pkg in self.cache if pkg.is_upgradable]
+        self.assertGreater(len(pkgs), self.NR_PKGS // 2)
+        flags = self.updates_list._get_security_flags(self.cache, pkgs)
+        self.assertEqual(len(self.security_pkgs), 8)
+        self.assertEqual(
+            set(pkg.name for (pkg, flag) in zip(pkgs, flags) if flag),
+            self.security_pkgs)
+        # the single package api gives the same result
+        for pkg in pkgs:
+            self.assertEqual(self.updates_list._is_security_update(pkg),
+                             pkg.name in self.security_pkgs)
+
+    def test_security_files_per_cache(self):
+        files = self.updates_list._get_security_files(self.cache)
+        self.assertEqual(len(files), 1)
+        self.assertIs(self.updates_list._get_security_files(self.cache),
+                      files)
+        # a reopened cache gets a new index
+        self.cache.open()
+        self.assertIsNot(self.updates_list._get_security_files(self.cache),
+                         files)
+
+
+class DesktopFileIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.info_dir = os.path.join(CURDIR, "aptroot-grouping-test",
+                                     "var", "lib", "dpkg", "info")
+        self.app_install_dir = os.path.join(self.tmpdir, "app-install")
+        os.mkdir(self.app_install_dir)
+        with open(os.path.join(self.app_install_dir,
+                               "installed-pkg:foo.desktop"), "w"):
+            pass
+        self.index_file = os.path.join(self.tmpdir, "index")
+
+    def make_index(self):
+        return UpdateList.DesktopFileIndex(
+            ['/usr/share/applications'], self.app_install_dir,
+            self.info_dir, self.index_file)
+
+    def test_index(self):
+        index = self.make_index()
+        self.assertEqual(index.get("installed-app"),
+                         ['/usr/share/applications/installed-app.desktop'])
+        self.assertEqual(index.get("installed-app:amd64"),
+                         ['/usr/share/applications/installed-app.desktop'])
+        self.assertEqual(index.get("installed-pkg"),
+                         [os.path.join(self.app_install_dir,
+                                       "installed-pkg:foo.desktop")])
+        self.assertEqual(index.get("base-pkg"), [])
+
+    def test_persisted(self):
+        self.make_index().get("installed-app")
+        self.assertTrue(os.path.exists(self.index_file))
+        # a unchanged index is not built again
+        index = self.make_index()
+        with patch.object(index, "_build") as mock_build:
+            index.get("installed-app")
+            self.assertFalse(mock_build.called)
+        # but it is when one of the directories changed
+        os.utime(self.app_install_dir, (0, 0))
+        index = self.make_index()
+        with patch.object(index, "_build") as mock_build:
+            mock_build.return_value = {}
+            index.get("installed-app")
+            self.assertTrue(mock_build.called)
+
+
+class DependencyIndexTestCase(unittest.TestCase):
+
+    def make_pkg(self, name, deps, has_candidate=True):
+        pkg = MagicMock()
+        pkg.name = name
+        if has_candidate:
+            dependencies = []
+            for dep in deps:
+                base_dep = MagicMock()
+                base_dep.name = dep
+                dependencies.append([base_dep])
+            pkg.candidate.get_dependencies.return_value = dependencies
+        else:
+            pkg.candidate = None
+        return pkg
+
+    def setUp(self):
+        # a -> b -> c -> b (cycle), c -> d, e -> f (no candidate) -> d
+        self.cache = {
+            "a": self.make_pkg("a", ["b"]),
+            "b": self.make_pkg("b", ["c"]),
+            "c": self.make_pkg("c", ["b", "d", "not-in-cache"]),
+            "d": self.make_pkg("d", []),
+            "e": self.make_pkg("e", ["f"]),
+            "f": self.make_pkg("f", ["d"], has_candidate=False),
+        }
+        self.index = UpdateList.DependencyIndex(self.cache,
+                                                ["a", "b", "d", "e", "f"])
+
+    def reaches(self, name, target):
+        return bool(self.index.get_reach(name) & self.index.bits[target])
+
+    def test_reach(self):
+        self.assertTrue(self.reaches("a", "a"))
+        self.assertTrue(self.reaches("a", "b"))
+        self.assertTrue(self.reaches("a", "d"))
+        self.assertTrue(self.reaches("c", "b"))
+        self.assertFalse(self.reaches("b", "a"))
+        self.assertFalse(self.reaches("d", "b"))
+
+    def test_no_candidate(self):
+        # packages without a candidate stop the walk, like before
+        self.assertFalse(self.reaches("e", "f"))
+        self.assertFalse(self.reaches("e", "d"))
+        self.assertEqual(self.index.get_reach("f"), 0)
+
+    def test_group(self):
+        group = UpdateList.UpdateGroup(None, None, None)
+        group._items.add(UpdateList.UpdateItem(self.cache["c"], "c", None))
+        self.assertTrue(group.is_dependency(self.cache, self.cache["d"]))
+        self.assertFalse(group.is_dependency(self.cache, self.cache["a"]))
+
+
 if __name__ == "__main__":
     unittest.main()
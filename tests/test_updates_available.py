@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+
+import logging
+import sys
+import unittest
+from mock import Mock, patch
+
+from UpdateManager.UpdatesAvailable import (LIST_NAME, LIST_UPDATE_DATA,
+                                            PLACEHOLDER_DATA,
+                                            UpdatesAvailable)
+
+import os
+CURDIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_group(name, item_names):
+    group = Mock()
+    group.name = name
+    group.get_total_size.return_value = 0
+    group.items = []
+    for item_name in item_names:
+        item = Mock()
+        item.name = item_name
+        item.attributes.size = 0
+        group.items.append(item)
+    return group
+
+
+class TestCollapsedGroups(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('UpdateManager.UpdateManager.UpdateManager')
+        self.addCleanup(patcher.stop)
+        self.manager = patcher.start()
+        self.manager.datadir = os.path.join(CURDIR, '..', 'data')
+        self.manager.update_list.security_groups = []
+        self.pane = UpdatesAvailable(self.manager)
+        self.group = make_group("Group", ["libfoo1", "foo-data"])
+        self.pane._reset_selection_rows()
+        self.pane._add_groups([self.group])
+        self.store = self.pane.store
+        self.group_iter = self.store.get_iter_first()
+        self.path = self.store.get_path(self.group_iter)
+
+    def test_expand(self):
+        # only a placeholder until the group is expanded
+        child = self.store.iter_children(self.group_iter)
+        self.assertIs(self.store.get_value(child, LIST_UPDATE_DATA),
+                      PLACEHOLDER_DATA)
+        self.pane.treeview_update.expand_row(self.path, False)
+        rows = self.store[self.path].iterchildren()
+        self.assertEqual([row[LIST_NAME] for row in rows],
+                         ["libfoo1", "foo-data"])
+        self.assertEqual(self.pane._collapsed_groups, {})
+
+    def test_search(self):
+        search = self.pane._search_equal_func
+        self.assertFalse(search(self.store, LIST_NAME, "gro",
+                                self.group_iter))
+        # a collapsed group is found by the names of its items
+        self.assertFalse(search(self.store, LIST_NAME, "foo-",
+                                self.group_iter))
+        self.assertTrue(search(self.store, LIST_NAME, "bar",
+                               self.group_iter))
+        # once expanded the item rows are found themselves
+        self.pane.treeview_update.expand_row(self.path, False)
+        self.assertTrue(search(self.store, LIST_NAME, "foo-",
+                               self.group_iter))
+
+    def test_handlers(self):
+        # the placeholder is skipped
+        child = self.store.iter_children(self.group_iter)
+        self.assertFalse(self.pane.on_update_toggled(
+            None, self.store.get_path(child)))
+        renderer = Mock()
+        self.pane.pkg_label_renderer_data_func(None, renderer, self.store,
+                                               child, None)
+        renderer.set_property.assert_called_with("markup", "")
+        # toggling a collapsed group toggles all of its items
+        with patch.object(self.pane, "toggle_from_groups") as mock_toggle:
+            with patch.object(self.pane, "updates_changed"):
+                self.pane.on_update_toggled(None, self.path)
+        mock_toggle.assert_called_with([self.group])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "-v":
+        logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
@@ -3,8 +3,13 @@
 
 import logging
 import glob
+import json
 import mock
+import os
+import shutil
 import sys
+import tempfile
+import threading
 import unittest
 
 from UpdateManager.Core import utils
@@ -85,6 +90,33 @@ class TestUtils(unittest.TestCase):
     def test_flavor_default(self):
         self.assertEqual(utils.get_ubuntu_flavor(cache={}), 'ubuntu')
 
+    @mock.patch('UpdateManager.Core.utils._load_meta_pkg_list')
+    def test_flavor_package_dpkg_status(self, mock_load):
+        mock_load.return_value = ['xubuntu-desktop', 'kubuntu-desktop']
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        status = os.path.join(tmpdir, "status")
+        with open(status, "w") as f:
+            f.write("Package: kubuntu-desktop\n"
+                    "Status: install ok installed\n"
+                    "\n"
+                    "Package: xubuntu-desktop\n"
+                    "Status: deinstall ok config-files\n")
+        old_status = utils.apt_pkg.config.find("Dir::State::status")
+        utils.apt_pkg.config.set("Dir::State::status", status)
+        self.addCleanup(utils.apt_pkg.config.set, "Dir::State::status",
+                        old_status)
+        self.addCleanup(setattr, utils, "_flavor_package", None)
+        utils._flavor_package = None
+        self.assertEqual(utils.get_ubuntu_flavor_package(),
+                         'kubuntu-desktop')
+        # the status file is only read once
+        os.remove(status)
+        self.assertEqual(utils.get_ubuntu_flavor_name(), 'Kubuntu')
+        # but a given cache is always used
+        self.assertEqual(utils.get_ubuntu_flavor_package(cache={}),
+                         'ubuntu-desktop')
+
     @mock.patch('UpdateManager.Core.utils.get_ubuntu_flavor_package')
     def test_flavor_simple(self, mock_package):
         mock_package.return_value = 'd'
@@ -111,6 +143,71 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(utils.get_ubuntu_flavor_name(), 'Ubuntu Studio')
 
 
+class TestTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def make_trace(self, format):
+        trace = utils.Trace(os.path.join(self.tmpdir, "trace"), format)
+        with utils.ExecutionTime("outer", trace):
+            with utils.ExecutionTime("inner", trace):
+                pass
+        thread = threading.Thread(
+            target=lambda: trace.add("other", trace.start, 0.5),
+            name="worker")
+        thread.start()
+        thread.join()
+        trace.write()
+        with open(trace.path) as f:
+            return json.load(f)
+
+    def test_json(self):
+        data = self.make_trace("json")
+        self.assertEqual([span["name"] for span in data["spans"]],
+                         ["inner", "outer", "other"])
+        self.assertEqual(data["spans"][2]["thread"], "worker")
+        self.assertEqual(data["spans"][2]["duration"], 0.5)
+
+    def test_chrome(self):
+        data = self.make_trace("chrome")
+        events = [e for e in data["traceEvents"] if e["ph"] == "X"]
+        self.assertEqual([e["name"] for e in events],
+                         ["inner", "outer", "other"])
+        self.assertEqual(events[2]["dur"], 500000)
+        self.assertNotEqual(events[0]["tid"], events[2]["tid"])
+        threads = [e["args"]["name"] for e in data["traceEvents"]
+                   if e["ph"] == "M"]
+        self.assertIn("worker", threads)
+
+    def test_span_disabled(self):
+        with mock.patch.object(utils, "_trace", None):
+            with mock.patch.object(utils, "_trace_checked_env", True):
+                with utils.trace_span("nothing"):
+                    pass
+
+    def test_span_enabled(self):
+        trace = utils.Trace()
+        with mock.patch.object(utils, "_trace", trace):
+            with utils.trace_span("something"):
+                pass
+        self.assertEqual([span[0] for span in trace.spans], ["something"])
+
+    def test_unknown_format(self):
+        path = os.path.join(self.tmpdir, "trace")
+        with mock.patch.dict(os.environ, {utils.TRACE_ENV: path,
+                                          utils.TRACE_FORMAT_ENV: "xml"}):
+            with mock.patch.object(utils, "_trace", None):
+                with mock.patch.object(utils, "_trace_checked_env", False):
+                    with mock.patch("atexit.register"):
+                        with utils.trace_span("something"):
+                            pass
+                        trace = utils.get_trace()
+        self.assertEqual(trace.format, "chrome")
+        self.assertEqual([span[0] for span in trace.spans], ["something"])
+
+
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == "-v":
         logging.basicConfig(level=logging.DEBUG)